@@ -0,0 +1,43 @@
+"""Compares building Locations one at a time with from_ip_list() against
+the bulk loader.
+
+Usage:
+    python benchmarks/bulk_locations.py [records]
+"""
+
+import sys
+import time
+
+from pyptables.rules.forwarding.locations import Location
+from pyptables.rules.forwarding.zones import Zone
+
+
+def records(count, zone_count=20):
+    for i in range(count):
+        ips = '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255)
+        if i % 3 == 0:
+            ips += ',172.16.%d.0/24' % (i & 255)
+        elif i % 3 == 1:
+            ips += ',192.168.%d.1-192.168.%d.9' % (i & 255, i & 255)
+        yield 'host%d' % i, 'zone%d' % (i % zone_count), ips
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 100000
+    zones = dict(('zone%d' % i, Zone('zone%d' % i, 'eth%d' % i)) for i in range(20))
+    data = list(records(count))
+
+    start = time.time()
+    result = []
+    for name, zone, ips in data:
+        result.extend(Location.from_ip_list(name, zones[zone], ips))
+    print("from_ip_list: %8d locations in %.3fs" % (len(result), time.time() - start))
+
+    start = time.time()
+    grouped = Location.bulk_load(data, zones, source='benchmark')
+    total = sum(len(locations) for locations in grouped.values())
+    print("bulk_load:    %8d locations in %.3fs (validated)" % (total, time.time() - start))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,57 @@
+"""Times normalizing a large ruleset and comparing it with iptables-save output.
+
+Usage:
+    python benchmarks/canonical.py [rules]
+"""
+
+import sys
+import time
+
+from pyptables import default_tables, UserChain, Jump, COMPACT
+from pyptables.rules import Accept
+from pyptables.canonical import render_save
+from pyptables.service import render_chains, delta_payload
+
+
+def build_tables(count):
+    tables = default_tables()
+    chain = tables['filter'].append(UserChain('hosts', comment='Per-host rules'))
+    for i in range(count):
+        chain.append(Accept(source='10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255), p='tcp', dport='443',
+                            comment='host %d https' % i))
+    tables['filter']['FORWARD'].append(Jump(chain))
+    return tables
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 50000
+    tables = build_tables(count)
+
+    start = time.time()
+    payload = tables.to_iptables(profile=COMPACT)
+    print("%d rules: rendered compact in %.2fs" % (count, time.time() - start))
+
+    start = time.time()
+    canonical = render_chains(tables, profile='canonical')
+    print("rendered canonical in %.2fs" % (time.time() - start))
+
+    start = time.time()
+    render_chains(tables, profile='canonical')
+    print("rendered canonical again (normalized rules cached) in %.2fs" % (time.time() - start))
+
+    start = time.time()
+    saved = render_save(payload)
+    print("normalized the compact payload in %.2fs" % (time.time() - start))
+
+    output = tables.to_iptables(profile='canonical')
+    start = time.time()
+    saved = render_save(output, normalized=True)
+    print("read canonical (iptables-save) output in %.2fs" % (time.time() - start))
+
+    start = time.time()
+    delta = delta_payload(saved, canonical)
+    print("compared in %.2fs, %s" % (time.time() - start, 'no changes' if delta is None else 'changed'))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
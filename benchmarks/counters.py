@@ -0,0 +1,73 @@
+"""Times parsing, mapping and exporting the counters of a large ruleset.
+
+Usage:
+    python benchmarks/counters.py [rules]
+"""
+
+import sys
+import time
+
+from pyptables import default_tables, UserChain, Jump, COMPACT
+from pyptables.rules import Accept
+from pyptables.counters import CounterSample, RuleMap, parse_list
+
+
+def build_tables(count):
+    tables = default_tables()
+    chain = tables['filter'].append(UserChain('hosts', comment='Per-host rules'))
+    for i in range(count):
+        chain.append(Accept(source='10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255), p='tcp', dport='443',
+                            comment='host %d https' % i))
+    tables['filter']['FORWARD'].append(Jump(chain))
+    return tables
+
+
+def counter_dumps(payload):
+    """Returns fake iptables-save -c and iptables -L -v -x -n outputs for payload"""
+    saved = []
+    listed = ['Chain hosts (1 references)',
+              '    pkts      bytes target     prot opt in     out     source               destination']
+    for i, line in enumerate(payload.split('\n')):
+        if line.startswith('-A hosts'):
+            saved.append('[%d:%d] %s' % (i, i * 60, line))
+            listed.append('%8d %8d ACCEPT     tcp  --  *      *       10.0.0.%d             0.0.0.0/0            '
+                          'tcp dpt:443 /* host %d https */' % (i, i * 60, i & 255, i))
+        else:
+            saved.append(line)
+    return "\n".join(saved), "\n".join(listed)
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 200000
+    tables = build_tables(count)
+    saved, listed = counter_dumps(tables.to_iptables(profile=COMPACT))
+
+    start = time.time()
+    sample = CounterSample.from_save(saved, time=0)
+    print("%d rules: parsed iptables-save -c in %.2fs" % (len(sample), time.time() - start))
+
+    start = time.time()
+    parse_list(listed)
+    print("parsed iptables -L -v -x -n in %.2fs" % (time.time() - start))
+
+    start = time.time()
+    rule_map = RuleMap(tables, profile=COMPACT)
+    mapped = sum(1 for counter in sample if rule_map[counter] is not None)
+    print("mapped %d rules in %.2fs" % (mapped, time.time() - start))
+
+    later = CounterSample.from_save(saved, time=10)
+    start = time.time()
+    rates = later.rates(sample)
+    print("%d rates in %.2fs" % (len(rates), time.time() - start))
+
+    start = time.time()
+    text = sample.to_prometheus(rule_map)
+    print("prometheus export of %d bytes in %.2fs" % (len(text), time.time() - start))
+
+    start = time.time()
+    sample.to_json()
+    print("JSON export in %.2fs" % (time.time() - start))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
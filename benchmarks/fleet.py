@@ -0,0 +1,76 @@
+"""Compares building and rendering a complete Tables per host with
+rendering HostTables overlays on a shared FleetBase, and times
+render_fleet() writing the output of every host.
+
+Usage:
+    python benchmarks/fleet.py [hosts] [base rules] [processes]
+"""
+
+import shutil
+import sys
+import tempfile
+import time
+
+from pyptables import default_tables, Rule, UserChain, Jump, COMPACT
+from pyptables.fleet import FleetBase, render_fleet
+
+
+def build_base(rule_count):
+    tables = default_tables()
+    common = tables['filter'].append(UserChain('common', comment='Common rules'))
+    for i in range(rule_count):
+        common.append(Rule(s='10.%d.%d.0/24' % (i >> 8 & 255, i & 255), p='tcp', dport=str(1000 + i % 5000),
+                           j='ACCEPT', comment='common service %d' % i))
+    tables['filter'].append(UserChain('services'))
+    tables['filter']['INPUT'].append(Jump(common))
+    tables['filter']['INPUT'].append(Jump('services'))
+    return tables
+
+
+def host_services(host):
+    return [Rule(p='tcp', dport=str(8000 + (host + i) % 100), j='ACCEPT', comment='host %d service %d' % (host, i))
+            for i in range(10)]
+
+
+def main(argv):
+    host_count = int(argv[1]) if len(argv) > 1 else 200
+    rule_count = int(argv[2]) if len(argv) > 2 else 5000
+    processes = int(argv[3]) if len(argv) > 3 else None
+
+    start = time.time()
+    for host in range(host_count):
+        tables = build_base(rule_count)
+        tables['filter']['services'].extend(host_services(host))
+        tables['filter']['INPUT'].append(Rule(s='192.0.2.%d' % (host % 256), j='ACCEPT'))
+        tables.to_iptables(profile=COMPACT)
+    print("full tables:   %d hosts in %.2fs" % (host_count, time.time() - start))
+
+    start = time.time()
+    base = FleetBase(build_base(rule_count))
+    hosts = {}
+    for host in range(host_count):
+        overlay = hosts['host%d' % host] = base.host('host%d' % host)
+        overlay.replace('filter', UserChain('services', rules=host_services(host)))
+        overlay.append('filter', 'INPUT', Rule(s='192.0.2.%d' % (host % 256), j='ACCEPT'))
+    built = time.time()
+    for overlay in hosts.values():
+        overlay.to_iptables(profile=COMPACT)
+    print("overlays:      %d hosts built in %.2fs, rendered in %.2fs" % (host_count, built - start,
+                                                                        time.time() - built))
+    assert overlay.to_iptables(profile=COMPACT) == overlay.tables().to_iptables(profile=COMPACT)
+
+    directory = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        reports = render_fleet(hosts, directory, profile=COMPACT, processes=processes)
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(directory)
+    slowest = max(reports, key=lambda report: report.seconds)
+    print("render_fleet:  %d hosts, %d bytes in %.2fs, slowest %s %.3fs, max rss %.1fMB" % (
+        len(reports), sum(report.size for report in reports), elapsed, slowest.host, slowest.seconds,
+        max(report.max_rss for report in reports) / 1e6))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,41 @@
+"""Times generating the scripts updating a large blocklist ipset: a full
+swap, against a member-level diff for a small change.
+
+Usage:
+    python benchmarks/ipsets.py [members] [changes]
+"""
+
+import sys
+import time
+
+from pyptables.rules.forwarding.ipsets import IPSet
+
+
+def network(i):
+    return '%d.%d.%d.0/24' % (1 + (i >> 16 & 127), i >> 8 & 255, i & 255)
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 200000
+    changes = int(argv[2]) if len(argv) > 2 else 100
+
+    start = time.time()
+    previous = IPSet('blocklist', 'hash:net', members=[network(i) for i in range(count)])
+    built = time.time()
+    swap = previous.swap_script()
+    print("%d members: built in %.2fs, swap script of %d bytes in %.2fs" % (
+        count, built - start, len(swap), time.time() - built))
+
+    start = time.time()
+    saved = IPSet.from_save(previous.restore_script())['blocklist']
+    print("parsed saved set in %.2fs" % (time.time() - start))
+
+    current = IPSet('blocklist', 'hash:net', members=[network(i) for i in range(changes // 2, count + changes // 2)])
+    start = time.time()
+    script = current.update_script(previous=saved)
+    print("%d changes: update script of %d lines (%d bytes) in %.2fs" % (
+        changes, script.count('\n'), len(script), time.time() - start))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,51 @@
+"""Measures the time and peak memory of rendering a single broad
+ForwardingRule (sources x destinations x channels rule definitions),
+streaming the lines to a file.
+
+Usage:
+    python benchmarks/lazy_rules.py [sources] [destinations] [channels]
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+from pyptables import COMPACT
+from pyptables.rules.forwarding import ForwardingRule
+from pyptables.rules.forwarding.channels import TCPChannel
+from pyptables.rules.forwarding.locations import Location
+from pyptables.rules.forwarding.zones import Zone
+
+
+def build_rule(source_count, destination_count, channel_count):
+    lan, dmz = Zone('lan', 'eth0'), Zone('dmz', 'eth1')
+    sources = [location for i in range(source_count)
+               for location in Location.from_ip_list('lan %d' % i, lan, '10.%d.%d.0/24' % (i >> 8, i & 255))]
+    destinations = [location for i in range(destination_count)
+                    for location in Location.from_ip_list('dmz %d' % i, dmz, '192.168.%d.%d' % (i >> 8, i & 255))]
+    channels = [TCPChannel(dports=str(8000 + i)) for i in range(channel_count)]
+    return ForwardingRule('ACCEPT', sources, destinations, channels=channels, comment='broad rule')
+
+
+def main(argv):
+    source_count = int(argv[1]) if len(argv) > 1 else 100
+    destination_count = int(argv[2]) if len(argv) > 2 else 100
+    channel_count = int(argv[3]) if len(argv) > 3 else 10
+    rule = build_rule(source_count, destination_count, channel_count)
+
+    with open(os.devnull, 'w') as sink:
+        tracemalloc.start()
+        start = time.time()
+        count = 0
+        for line in rule.iter_iptables(prefix='-A FORWARD', profile=COMPACT):
+            sink.write(line + '\n')
+            count += 1
+        elapsed = time.time() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    print("%d lines in %.2fs, peak memory %.1fMB" % (count, elapsed, peak / 1e6))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,76 @@
+"""Compares a flat PREROUTING chain of DNAT rules with a PortForwardTable,
+by the number of rules a packet is evaluated against (and, with numpy,
+by simulating a packet for every forward).
+
+Usage:
+    python benchmarks/port_forwards.py [forwards] [addresses]
+"""
+
+import sys
+import time
+
+from pyptables import default_tables
+from pyptables.parsing import tokenize, target
+from pyptables.rules.nat import DNAT, PortForwardTable
+
+
+def forwards(count, addresses):
+    for i in range(count):
+        address = '203.0.113.%d' % (i % addresses + 1)
+        port = 1024 + i // addresses
+        yield address, port, '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255 or 1), 80
+
+
+def evaluated(table, name):
+    """Worst case rules evaluated by a packet in a tree of disjoint chains"""
+    targets = [target(tokenize(rule.rule_definitions('minimal')[0]))[0] for rule in table[name]]
+    return len(table[name]) + max([evaluated(table, name) for name in targets if name in table] or [0])
+
+
+def simulate(tables, count, addresses):
+    try:
+        from pyptables.simulator import Simulator, make_packets
+    except ImportError:
+        return
+    forwarded = list(forwards(count, addresses))
+    packets = make_packets(len(forwarded), in_interface='eth0',
+                           dst=[forward[0] for forward in forwarded],
+                           proto='tcp',
+                           dport=[forward[1] for forward in forwarded])
+    start = time.time()
+    Simulator(tables).classify(packets, path=('nat', 'PREROUTING'))
+    return time.time() - start
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 20000
+    addresses = int(argv[2]) if len(argv) > 2 else 4
+
+    flat = default_tables()
+    for address, port, to_address, to_port in forwards(count, addresses):
+        flat['nat']['PREROUTING'].append(DNAT('%s:%d' % (to_address, to_port), i='eth0',
+                                              d=address, p='tcp', dport=str(port)))
+    seconds = simulate(flat, count, addresses)
+    print("flat: %d rules evaluated (worst case)%s" % (
+        len(flat['nat']['PREROUTING']),
+        ', simulated %d packets in %.2fs' % (count, seconds) if seconds is not None else '',
+    ))
+
+    tree = default_tables()
+    table = PortForwardTable('port_fwd', in_interface='eth0')
+    for address, port, to_address, to_port in forwards(count, addresses):
+        table.add(address, port, to_address, to_port)
+    start = time.time()
+    table.install(tree['nat'])
+    built = time.time() - start
+    seconds = simulate(tree, count, addresses)
+    print("tree: %d rules evaluated (worst case), %d chains built in %.2fs%s" % (
+        evaluated(tree['nat'], 'port_fwd') + 1,
+        len(tree['nat']) - 3,
+        built,
+        ', simulated %d packets in %.2fs' % (count, seconds) if seconds is not None else '',
+    ))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
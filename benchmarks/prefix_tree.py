@@ -0,0 +1,68 @@
+"""Compares a flat chain of per-address rules with a PrefixTree, by the
+number of rules a packet is evaluated against before it reaches the rule
+of its entry (worst case, and average over the entries).
+
+Usage:
+    python benchmarks/prefix_tree.py [entries] [bucket_size] [bits]
+"""
+
+import random
+import sys
+import time
+
+from pyptables.parsing import tokenize, target
+from pyptables.rules.prefixtree import PrefixTree
+
+
+def entries(count, seed=0):
+    rand = random.Random(seed)
+    result = {}
+    while len(result) < count:
+        length = rand.choice([20, 24, 28, 32, 32, 32, 32])
+        address = rand.getrandbits(24) >> (32 - length) << (32 - length)
+        cidr = '10.%d.%d.%d/%d' % (address >> 16, address >> 8 & 255, address & 255, length)
+        result[cidr] = rand.choice(['ACCEPT', 'DROP', 'REJECT'])
+    return result
+
+
+def depths(chains):
+    """Returns (worst case, average) rules evaluated to reach a leaf rule of a tree of chains"""
+    by_name = dict((chain.name, chain) for chain in chains)
+
+    def walk(chain):
+        worst, total, leaves = 0, 0, 0
+        for position, rule in enumerate(chain, 1):
+            name = target(tokenize(rule.rule_definitions('minimal')[0]))[0]
+            if name in by_name:
+                child_worst, child_total, child_leaves = walk(by_name[name])
+                worst = max(worst, position + child_worst)
+                total += child_total + position * child_leaves
+                leaves += child_leaves
+            else:
+                worst = max(worst, position)
+                total += position
+                leaves += 1
+        return worst, total, leaves
+    worst, total, leaves = walk(chains[0])
+    return worst, float(total) / leaves
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 100000
+    bucket_size = int(argv[2]) if len(argv) > 2 else 16
+    bits = int(argv[3]) if len(argv) > 3 else 3
+
+    tree = PrefixTree('per_host', entries(count), bucket_size=bucket_size, bits=bits)
+    print("flat: %d rules evaluated (worst case), %.1f on average" % (count, (count + 1) / 2.0))
+
+    start = time.time()
+    chains = tree.chains()
+    built = time.time() - start
+    worst, average = depths(chains)
+    print("tree: %d rules evaluated (worst case), %.1f on average, %d chains, %d rules, built in %.2fs" % (
+        worst + 1, average + 1, len(chains), sum(len(chain) for chain in chains), built,
+    ))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
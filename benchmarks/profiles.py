@@ -0,0 +1,70 @@
+"""Compares the size and restore-parse time of the rendering profiles.
+
+Usage:
+    python benchmarks/profiles.py [rules] [restore command ...]
+
+By default the output is parsed by a stub mimicking the line handling
+of iptables-restore (skip comments, tokenize the rule).  A real command
+can be given instead, e.g.:
+    python benchmarks/profiles.py 50000 iptables-restore --test
+"""
+
+import shlex
+import subprocess
+import sys
+import time
+
+from pyptables import default_tables, UserChain, Jump
+from pyptables.profiles import VERBOSE, COMPACT, MINIMAL
+from pyptables.rules import Accept, Drop
+
+
+def build_tables(count):
+    tables = default_tables()
+    chain = tables['filter'].append(UserChain('hosts', comment='Per-host rules'))
+    for i in range(count):
+        rule = Accept if i % 2 else Drop
+        chain.append(rule(source='10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+                          proto='tcp',
+                          dport=str(1024 + i % 1000),
+                          comment='host %d' % i,
+                          ))
+    tables['filter']['FORWARD'].append(Jump(chain))
+    return tables
+
+
+def stub_restore(payload):
+    """Parses the payload the way iptables-restore tokenizes its input"""
+    rules = 0
+    for line in payload.split('\n'):
+        if not line or line.startswith('#'):
+            continue
+        shlex.split(line)
+        rules += 1
+    return rules
+
+
+def command_restore(command, payload):
+    process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    process.communicate(payload.encode('utf-8'))
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 20000
+    command = argv[2:]
+    tables = build_tables(count)
+    print("%-8s %12s %10s %10s" % ('profile', 'bytes', 'render', 'parse'))
+    for profile in (VERBOSE, COMPACT, MINIMAL):
+        start = time.time()
+        payload = tables.to_iptables(profile=profile)
+        rendered = time.time()
+        if command:
+            command_restore(command, payload)
+        else:
+            stub_restore(payload)
+        parsed = time.time()
+        print("%-8s %12d %9.3fs %9.3fs" % (profile.name, len(payload), rendered - start, parsed - rendered))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,57 @@
+"""Measures the packet classification rate of the Simulator.
+
+Usage:
+    python benchmarks/simulator.py [packets] [rules]
+"""
+
+import sys
+import time
+
+import numpy
+
+from pyptables import default_tables, Rule, UserChain
+from pyptables.simulator import Simulator, make_packets, PROTOCOLS, CTSTATES
+
+
+def build(rule_count):
+    tables = default_tables()
+    forward = tables['filter']['FORWARD']
+    forward.policy = 'DROP'
+    forward.append(Rule(m='conntrack', ctstate='ESTABLISHED,RELATED', j='ACCEPT'))
+    for zone in range(10):
+        chain = tables['filter'].append(UserChain('zone%d' % zone))
+        forward.append(Rule(i='eth%d' % zone, j=chain.name))
+        for i in range(rule_count // 10):
+            chain.append(Rule(p='tcp', d='10.%d.%d.0/24' % (zone, i & 255), m='multiport',
+                              dports='%d,%d' % (1000 + i, 2000 + i), j='ACCEPT'))
+        chain.append(Rule(p='udp', dport='53', j='ACCEPT'))
+    return tables
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 1000000
+    rule_count = int(argv[2]) if len(argv) > 2 else 200
+    random = numpy.random.RandomState(0)
+    packets = make_packets(
+        count,
+        in_interface=numpy.array(['eth%d' % i for i in range(12)])[random.randint(0, 12, count)],
+        src=random.randint(0, 2 ** 32, count, dtype=numpy.uint64).astype(numpy.uint32),
+        dst=(10 << 24) + random.randint(0, 10 << 16, count),
+        proto=numpy.array([PROTOCOLS['tcp'], PROTOCOLS['udp']])[random.randint(0, 2, count)],
+        dport=random.randint(0, 2100, count),
+        ctstate=numpy.array([CTSTATES['NEW'], CTSTATES['ESTABLISHED']])[random.randint(0, 2, count)],
+    )
+
+    start = time.time()
+    simulator = Simulator(build(rule_count))
+    print("compiled %d rules in %.3fs" % (len(simulator.rules), time.time() - start))
+
+    start = time.time()
+    result = simulator.classify(packets)
+    elapsed = time.time() - start
+    print("classified %d packets in %.3fs (%.0f packets/s)" % (count, elapsed, count / elapsed))
+    print(result.counts())
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,52 @@
+"""Compares building and rendering per-tenant chains from Rule objects
+with instantiating a ChainTemplate.
+
+Usage:
+    python benchmarks/templates.py [tenants] [rules]
+"""
+
+import sys
+import time
+
+from pyptables import default_tables, Rule, UserChain, Jump, COMPACT
+from pyptables.templates import ChainTemplate
+
+
+def tenant_rules(chain, rule_count, interface, network):
+    for i in range(rule_count):
+        chain.append(Rule(i=interface, s=network, p='tcp', dport=str(1000 + i), j='ACCEPT',
+                          comment='service %d' % i))
+    return chain
+
+
+def main(argv):
+    tenants = int(argv[1]) if len(argv) > 1 else 5000
+    rule_count = int(argv[2]) if len(argv) > 2 else 200
+
+    start = time.time()
+    tables = default_tables()
+    for tenant in range(tenants):
+        chain = tables['filter'].append(tenant_rules(UserChain('tenant_%d' % tenant), rule_count,
+                                                     'veth%d' % tenant, '10.%d.%d.0/24' % (tenant >> 8, tenant & 255)))
+        tables['filter']['FORWARD'].append(Jump(chain))
+    built = time.time()
+    output = tables.to_iptables(profile=COMPACT)
+    print("objects:  built in %.3fs, rendered %d bytes in %.3fs" % (built - start, len(output), time.time() - built))
+
+    start = time.time()
+    tables = default_tables()
+    template = tenant_rules(ChainTemplate('tenant_${id}'), rule_count, '${interface}', '${network}')
+    for tenant in range(tenants):
+        chain = tables['filter'].append(template.instantiate(id=tenant,
+                                                             interface='veth%d' % tenant,
+                                                             network='10.%d.%d.0/24' % (tenant >> 8, tenant & 255)))
+        tables['filter']['FORWARD'].append(Jump(chain))
+    built = time.time()
+    template_output = tables.to_iptables(profile=COMPACT)
+    print("template: built in %.3fs, rendered %d bytes in %.3fs" % (built - start, len(template_output),
+                                                                    time.time() - built))
+    assert output == template_output
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,50 @@
+"""Times validate() on a large ruleset, against the time taken to render it.
+
+Usage:
+    python benchmarks/validator.py [rules]
+"""
+
+import sys
+import time
+
+from pyptables import default_tables, UserChain, Jump
+from pyptables.rules import Accept, Drop
+from pyptables.rules.forwarding.channels import TCPChannel
+from pyptables.validator import validate
+
+
+def build_tables(count):
+    tables = default_tables()
+    chain = tables['filter'].append(UserChain('hosts', comment='Per-host rules'))
+    for i in range(count):
+        rule = Accept if i % 2 else Drop
+        chain.append(rule(source='10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+                          in_interface='eth%d' % (i % 4),
+                          args=[TCPChannel(dports='80,443,8000:8080', states='NEW')],
+                          comment='host %d, channel tcp, ports any -> 80,443,8000:8080' % i,
+                          ))
+    tables['filter']['FORWARD'].append(Jump(chain))
+    return tables
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 500000
+    tables = build_tables(count)
+
+    start = time.time()
+    payload = tables.to_iptables(profile='compact')
+    rendered = time.time() - start
+
+    start = time.time()
+    errors = validate(payload)
+    validated = time.time() - start
+    print("%d rules: rendered in %.2fs, validated in %.2fs (%.1fus per rule), %d errors" % (
+        count, rendered, validated, validated * 1e6 / count, len(errors)))
+
+    start = time.time()
+    validate(tables, profile='compact')
+    print("render and validate: %.2fs" % (time.time() - start))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -1,10 +1,10 @@
-import re 
-import subprocess
-
 from pyptables.tables import Tables, Table
 from pyptables.chains import BuiltinChain, UserChain
+from pyptables.templates import ChainTemplate
 from pyptables.rules import Rule, Accept, Drop, Jump, Redirect, Return, Log, CustomRule
 from pyptables.rules.matches import Match
+from pyptables.profiles import Profile, VERBOSE, COMPACT, MINIMAL, CANONICAL
+from pyptables.index import LineIndex
 
 
 def default_tables():
@@ -27,6 +27,15 @@ def default_tables():
                         BuiltinChain('OUTPUT', 'ACCEPT'),
                         BuiltinChain('POSTROUTING', 'ACCEPT'),
                         ),
+                  Table('raw',
+                        BuiltinChain('PREROUTING', 'ACCEPT'),
+                        BuiltinChain('OUTPUT', 'ACCEPT'),
+                        ),
+                  Table('security',
+                        BuiltinChain('INPUT', 'ACCEPT'),
+                        BuiltinChain('FORWARD', 'ACCEPT'),
+                        BuiltinChain('OUTPUT', 'ACCEPT'),
+                        ),
                   )
 
 
@@ -73,12 +82,14 @@ def colorize(string):
     return "\n".join(result)
 
 
-strip_ANSI_escape_sequences_sub = re.compile(r"""
-    \x1b     # literal ESC
-    \[       # literal [
-    [;\d]*   # zero or more digits or semicolons
-    [A-Za-z] # a letter
-    """, re.VERBOSE).sub
+def strip_ANSI_escape_sequences_sub(replacement, string):
+    import re
+    return re.sub(r"""
+        \x1b     # literal ESC
+        \[       # literal [
+        [;\d]*   # zero or more digits or semicolons
+        [A-Za-z] # a letter
+        """, replacement, string, flags=re.VERBOSE)
 
 
 def uncolorize(string):
@@ -92,14 +103,42 @@ def add_line_numbers(string, start=1):
     return "\n".join([("%0" + str(len(str(len(lines)))) + "s | %s") % i for i in enumerate(lines, start)])
 
 
-def restore(tables):
+class RestoreOutput(tuple):
+    """The (stdout, stderr) tuple returned by restore(), with the
+    iptables-restore exit code as its returncode attribute
+    """
+    
+    def __new__(cls, stdout, stderr, returncode):
+        result = super(RestoreOutput, cls).__new__(cls, (stdout, stderr))
+        result.returncode = returncode
+        return result
+
+
+def restore(tables, profile=None, index=None, history=None):
+    """Write tables into the kernel with iptables-restore.
+    
+    tables  - a Tables object (or an iptables-restore formatted string)
+    profile - the Profile used to render the tables
+    index   - a LineIndex, which records the rule that generated
+              each line, for use with index.errors(stderr)
+    history - a pyptables.history.History, which records the payload
+              if iptables-restore succeeds
+    
+    Returns a RestoreOutput, a tuple (stdout, stderr) with the exit
+    code of iptables-restore as its returncode attribute
+    """
+    import subprocess
     process = subprocess.Popen(
         ["iptables-restore"],
         stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
     )
+    source = tables
     if hasattr(tables, 'to_iptables'):
-        tables = tables.to_iptables()
+        tables = tables.to_iptables(profile=profile, index=index)
     tables = tables.encode('utf-8')
-    return process.communicate(tables)
+    stdout, stderr = process.communicate(tables)
+    if history is not None and process.returncode == 0:
+        history.record(tables, tables=source if hasattr(source, 'to_iptables') else None, profile=profile)
+    return RestoreOutput(stdout, stderr, process.returncode)
@@ -1,9 +1,47 @@
-from pyptables import default_tables, CustomRule, Jump, UserChain, colorize, add_line_numbers
-
 import sys
 
+from pyptables import default_tables, CustomRule, Jump, UserChain, colorize, add_line_numbers, restore
+
 if '--colorize' in sys.argv:
     output = colorize(sys.stdin.read())
+elif '--snapshot' in sys.argv:
+    # render (or --apply) a snapshot saved with pyptables.snapshot.save_snapshot()
+    from pyptables.snapshot import load_snapshot
+    path = sys.argv[sys.argv.index('--snapshot') + 1]
+    snapshot = load_snapshot(path)
+    if snapshot is None:
+        sys.exit("%s: no such snapshot" % path)
+    output = snapshot.to_iptables()
+    if '--apply' in sys.argv:
+        result = restore(output)
+        sys.stderr.write(result[1].decode('utf-8'))
+        sys.exit(result.returncode)
+elif '--history' in sys.argv:
+    # list, --show or --rollback the rulesets recorded by restore(tables, history=History(path))
+    import time
+    from pyptables.history import History
+    history = History(sys.argv[sys.argv.index('--history') + 1])
+
+    def ref(option, default):
+        i = sys.argv.index(option) + 1
+        return sys.argv[i] if i < len(sys.argv) and not sys.argv[i].startswith('--') else default
+    try:
+        if '--rollback' in sys.argv:
+            entry, stdout, stderr = history.rollback(ref('--rollback', 1))
+            sys.stderr.write(stderr.decode('utf-8'))
+            output = "rolled back to %s" % entry.fingerprint
+        elif '--show' in sys.argv:
+            output = history.payload(ref('--show', 0))
+        else:
+            output = "\n".join("%3d %s %s %8d %s" % (
+                i,
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry.time)),
+                entry.fingerprint[:12],
+                entry.size,
+                entry.comment or entry.source or '',
+            ) for i, entry in enumerate(history.entries()))
+    except (KeyError, RuntimeError) as e:
+        sys.exit(str(e))
 else:
     tables = default_tables()
     
@@ -0,0 +1,130 @@
+"""This module contains asyncio versions of the restore functions."""
+
+import asyncio
+from collections import namedtuple
+
+from pyptables.index import LineIndex, parse_errors
+from pyptables.profiles import get_profile
+
+
+RestoreResult = namedtuple('RestoreResult', 'returncode stdout stderr errors rolled_back index')
+RestoreResult.__doc__ = """The result of restore_async()
+
+returncode  - the iptables-restore exit code
+stdout      - the iptables-restore output
+stderr      - the iptables-restore error output
+errors      - list of RestoreFailure parsed from stderr
+rolled_back - True if the previous ruleset was restored
+index       - the LineIndex of the generated output
+"""
+
+
+async def _write(process, chunk):
+    try:
+        process.stdin.write(chunk.encode('utf-8'))
+        await process.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        return False
+    return True
+
+
+async def _stream(process, tables, profile, chunk_size, index):
+    """Write the tables to the process, as they are rendered"""
+    # read the output while writing, so the process can't block on a full
+    # stdout/stderr pipe while we are blocked on a full stdin pipe
+    readers = asyncio.gather(process.stdout.read(), process.stderr.read())
+    try:
+        if isinstance(tables, str):
+            await _write(process, tables)
+        else:
+            chunk, size = [], 0
+            for line in index.record(tables.iter_iptables(profile=profile)):
+                chunk.append(line)
+                size += len(line) + 1
+                if size >= chunk_size:
+                    chunk.append('')
+                    if not await _write(process, "\n".join(chunk)):
+                        break
+                    chunk, size = [], 0
+            else:
+                chunk.append('')
+                await _write(process, "\n".join(chunk))
+        process.stdin.close()
+        stdout, stderr = await readers
+    except BaseException:
+        readers.cancel()
+        raise
+    await process.wait()
+    return stdout, stderr
+
+
+async def _run(command, payload=None):
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await process.communicate(payload)
+    return process.returncode, stdout, stderr
+
+
+async def _rollback(command, saved):
+    returncode, __, stderr = await _run(command, saved)
+    if returncode:
+        raise RuntimeError('rollback failed: %s' % stderr.decode('utf-8', 'replace'))
+
+
+async def restore_async(tables, command=('iptables-restore',), profile=None, timeout=None,
+                        rollback=False, save_command=('iptables-save',), chunk_size=65536):
+    """Write tables into the kernel without blocking the event loop.
+
+    tables       - a Tables object (or an iptables-restore formatted string)
+    command      - the iptables-restore command
+    profile      - the Profile used to render the tables
+    timeout      - seconds to wait for iptables-restore, after which it is
+                   killed and asyncio.TimeoutError is raised
+    rollback     - if true, the current ruleset is saved (with save_command)
+                   first, and restored if the restore fails, times out or
+                   is cancelled (iptables-restore commits each table
+                   separately, so a failure can leave a partial ruleset)
+    save_command - the iptables-save command
+    chunk_size   - number of bytes to render before writing to iptables-restore
+
+    Returns a RestoreResult, with any errors mapped back to the Rule
+    objects that generated the failing lines.
+    """
+    profile = get_profile(profile)
+    saved = None
+    if rollback:
+        returncode, saved, stderr = await _run(save_command)
+        if returncode:
+            raise RuntimeError('unable to save current ruleset: %s' % stderr.decode('utf-8', 'replace'))
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    index = LineIndex()
+    try:
+        stdout, stderr = await asyncio.wait_for(_stream(process, tables, profile, chunk_size, index), timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        if saved is not None:
+            await asyncio.shield(_rollback(command, saved))
+        raise
+    stderr = stderr.decode('utf-8', 'replace')
+    rolled_back = False
+    if process.returncode and saved is not None:
+        await asyncio.shield(_rollback(command, saved))
+        rolled_back = True
+    return RestoreResult(returncode=process.returncode,
+                         stdout=stdout.decode('utf-8', 'replace'),
+                         stderr=stderr,
+                         errors=parse_errors(stderr, index),
+                         rolled_back=rolled_back,
+                         index=index,
+                         )
@@ -1,4 +1,35 @@
-import inspect
+import sys
+import threading
+from contextlib import contextmanager
+
+
+_override = threading.local()
+
+
+@contextmanager
+def debug_source(filename, lineno=0, function='<module>'):
+    """Context manager overriding the debug info of DebugObjects created
+    within it, skipping the stack inspection.
+
+    Useful when creating large numbers of objects from an external
+    source (e.g. a CSV file), where the python source line is not
+    meaningful:
+
+    with debug_source('hosts.csv', 12):
+        Location(...)
+    """
+    previous = getattr(_override, 'info', None)
+    _override.info = (filename, lineno, function)
+    try:
+        yield
+    finally:
+        _override.info = previous
+
+
+def set_debug_line(lineno):
+    """Update the line number used by the enclosing debug_source()"""
+    filename, __, function = _override.info
+    _override.info = (filename, lineno, function)
 
 
 class DebugObject(object):
@@ -8,14 +39,16 @@ class DebugObject(object):
     """
     def __init__(self, *args, **kwargs):
         super(DebugObject, self).__init__(*args, **kwargs)
-        frame = inspect.currentframe().f_back
-        while frame:
-            info = inspect.getframeinfo(frame)
-            if not info[2].startswith('__'):
-                break
-            frame = frame.f_back
-        self.filename, self.lineno, self.function, __, __ = info
-    
+        info = getattr(_override, 'info', None)
+        if info is None:
+            frame = sys._getframe(1)
+            while frame:
+                info = (frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+                if not info[2].startswith('__'):
+                    break
+                frame = frame.f_back
+        self.filename, self.lineno, self.function = info
+
     def debug_info(self):
         """Returns a string of debug info about the creation of this object"""
         return "%s:%s %s" % (self.filename, self.lineno, self.function)
@@ -0,0 +1,601 @@
+"""This module contains the iptables-save canonicalizer.
+
+   iptables-save doesn't list rules the way they were written: it adds
+   the match modules loaded implicitly (-m tcp), writes addresses as
+   networks (1.2.3.4/32), lists the options of each rule in a fixed
+   order, fills in default option values, and quotes values its own way.
+   normalize() rewrites a rule definition into the form iptables-save
+   lists it in, so that generated rules can be compared with the rules
+   in the kernel line for line:
+
+   >>> normalize('-A INPUT -p tcp -s 1.2.3.4 -j ACCEPT --dport 22')
+   ['-A INPUT -s 1.2.3.4/32 -p tcp -m tcp --dport 22 -j ACCEPT']
+
+   A definition with comma separated addresses is listed as one rule
+   for each combination of source and destination, as iptables creates
+   them.  Rendering with the "canonical" profile normalizes every rule:
+
+   tables.to_iptables(profile='canonical')
+
+   and render_save() reads iptables-save output into the structure of
+   render_chains() (see pyptables.service), so that delta_payload() only
+   rewrites the chains which differ from the rules in the kernel:
+
+   payload = delta_payload(render_save(saved, normalized=True), render_chains(tables, 'canonical'))
+
+   The form is that of iptables-save (legacy) 1.8.  Names are not
+   resolved, except service names (with the services database), host
+   names are left as they are.  Options of matches and targets PyPTables
+   doesn't know (see pyptables.validator) are listed as written.
+"""
+
+import binascii
+import re
+import socket
+import string
+from collections import OrderedDict
+
+from pyptables.parsing import tokenize
+from pyptables.validator import CORE_OPTIONS, MATCHES, TARGETS, IMPLICIT_MATCHES
+
+
+# the long names of options, mapped to the names iptables-save lists
+ALIASES = {
+    '--source-port': '--sport', '--destination-port': '--dport',
+    '--source-ports': '--sports', '--destination-ports': '--dports',
+    '--hashlimit': '--hashlimit-upto',
+}
+
+# the order iptables-save lists the options of a match or target in
+# (options not listed follow, in the order they were written)
+SAVE_ORDER = {
+    'tcp': ('--sport', '--dport', '--tcp-option', '--tcp-flags'),
+    'udp': ('--sport', '--dport'),
+    'multiport': ('--sports', '--dports', '--ports'),
+    'conntrack': ('--ctstate', '--ctproto', '--ctorigsrc', '--ctorigdst', '--ctreplsrc', '--ctrepldst',
+                  '--ctorigsrcport', '--ctorigdstport', '--ctreplsrcport', '--ctrepldstport', '--ctstatus',
+                  '--ctexpire', '--ctdir'),
+    'iprange': ('--src-range', '--dst-range'),
+    'addrtype': ('--src-type', '--dst-type', '--limit-iface-in', '--limit-iface-out'),
+    'physdev': ('--physdev-is-in', '--physdev-in', '--physdev-is-out', '--physdev-out', '--physdev-is-bridged'),
+    'limit': ('--limit', '--limit-burst'),
+    'hashlimit': ('--hashlimit-upto', '--hashlimit-above', '--hashlimit-burst', '--hashlimit-mode',
+                  '--hashlimit-srcmask', '--hashlimit-dstmask', '--hashlimit-name', '--hashlimit-htable-size',
+                  '--hashlimit-htable-max', '--hashlimit-htable-gcinterval', '--hashlimit-htable-expire'),
+    'connlimit': ('--connlimit-upto', '--connlimit-above', '--connlimit-mask', '--connlimit-saddr',
+                  '--connlimit-daddr'),
+    'LOG': ('--log-prefix', '--log-level', '--log-tcp-sequence', '--log-tcp-options', '--log-ip-options',
+            '--log-uid', '--log-macdecode'),
+    'NFLOG': ('--nflog-prefix', '--nflog-group', '--nflog-range', '--nflog-size', '--nflog-threshold'),
+    'DNAT': ('--to-destination', '--random', '--persistent'),
+    'SNAT': ('--to-source', '--random', '--random-fully', '--persistent'),
+    'CONNMARK': ('--set-xmark', '--save-mark', '--restore-mark', '--nfmask', '--ctmask'),
+}
+
+# options whose values iptables-save quotes when they aren't plain words
+STRING_OPTIONS = frozenset(['--comment', '--log-prefix', '--nflog-prefix'])
+
+# protocol numbers, mapped to the names iptables-save lists
+PROTOCOLS = {
+    '1': 'icmp', '2': 'igmp', '6': 'tcp', '17': 'udp', '47': 'gre', '50': 'esp', '51': 'ah',
+    '58': 'ipv6-icmp', '132': 'sctp', '136': 'udplite', 'icmpv6': 'ipv6-icmp',
+}
+
+CTSTATES = ('INVALID', 'NEW', 'RELATED', 'ESTABLISHED', 'UNTRACKED', 'SNAT', 'DNAT')
+
+# ICMP type names, mapped to type[/code]
+ICMP_TYPES = {
+    'echo-reply': '0', 'destination-unreachable': '3', 'network-unreachable': '3/0', 'host-unreachable': '3/1',
+    'protocol-unreachable': '3/2', 'port-unreachable': '3/3', 'fragmentation-needed': '3/4',
+    'source-route-failed': '3/5', 'network-unknown': '3/6', 'host-unknown': '3/7', 'network-prohibited': '3/9',
+    'host-prohibited': '3/10', 'TOS-network-unreachable': '3/11', 'TOS-host-unreachable': '3/12',
+    'communication-prohibited': '3/13', 'host-precedence-violation': '3/14', 'precedence-cutoff': '3/15',
+    'source-quench': '4', 'redirect': '5', 'network-redirect': '5/0', 'host-redirect': '5/1',
+    'TOS-network-redirect': '5/2', 'TOS-host-redirect': '5/3', 'echo-request': '8', 'router-advertisement': '9',
+    'router-solicitation': '10', 'time-exceeded': '11', 'ttl-zero-during-transit': '11/0',
+    'ttl-zero-during-reassembly': '11/1', 'parameter-problem': '12', 'ip-header-bad': '12/0',
+    'required-option-missing': '12/1', 'timestamp-request': '13', 'timestamp-reply': '14',
+    'address-mask-request': '17', 'address-mask-reply': '18',
+}
+
+LOG_LEVELS = {'emerg': '0', 'alert': '1', 'crit': '2', 'error': '3', 'err': '3', 'warning': '4', 'warn': '4',
+              'notice': '5', 'info': '6', 'debug': '7', 'panic': '0'}
+
+# limit rates are stored as the period between packets, in 1/10000s of a second
+_LIMIT_SCALE = 10000
+_LIMIT_UNITS = (('day', 86400), ('hour', 3600), ('min', 60), ('sec', 1))
+
+_MASK = 0xffffffff
+_PLAIN = string.ascii_letters + string.digits + '_-'
+_SAVE_ESCAPE = re.compile(r'(["\\\'])')
+_ESCAPE = re.compile(r'(["\\])')
+_IPV4 = re.compile(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$')
+
+_CACHE_SIZE = 65536
+_cache = {}
+
+
+def save_string(value):
+    """Returns value (a comment, log prefix, etc.) quoted as iptables-save
+    quotes it: plain words as they are, anything else in double quotes"""
+    if value and not value.strip(_PLAIN):
+        return value
+    return '"%s"' % _SAVE_ESCAPE.sub(r'\\\1', value)
+
+
+def _quote(value):
+    if value and not any(c.isspace() or c in '"\\' for c in value):
+        return value
+    return '"%s"' % _ESCAPE.sub(r'\\\1', value)
+
+
+def _address(value):
+    """Returns an address or network as iptables-save lists it
+    (a.b.c.d/len, with the host bits cleared), host names unchanged"""
+    address, _, mask = value.partition('/')
+    if _IPV4.match(address):
+        family, bits = socket.AF_INET, 32
+    elif ':' in address:
+        family, bits = socket.AF_INET6, 128
+    else:
+        return value
+    try:
+        number = int(binascii.hexlify(socket.inet_pton(family, address)), 16)
+    except (socket.error, ValueError):
+        return value
+    if not mask:
+        length = bits
+    elif mask.isdigit():
+        length = int(mask)
+    elif family == socket.AF_INET and _IPV4.match(mask):
+        netmask = int(binascii.hexlify(socket.inet_aton(mask)), 16)
+        length = bin(netmask).count('1')
+        if netmask != (_MASK << (32 - length)) & _MASK:  # not contiguous, listed as a netmask
+            return '%s/%s' % (socket.inet_ntop(family, _pack(number & netmask, bits)), mask)
+    else:
+        return value
+    if length > bits:
+        return value
+    number &= ((1 << bits) - 1) ^ ((1 << (bits - length)) - 1)
+    return '%s/%d' % (socket.inet_ntop(family, _pack(number, bits)), length)
+
+
+def _pack(number, bits):
+    return binascii.unhexlify('%0*x' % (bits // 4, number))
+
+
+def _port(value, protocol):
+    if value.isdigit():
+        return str(int(value))
+    try:
+        return str(socket.getservbyname(value, protocol or 'tcp'))
+    except (socket.error, OverflowError):
+        return value
+
+
+def _port_range(value, protocol):
+    """Returns a port or port range as listed by iptables-save, or None
+    for the full range (which isn't listed)"""
+    if ':' not in value:
+        return _port(value, protocol)
+    low, _, high = value.partition(':')
+    low = _port(low, protocol) if low else '0'
+    high = _port(high, protocol) if high else '65535'
+    if (low, high) == ('0', '65535'):
+        return None
+    return low if low == high else '%s:%s' % (low, high)
+
+
+def _ports(value, protocol):
+    return ",".join([_port_range(port, protocol) or '0:65535' for port in value.split(',')])
+
+
+def _number(value):
+    try:
+        return int(value, 0)
+    except ValueError:
+        return None
+
+
+def _mark(value, mask=_MASK):
+    """Returns (mark, mask) of a mark[/mask] value, or None"""
+    mark, _, given = value.partition('/')
+    mark = _number(mark)
+    if given:
+        mask = _number(given)
+    if mark is None or mask is None:
+        return None
+    return mark, mask
+
+
+def _rate(value):
+    """Returns a limit rate as iptables-save lists it (in the largest unit
+    the rate is a whole number of)"""
+    number, _, unit = value.partition('/')
+    multiplier = 1
+    if unit:
+        for name, seconds in _LIMIT_UNITS:
+            if name.startswith(unit.lower()[:1]):
+                multiplier = seconds
+                break
+        else:
+            return value
+    if not number.isdigit() or not int(number):
+        return value
+    period = _LIMIT_SCALE * multiplier // int(number)
+    if not period:
+        return value
+    scaled = [(name, _LIMIT_SCALE * seconds) for name, seconds in _LIMIT_UNITS]
+    i = 1
+    while i < len(scaled) and not (period > scaled[i][1] or scaled[i][1] // period < scaled[i][1] % period):
+        i += 1
+    return '%d/%s' % (scaled[i - 1][1] // period, scaled[i - 1][0])
+
+
+class _Extension(object):
+    """A match or target of a rule being normalized"""
+
+    def __init__(self, name, target=False, goto=False):
+        self.name = name
+        self.target = target
+        self.goto = goto
+        self.known = (TARGETS if target else MATCHES).get(name, {})
+        self.options = OrderedDict()  # option -> (inverse, values)
+
+    def save(self, protocol, ipv6):
+        """Returns the words of the extension as iptables-save lists them"""
+        options = self.options
+        fixup = _FIXUPS.get(self.name)
+        if fixup is not None and all(len(values) >= _arity(self.known.get(option, 0))[0]
+                                     for option, (__, values) in options.items()):
+            options = fixup(OrderedDict(options), protocol, ipv6)
+        order = SAVE_ORDER.get(self.name, ())
+        ordered = [option for option in order if option in options]
+        ordered.extend([option for option in options if option not in order])
+        words = ['-g' if self.goto else '-j' if self.target else '-m', self.name]
+        for option in ordered:
+            inverse, values = options[option]
+            if inverse:
+                words.append('!')
+            words.append(option)
+            if option in STRING_OPTIONS:
+                words.extend([save_string(value) for value in values])
+            else:
+                words.extend([_quote(value) for value in values])
+        return words
+
+
+def _fix_ports(options, protocol, ipv6):
+    for option in ('--sport', '--dport'):
+        if option in options:
+            inverse, values = options[option]
+            port = _port_range(values[0], protocol)
+            if port is None and not inverse:
+                del options[option]
+            else:
+                options[option] = (inverse, [port or '0:65535'])
+    return options
+
+
+def _fix_tcp(options, protocol, ipv6):
+    if '--syn' in options:
+        inverse, __ = options.pop('--syn')
+        options['--tcp-flags'] = (inverse, ['FIN,SYN,RST,ACK', 'SYN'])
+    if '--tcp-flags' in options:
+        inverse, values = options['--tcp-flags']
+        options['--tcp-flags'] = (inverse, [_tcp_flags(value) for value in values])
+    return _fix_ports(options, 'tcp', ipv6)
+
+
+_TCP_FLAGS = ('FIN', 'SYN', 'RST', 'PSH', 'ACK', 'URG')
+
+
+def _tcp_flags(value):
+    flags = set(value.upper().split(','))
+    if 'ALL' in flags:
+        flags.update(_TCP_FLAGS)
+    listed = [flag for flag in _TCP_FLAGS if flag in flags]
+    return ",".join(listed) if listed else 'NONE'
+
+
+def _fix_udp(options, protocol, ipv6):
+    return _fix_ports(options, 'udp', ipv6)
+
+
+def _fix_multiport(options, protocol, ipv6):
+    for option, (inverse, values) in list(options.items()):
+        if option in ('--sports', '--dports', '--ports'):
+            options[option] = (inverse, [_ports(values[0], protocol)])
+    return options
+
+
+def _fix_icmp(options, protocol, ipv6):
+    if '--icmp-type' in options:
+        inverse, values = options['--icmp-type']
+        options['--icmp-type'] = (inverse, [ICMP_TYPES.get(values[0], values[0])])
+    return options
+
+
+def _fix_states(option):
+    def fix(options, protocol, ipv6):
+        if option in options:
+            inverse, values = options[option]
+            states = set(values[0].upper().split(','))
+            listed = [state for state in CTSTATES if state in states]
+            listed.extend(sorted(states.difference(CTSTATES)))
+            options[option] = (inverse, [",".join(listed)])
+        return options
+    return fix
+
+
+def _fix_mark(options, protocol, ipv6):
+    if '--mark' in options:
+        inverse, values = options['--mark']
+        mark = _mark(values[0])
+        if mark is not None:
+            value = '0x%x' % mark[0] if mark[1] == _MASK else '0x%x/0x%x' % mark
+            options['--mark'] = (inverse, [value])
+    return options
+
+
+def _fix_limit(options, protocol, ipv6):
+    inverse, values = options.get('--limit', (False, ['3/hour']))
+    options['--limit'] = (inverse, [_rate(values[0])])
+    if options.get('--limit-burst', (False, ['5']))[1] == ['5']:
+        options.pop('--limit-burst', None)
+    return options
+
+
+def _fix_connlimit(options, protocol, ipv6):
+    options.setdefault('--connlimit-mask', (False, ['128' if ipv6 else '32']))
+    if '--connlimit-daddr' not in options:
+        options.setdefault('--connlimit-saddr', (False, []))
+    return options
+
+
+def _fix_reject(options, protocol, ipv6):
+    inverse, values = options.get('--reject-with', (False, ['icmp6-port-unreachable' if ipv6
+                                                            else 'icmp-port-unreachable']))
+    options['--reject-with'] = (inverse, ['tcp-reset' if values[0] == 'tcp-rst' else values[0]])
+    return options
+
+
+def _fix_log(options, protocol, ipv6):
+    if '--log-level' in options:
+        inverse, values = options['--log-level']
+        level = LOG_LEVELS.get(values[0].lower(), values[0])
+        if level == '4':
+            del options['--log-level']
+        else:
+            options['--log-level'] = (inverse, [level])
+    return options
+
+
+def _fix_nflog(options, protocol, ipv6):
+    if options.get('--nflog-group', (False, []))[1] == ['0']:
+        del options['--nflog-group']
+    if options.get('--nflog-threshold', (False, []))[1] == ['1']:
+        del options['--nflog-threshold']
+    return options
+
+
+def _xmark(option, values):
+    """Returns the (mark, mask) of --set-xmark equivalent to a MARK/CONNMARK option, or None"""
+    mark = _mark(values[0])
+    if mark is None:
+        return None
+    value, mask = mark
+    if option == '--set-mark':
+        return value, (value | mask) & _MASK
+    if option == '--and-mark':
+        return 0, ~value & _MASK
+    if option == '--or-mark':
+        return value, value
+    if option == '--xor-mark':
+        return value, 0
+    return mark
+
+
+def _fix_xmark(options):
+    for option in ('--set-mark', '--set-xmark', '--and-mark', '--or-mark', '--xor-mark'):
+        if option in options:
+            inverse, values = options.pop(option)
+            xmark = _xmark(option, values)
+            options['--set-xmark'] = (inverse, ['0x%x/0x%x' % xmark] if xmark else values)
+    return options
+
+
+def _fix_mark_target(options, protocol, ipv6):
+    return _fix_xmark(options)
+
+
+def _fix_connmark_target(options, protocol, ipv6):
+    options = _fix_xmark(options)
+    if '--save-mark' in options or '--restore-mark' in options:
+        mask = options.pop('--mask', None)
+        for option in ('--nfmask', '--ctmask'):
+            inverse, values = options.get(option, mask or (False, ['0xffffffff']))
+            number = _number(values[0])
+            options[option] = (inverse, ['0x%x' % number] if number is not None else values)
+    return options
+
+
+_FIXUPS = {
+    'tcp': _fix_tcp,
+    'udp': _fix_udp,
+    'multiport': _fix_multiport,
+    'icmp': _fix_icmp,
+    'conntrack': _fix_states('--ctstate'),
+    'state': _fix_states('--state'),
+    'mark': _fix_mark,
+    'connmark': _fix_mark,
+    'limit': _fix_limit,
+    'connlimit': _fix_connlimit,
+    'REJECT': _fix_reject,
+    'LOG': _fix_log,
+    'NFLOG': _fix_nflog,
+    'MARK': _fix_mark_target,
+    'CONNMARK': _fix_connmark_target,
+}
+
+
+def _arity(spec):
+    return spec if isinstance(spec, tuple) else (spec, spec)
+
+
+def _is_option(token):
+    return token.startswith('-') and len(token) > 1 and not token[1].isdigit()
+
+
+def _normalize(line):
+    tokens = tokenize(line)
+    if tokens and tokens[0].startswith('[') and tokens[0].endswith(']'):
+        tokens = tokens[1:]  # iptables-save -c counters
+    core = {}
+    extensions = []
+    loose = []  # options before any match or target
+    implicit = None
+    i = 0
+    inverse = False
+    while i < len(tokens):
+        option = tokens[i]
+        i += 1
+        if option == '!':
+            inverse = True
+            continue
+        spec = CORE_OPTIONS.get(option)
+        extension = None
+        if spec is not None:
+            option, arity = spec
+        else:
+            option = ALIASES.get(option, option)
+            for extension in reversed(extensions):
+                if option in extension.known:
+                    break
+            else:
+                protocol = "".join(core.get('-p', (False, []))[1]).lower()
+                if protocol in IMPLICIT_MATCHES and option in MATCHES[protocol] and implicit is None:
+                    extension = implicit = _Extension(protocol)
+                    extensions.append(implicit)
+                elif extensions:
+                    extension = extensions[-1]  # an option PyPTables doesn't know, of the latest extension
+            arity = extension.known.get(option) if extension is not None else None
+        low, high = _arity(arity) if arity is not None else (0, len(tokens))
+        if i < len(tokens) and tokens[i] == '!' and high:  # "--option ! value", as older versions wrote it
+            inverse = not inverse
+            i += 1
+        values = []
+        while i < len(tokens) and len(values) < high and (len(values) < low or not _is_option(tokens[i])):
+            values.append(tokens[i])
+            i += 1
+        if spec is None:
+            if extension is not None:
+                extension.options[option] = (inverse, values)
+            else:
+                loose.append((inverse, option, values))
+        elif option == '-m' and values:
+            extensions.append(_Extension(values[0]))
+        elif option in ('-j', '-g') and values:
+            extensions.append(_Extension(values[0], target=True, goto=option == '-g'))
+        elif option in ('-A', '-I') and values:
+            core['-A'] = (False, values[:1])
+        elif option != '-c':
+            core[option] = (inverse, values)
+        inverse = False
+    return _save(core, extensions, loose)
+
+
+def _save(core, extensions, loose):
+    """Returns the lines iptables-save lists the rule (parsed by _normalize()) as"""
+    sources = [(core['-s'][0], _address(address)) for address in core['-s'][1][0].split(',')] \
+        if core.get('-s', (False, []))[1] else [None]
+    destinations = [(core['-d'][0], _address(address)) for address in core['-d'][1][0].split(',')] \
+        if core.get('-d', (False, []))[1] else [None]
+    ipv6 = any(address is not None and ':' in address[1] for address in sources + destinations)
+    head = ['-A', core['-A'][1][0]] if '-A' in core else []
+    tail = []
+    for option in ('-i', '-o'):
+        if core.get(option, (False, []))[1]:
+            tail.extend((['!'] if core[option][0] else []) + [option, _quote(core[option][1][0])])
+    protocol = None
+    if core.get('-p', (False, []))[1]:
+        inverse, values = core['-p']
+        protocol = values[0].lower()
+        protocol = PROTOCOLS.get(protocol, protocol)
+        if protocol not in ('all', '0') or inverse:
+            tail.extend((['!'] if inverse else []) + ['-p', protocol])
+    if '-f' in core:
+        tail.extend((['!'] if core['-f'][0] else []) + ['-f'])
+    for inverse, option, values in loose:
+        tail.extend((['!'] if inverse else []) + [option] + [_quote(value) for value in values])
+    # the matches, in the order they were loaded, and the target last
+    for extension in sorted(extensions, key=lambda extension: extension.target):
+        tail.extend(extension.save(protocol, ipv6))
+    lines = []
+    for source in sources:
+        for destination in destinations:
+            words = list(head)
+            for option, address in (('-s', source), ('-d', destination)):
+                if address is not None and (address[0] or address[1] not in ('0.0.0.0/0', '::/0')):
+                    words.extend((['!'] if address[0] else []) + [option, address[1]])
+            words.extend(tail)
+            lines.append(" ".join(words))
+    return lines
+
+
+def normalize(line):
+    """Returns the list of the rules (one for each kernel rule) a rule
+    definition (with or without the leading "-A CHAIN", or counters) is
+    listed as by iptables-save, see module documentation
+    """
+    lines = _cache.get(line)
+    if lines is None:
+        lines = _normalize(line)
+        if len(_cache) >= _CACHE_SIZE:
+            _cache.clear()
+        _cache[line] = lines
+    return list(lines)
+
+
+def iter_normalized(lines):
+    """Yield the normalized rules of each of lines (see normalize())"""
+    for line in lines:
+        for rule in normalize(line):
+            yield rule
+
+
+def render_save(output, normalized=False):
+    """Returns the tables of the output of iptables-save (or an
+    iptables-restore payload) in the structure of render_chains() (see
+    pyptables.service), with the rules normalized and the counters
+    zeroed, to compare with (or compute a delta_payload() from) tables
+    rendered with the "canonical" profile
+
+    normalized - if true, the rules are known to be in canonical form
+                 (e.g. the output of iptables-save) and are used as they
+                 are, which is much faster
+    """
+    tables = []
+    chains = None
+    for line in output.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#') or line == 'COMMIT':
+            continue
+        if line.startswith('*'):
+            chains = OrderedDict()
+            tables.append((line[1:], chains))
+        elif line.startswith(':'):
+            name, policy = line[1:].split()[:2]
+            chains[name] = (':%s %s [0:0]' % (name, policy), [])
+        else:
+            if normalized:
+                rules = [line.split('] ', 1)[1] if line.startswith('[') else line]
+            else:
+                rules = normalize(line)
+            for rule in rules:
+                name = rule.split(' ', 2)[1]
+                if name not in chains:
+                    chains[name] = (':%s - [0:0]' % name, [])
+                chains[name][1].append(rule)
+    return [(table, [(name, definition, "\n".join(rules)) for name, (definition, rules) in chains.items()])
+            for table, chains in tables]
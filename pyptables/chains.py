@@ -1,7 +1,7 @@
-import re
 from collections import namedtuple
 
 from pyptables.base import DebugObject
+from pyptables.profiles import get_profile
 
 
 class AbstractChain(DebugObject, list):
@@ -13,21 +13,31 @@ class AbstractChain(DebugObject, list):
         self.comment = comment
         self.name = name
     
-    def to_iptables(self):
+    def to_iptables(self, profile=None):
         """Returns this chain in a format compatible with iptables-restore"""
+        return AbstractChain.Result(header_content=self._chain_definition(),
+                                    rules="\n".join([line for line, __ in self.iter_iptables(profile=profile)]),
+                                    )
+    
+    def iter_iptables(self, profile=None):
+        """Yield (line, rule) tuples for the rules of this chain in iptables format,
+        as they are generated.  rule is None for lines not generated by a rule.
+        
+        Note: the chain definition is not included, see _chain_definition()
+        """
         try:
+            profile = get_profile(profile)
+            if profile.headers:
+                for line in self._comment().split('\n'):
+                    yield line, None
             prefix = '-A %s' % (self.name,)
-            if self:
-                rule_output = [rule.to_iptables(prefix=prefix) for rule in self]
-                rule_output = "\n".join(rule_output)
-            else:
-                rule_output = '# No rules'
-            return AbstractChain.Result(header_content=self._chain_definition(),
-                                        rules="%(comment)s\n%(rules)s" % {
-                                              'comment': self._comment(),
-                                              'rules': rule_output,
-                                              },
-                                        )
+            empty = True
+            for rule in self:
+                for line in rule.iter_iptables(prefix=prefix, profile=profile):
+                    empty = False
+                    yield line, rule
+            if empty and profile.headers:
+                yield '# No rules', None
         except Exception as e:  # pragma: no cover
             e.iptables_path = getattr(e, 'iptables_path', [])
             e.iptables_path.insert(0, self.name)
@@ -51,6 +61,7 @@ class AbstractChain(DebugObject, list):
         return comment
     
     def _type_name(self):
+        import re
         return " ".join(re.findall(r'[A-Z][^A-Z]*', self.__class__.__name__))
     
     def __repr__(self):
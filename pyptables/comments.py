@@ -0,0 +1,144 @@
+"""This module contains the CommentIndex profile.
+
+   Rule comments generated by ForwardingRule and InputRule describe
+   every route, channel and argument of the rule, and can be long: they
+   are copied into every kernel rule, making the payload, kernel memory
+   and iptables-save time grow, and are rejected by the kernel if longer
+   than 255 bytes.
+
+   A CommentIndex is a Profile which attaches a short ID to each rule
+   in the kernel, rather than its comment, and records the comment and
+   where the rule was created (its debug info) in an index, which is
+   saved alongside the output:
+
+   index = CommentIndex()
+   output = tables.to_iptables(profile=index)
+   index.save('rules.v4.comments.json')
+
+   and used to look up the rules found in the kernel later:
+
+   index = CommentIndex.load('rules.v4.comments.json')
+   print(index['3fa2c91e0b7d'].comment)
+   print(index.expand(line_from_iptables_save))
+
+   The ID of a rule is a hash of its comment, so it doesn't change when
+   other rules are added, removed or reordered.  Rules with the same
+   comment share an ID (their debug info is recorded together), rules
+   without a comment have no ID.
+"""
+
+import hashlib
+import json
+import re
+from collections import namedtuple, OrderedDict
+
+from pyptables.profiles import Profile
+from pyptables.util import write_atomic
+
+
+CommentEntry = namedtuple('CommentEntry', 'comment sources')
+CommentEntry.__doc__ = """A comment recorded in a CommentIndex
+
+comment - the full comment
+sources - list of the debug info of the rules with the comment
+"""
+
+_KERNEL_COMMENT = re.compile(r'(--comment\s+)(\S+)')
+
+
+class CommentIndex(Profile):
+    """A Profile attaching a short stable ID, rather than the comment, to
+    each rule in the kernel, see module documentation"""
+
+    records_comments = True
+
+    def __init__(self, name='indexed', headers=False, prefix='', digits=12):
+        """Creates a CommentIndex
+
+        name    - profile name
+        headers - if true, "#" comment lines are included in the output
+        prefix  - a prefix for the IDs
+        digits  - the number of hexadecimal digits of the IDs (the
+                  probability of two comments getting the same ID grows
+                  with the square of the number of comments divided by
+                  16 ** digits)
+        """
+        super(CommentIndex, self).__init__(name, headers=headers, comments=True)
+        if not 4 <= digits <= 40:
+            raise ValueError('digits must be between 4 and 40')
+        self.prefix = prefix
+        self.digits = digits
+        self._entries = OrderedDict()
+
+    def comment_id(self, comment):
+        """Returns the ID of a comment"""
+        return self.prefix + hashlib.sha1(comment.encode('utf-8')).hexdigest()[:self.digits]
+
+    def kernel_comment(self, comment, rule=None):
+        """Returns the ID of comment, recording the comment (and the
+        debug info of rule) in the index"""
+        if not comment:
+            return None
+        comment_id = self.comment_id(comment)
+        entry = self._entries.get(comment_id)
+        if entry is None:
+            entry = self._entries[comment_id] = CommentEntry(comment, [])
+        elif entry.comment != comment:
+            raise ValueError('comments "%s" and "%s" have the same ID %s, use more digits' % (
+                entry.comment, comment, comment_id))
+        if rule is not None:
+            debug_info = rule.debug_info()
+            if debug_info not in entry.sources:
+                entry.sources.append(debug_info)
+        return comment_id
+
+    def __getitem__(self, comment_id):
+        """Returns the CommentEntry for an ID"""
+        return self._entries[comment_id]
+
+    def __contains__(self, comment_id):
+        return comment_id in self._entries
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """Remove all the entries"""
+        self._entries.clear()
+
+    def expand(self, line):
+        """Returns a rule definition (e.g. from iptables-save) with the IDs
+        of the comments replaced by the comments"""
+        def replace(match):
+            entry = self._entries.get(match.group(2).strip('"'))
+            if entry is None:
+                return match.group(0)
+            return '%s"%s"' % (match.group(1), entry.comment.replace('"', '\\"'))
+        return _KERNEL_COMMENT.sub(replace, line)
+
+    def as_dict(self):
+        return OrderedDict([
+            ('prefix', self.prefix),
+            ('digits', self.digits),
+            ('comments', OrderedDict((comment_id, entry._asdict()) for comment_id, entry in self._entries.items())),
+        ])
+
+    def save(self, path):
+        """Write the index to a JSON file"""
+        write_atomic(path, json.dumps(self.as_dict(), indent=1).encode('utf-8'))
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        """Read an index written by save() (kwargs are passed to the constructor)"""
+        with open(path) as index_file:
+            data = json.load(index_file, object_pairs_hook=OrderedDict)
+        index = cls(prefix=data['prefix'], digits=data['digits'], **kwargs)
+        for comment_id, entry in data['comments'].items():
+            index._entries[comment_id] = CommentEntry(entry['comment'], entry['sources'])
+        return index
+
+    def __repr__(self):
+        return "<CommentIndex: %s - %d comments>" % (self.name, len(self._entries))
@@ -0,0 +1,260 @@
+"""This module contains a static cost model for Tables.
+
+   estimate() computes, without loading the rules into the kernel,
+   how many rules a packet traverses in each built-in chain (following
+   jumps and gotos into user chains), how many rules the kernel will
+   hold after iptables has expanded comma separated addresses, and an
+   approximate kernel memory and restore time figure.
+
+   The figures are estimates: the worst case assumes a packet is
+   evaluated against every rule it can reach, the average assumes a
+   packet is equally likely to leave a chain at any of the rules that
+   could terminate it (or at the end of the chain), and that jumps to
+   user chains are taken half of the time.
+
+   report = estimate(tables, zones=[lan, dmz, wan])
+   print(report)
+   problems = report.check(max_worst=500)
+"""
+
+from collections import namedtuple, OrderedDict
+
+from pyptables.parsing import tokenize, options, target, kernel_rule_count, \
+    MATCH_OPTIONS, MATCH_MODULE_OPTIONS, TERMINAL_TARGETS
+from pyptables.profiles import get_profile, COMPACT
+
+
+ChainCost = namedtuple('ChainCost', 'worst average rules kernel_rules')
+ChainCost.__doc__ = """The cost of traversing a chain
+
+worst        - worst case number of (kernel) rules a packet is evaluated against
+average      - estimated average number of rules a packet is evaluated against
+rules        - number of rule definitions in the chain
+kernel_rules - number of kernel rules in the chain, after address expansion
+"""
+
+# approximate sizes of the kernel structures for a rule (x_tables, 64bit)
+RULE_BYTES = 112 + 40     # ipt_entry and standard target
+MATCH_BYTES = 48          # xt_entry_match header and typical match data
+COMMENT_BYTES = 256       # comment match data is fixed size
+# approximate time iptables-restore spends on each kernel rule
+RESTORE_SECONDS_PER_RULE = 0.00002
+
+
+class _Line(object):
+    """Parsed rule definition"""
+    __slots__ = ('kernel_rules', 'target', 'goto', 'matches', 'in_interfaces',
+                 'out_interfaces', 'bytes')
+
+    def __init__(self, line):
+        tokens = tokenize(line)
+        parsed = options(tokens)
+        self.kernel_rules = kernel_rule_count(tokens)
+        self.target, self.goto = target(tokens)
+        self.in_interfaces = self.out_interfaces = None
+        self.matches = False  # criteria other than interfaces
+        modules = 0
+        comment = False
+        for inverse, option, values in parsed:
+            name = MATCH_OPTIONS.get(option)
+            if name == '-i':
+                self.in_interfaces = (inverse, values[0] if values else '')
+            elif name == '-o':
+                self.out_interfaces = (inverse, values[0] if values else '')
+            elif name is not None:
+                self.matches = True
+            elif option in MATCH_MODULE_OPTIONS and values:
+                if values[0] == 'comment':
+                    comment = True
+                else:
+                    self.matches = True
+                    modules += 1
+        self.bytes = self.kernel_rules * (RULE_BYTES + MATCH_BYTES * modules + (COMMENT_BYTES if comment else 0))
+
+    def possible(self, in_interface, out_interface):
+        """Returns False if this rule can't match a packet on the specified interfaces"""
+        return (_interface_possible(self.in_interfaces, in_interface) and
+                _interface_possible(self.out_interfaces, out_interface))
+
+    def conditional(self, in_interface, out_interface):
+        """Returns True if this rule might not match a packet on the specified interfaces"""
+        return (self.matches or
+                not _interface_certain(self.in_interfaces, in_interface) or
+                not _interface_certain(self.out_interfaces, out_interface))
+
+
+def _interface_possible(spec, interface):
+    if spec is None or interface is None:
+        return True
+    inverse, name = spec
+    if name.endswith('+'):
+        match = interface.startswith(name[:-1])
+    else:
+        match = interface == name
+    return match != inverse
+
+
+def _interface_certain(spec, interface):
+    if spec is None:
+        return True
+    return interface is not None and _interface_possible(spec, interface)
+
+
+class CostReport(object):
+    """The result of estimate()"""
+
+    def __init__(self):
+        super(CostReport, self).__init__()
+        self.chains = OrderedDict()
+        self.zone_pairs = OrderedDict()
+        self.kernel_rules = 0
+        self.memory_bytes = 0
+        self.restore_seconds = 0.0
+
+    def check(self, max_worst=None, max_average=None, max_kernel_rules=None, max_memory_bytes=None):
+        """Returns a list of messages describing any limits that are exceeded"""
+        problems = []
+        for name, costs in list(self.chains.items()) + list(self.zone_pairs.items()):
+            label = "/".join(name) if name in self.chains else "%s -> %s" % name
+            if max_worst is not None and costs.worst > max_worst:
+                problems.append("%s: worst case %s rules exceeds %s" % (label, costs.worst, max_worst))
+            if max_average is not None and costs.average > max_average:
+                problems.append("%s: average %.1f rules exceeds %s" % (label, costs.average, max_average))
+        if max_kernel_rules is not None and self.kernel_rules > max_kernel_rules:
+            problems.append("%s kernel rules exceeds %s" % (self.kernel_rules, max_kernel_rules))
+        if max_memory_bytes is not None and self.memory_bytes > max_memory_bytes:
+            problems.append("%s bytes of kernel memory exceeds %s" % (self.memory_bytes, max_memory_bytes))
+        return problems
+
+    def as_dict(self):
+        return {
+            'chains': dict(("/".join(name), costs._asdict()) for name, costs in self.chains.items()),
+            'zone_pairs': dict(("%s -> %s" % name, costs._asdict()) for name, costs in self.zone_pairs.items()),
+            'kernel_rules': self.kernel_rules,
+            'memory_bytes': self.memory_bytes,
+            'restore_seconds': self.restore_seconds,
+        }
+
+    def __str__(self):
+        lines = ["%-32s %8s %8s %8s %8s" % ('chain', 'worst', 'average', 'rules', 'kernel')]
+        for name, costs in self.chains.items():
+            lines.append("%-32s %8d %8.1f %8d %8d" % (("/".join(name),) + costs))
+        for name, costs in self.zone_pairs.items():
+            lines.append("%-32s %8d %8.1f %8d %8d" % (("%s -> %s" % name,) + costs))
+        lines.append("kernel rules: %d, memory: ~%d KiB, restore: ~%.2fs" % (
+            self.kernel_rules,
+            self.memory_bytes / 1024,
+            self.restore_seconds,
+        ))
+        return "\n".join(lines)
+
+
+class _Estimator(object):
+    def __init__(self, table, profile):
+        self.chains = {}
+        for chain in table.values():
+            lines = []
+            for rule in chain:
+                lines.extend([_Line(line) for line in rule.rule_definitions(profile)])
+            self.chains[chain.name] = lines
+        self._costs = {}
+
+    def cost(self, name, in_interface=None, out_interface=None, stack=()):
+        """Returns (worst, average, ended) for traversing the named chain,
+        where ended is True if a packet entering the chain never returns
+        to the calling chain"""
+        if name in stack:
+            raise ValueError('chain loop: %s' % " -> ".join(stack + (name,)))
+        key = (name, in_interface, out_interface)
+        result = self._costs.get(key)
+        if result is None:
+            # chains shared by many paths are only walked once per interface pair
+            result = self._costs[key] = self._cost(name, in_interface, out_interface, stack + (name,))
+        return result
+
+    def _cost(self, name, in_interface, out_interface, stack):
+        worst = branch_worst = 0
+        spent = 0.0
+        exits = []
+        for line in self.chains[name]:
+            worst += line.kernel_rules
+            spent += line.kernel_rules
+            if not line.possible(in_interface, out_interface):
+                continue
+            conditional = line.conditional(in_interface, out_interface)
+            if line.target in self.chains:
+                target_worst, target_average, target_ended = self.cost(line.target, in_interface,
+                                                                       out_interface, stack)
+                if line.goto:
+                    branch_worst = max(branch_worst, worst + target_worst)
+                    exits.append(spent + target_average)
+                    if not conditional:
+                        return branch_worst, _mean(exits), target_ended
+                else:
+                    worst += target_worst
+                    spent += target_average * (0.5 if conditional else 1)
+                    if target_ended and not conditional:
+                        exits.append(spent)
+                        return max(worst, branch_worst), _mean(exits), True
+            elif line.target in TERMINAL_TARGETS:
+                exits.append(spent)
+                if not conditional:
+                    return max(worst, branch_worst), _mean(exits), line.target != 'RETURN'
+        exits.append(spent)
+        return max(worst, branch_worst), _mean(exits), False
+
+    def totals(self):
+        kernel_rules = memory = 0
+        for lines in self.chains.values():
+            for line in lines:
+                kernel_rules += line.kernel_rules
+                memory += line.bytes
+        return kernel_rules, memory
+
+
+def _mean(values):
+    return float(sum(values)) / len(values)
+
+
+def estimate(tables, zones=(), zone_chain=('filter', 'FORWARD'), profile=COMPACT):
+    """Estimate the per-packet cost and kernel footprint of tables.
+
+    tables     - the Tables object
+    zones      - Zone objects, for which the cost of each (source zone,
+                 destination zone) pair is estimated
+    zone_chain - the (table, chain) used for the zone pair estimates
+    profile    - the Profile the tables will be loaded with (comments
+                 increase the kernel memory used)
+
+    Returns a CostReport
+    """
+    report = CostReport()
+    for table in tables.values():
+        estimator = _Estimator(table, get_profile(profile))
+        for chain in table.values():
+            if chain._chain_definition().split()[1] == '-':
+                continue  # user chains are included in the built-in chains they are reached from
+            worst, average, __ = estimator.cost(chain.name)
+            lines = estimator.chains[chain.name]
+            report.chains[(table.name, chain.name)] = ChainCost(
+                worst=worst,
+                average=average,
+                rules=len(lines),
+                kernel_rules=sum(line.kernel_rules for line in lines),
+            )
+        kernel_rules, memory = estimator.totals()
+        report.kernel_rules += kernel_rules
+        report.memory_bytes += memory
+        if table.name == zone_chain[0] and zone_chain[1] in table:
+            lines = estimator.chains[zone_chain[1]]
+            for source in zones:
+                for destination in zones:
+                    worst, average, __ = estimator.cost(zone_chain[1], source.interface, destination.interface)
+                    report.zone_pairs[(source.name, destination.name)] = ChainCost(
+                        worst=worst,
+                        average=average,
+                        rules=len(lines),
+                        kernel_rules=sum(line.kernel_rules for line in lines),
+                    )
+    report.restore_seconds = report.kernel_rules * RESTORE_SECONDS_PER_RULE
+    return report
@@ -0,0 +1,340 @@
+"""This module contains the CounterSample and RuleMap classes.
+
+   A CounterSample holds the packet and byte counters of every rule and
+   built-in chain policy in the kernel, parsed from the output of
+   "iptables-save -c" (or of "iptables -L -v -x -n"):
+
+   sample = CounterSample.collect()
+
+   A RuleMap maps the counters back to the Rule objects that generated
+   the rules, by position in the chain (checked against the comment of
+   the rule, where there is one), falling back to the comment when the
+   positions don't match (e.g. if rules were inserted by another tool).
+   The tables must be rendered with the profile used to write them into
+   the kernel:
+
+   rule_map = RuleMap(tables, profile='compact')
+   for rate in sample.rates(previous_sample):
+       print(rate.packets, rule_map[rate.counter])
+
+   Rules written with a CommentIndex profile carry a comment ID, which
+   the CommentIndex (e.g. loaded from the file saved alongside the
+   rules) maps back to the comment and the debug info of the rules,
+   without the tables.  Either can be used when exporting the counters:
+
+   print(sample.to_prometheus(CommentIndex.load('rules.v4.comments.json')))
+"""
+
+import json
+import subprocess
+import time as _time
+from collections import namedtuple, OrderedDict
+
+from pyptables.parsing import comment as _comment, kernel_rule_count, tokenize
+from pyptables.profiles import get_profile
+
+
+RuleCounter = namedtuple('RuleCounter', 'table chain position packets bytes rule comment')
+RuleCounter.__doc__ = """The counters of a rule in the kernel
+
+table    - the table name
+chain    - the chain name
+position - the (1-based) position of the rule in the chain
+packets  - the number of packets matched by the rule
+bytes    - the number of bytes matched by the rule
+rule     - the rule, as listed (without the counters)
+comment  - the comment of the rule, or None
+"""
+
+PolicyCounter = namedtuple('PolicyCounter', 'table chain policy packets bytes')
+PolicyCounter.__doc__ = """The counters of the policy of a built-in chain
+
+table   - the table name
+chain   - the chain name
+policy  - the policy (ACCEPT, DROP)
+packets - the number of packets that reached the policy
+bytes   - the number of bytes that reached the policy
+"""
+
+RuleRate = namedtuple('RuleRate', 'counter packets bytes')
+RuleRate.__doc__ = """The rate at which a rule was hit between two samples
+
+counter - the RuleCounter of the later sample
+packets - packets per second
+bytes   - bytes per second
+"""
+
+
+def parse_save(output):
+    """Returns (rules, policies), lists of the RuleCounter and PolicyCounter
+    objects in the output of iptables-save -c
+    """
+    rules = []
+    policies = []
+    table = None
+    positions = {}
+    for line in output.splitlines():
+        if line.startswith('['):
+            end = line.index(']')
+            packets, _, byte_count = line[1:end].partition(':')
+            rule = line[end + 2:]
+            chain = rule.split(' ', 2)[1]
+            position = positions[chain] = positions.get(chain, 0) + 1
+            rules.append(RuleCounter(table, chain, position, int(packets), int(byte_count), rule,
+                                     _comment(rule)))
+        elif line.startswith(':'):
+            chain, policy, counters = line[1:].split(' ', 2)
+            if policy != '-':
+                packets, _, byte_count = counters.strip('[]').partition(':')
+                policies.append(PolicyCounter(table, chain, policy, int(packets), int(byte_count)))
+        elif line.startswith('*'):
+            table = line[1:].strip()
+            positions = {}
+    return rules, policies
+
+
+def parse_list(output, table='filter'):
+    """Returns (rules, policies), lists of the RuleCounter and PolicyCounter
+    objects in the output of iptables -L -v -x -n (with or without
+    --line-numbers) for table
+    """
+    rules = []
+    policies = []
+    chain = None
+    skip = 2
+    for line in output.splitlines():
+        if line.startswith('Chain '):
+            words = line.split()
+            chain = words[1]
+            position = 0
+            if words[2] == '(policy':
+                policies.append(PolicyCounter(table, chain, words[3], int(words[4]), int(words[6])))
+        elif not line.strip():
+            continue
+        elif line.split(None, 1)[0] in ('pkts', 'num'):
+            skip = 3 if line.split(None, 1)[0] == 'num' else 2
+        elif chain is not None:
+            fields = line.split()
+            position += 1
+            comment = None
+            start = line.find('/* ')
+            if start != -1:
+                comment = line[start + 3:line.rindex(' */')]
+            rules.append(RuleCounter(table, chain, position, int(fields[skip - 2]), int(fields[skip - 1]),
+                                     " ".join(fields[skip:]), comment))
+    return rules, policies
+
+
+class CounterSample(object):
+    """The counters of the rules and policies in the kernel at a time"""
+
+    def __init__(self, rules, policies=(), time=None):
+        """Creates a CounterSample
+
+        rules    - list of RuleCounter objects
+        policies - list of PolicyCounter objects
+        time     - the time the counters were read (defaults to now)
+        """
+        super(CounterSample, self).__init__()
+        self.rules = list(rules)
+        self.policies = list(policies)
+        self.time = _time.time() if time is None else time
+
+    @classmethod
+    def from_save(cls, output, time=None):
+        """Returns a CounterSample of the output of iptables-save -c"""
+        rules, policies = parse_save(output)
+        return cls(rules, policies, time)
+
+    @classmethod
+    def from_list(cls, outputs, time=None):
+        """Returns a CounterSample of the outputs of iptables -L -v -x -n
+
+        outputs - dictionary of table name -> output for the table
+        """
+        rules, policies = [], []
+        for table, output in outputs.items():
+            table_rules, table_policies = parse_list(output, table)
+            rules.extend(table_rules)
+            policies.extend(table_policies)
+        return cls(rules, policies, time)
+
+    @classmethod
+    def collect(cls, command=('iptables-save', '-c')):
+        """Returns a CounterSample of the counters in the kernel (read with
+        iptables-save -c, or a compatible command)"""
+        now = _time.time()
+        output = subprocess.check_output(list(command))
+        return cls.from_save(output.decode('utf-8'), time=now)
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def rates(self, previous):
+        """Returns the list of RuleRate objects of the rules since the previous
+        sample.  Rules which changed (or were not in the previous sample)
+        are skipped, rules whose counters decreased (the rules were
+        written again, or the counters zeroed) are measured from zero.
+        """
+        elapsed = self.time - previous.time
+        if elapsed <= 0:
+            raise ValueError('the previous sample must be older than this sample')
+        before = dict(((counter.table, counter.chain, counter.position), counter) for counter in previous.rules)
+        rates = []
+        for counter in self.rules:
+            old = before.get((counter.table, counter.chain, counter.position))
+            if old is None or old.rule != counter.rule:
+                continue
+            packets, byte_count = counter.packets - old.packets, counter.bytes - old.bytes
+            if packets < 0 or byte_count < 0:
+                packets, byte_count = counter.packets, counter.bytes
+            rates.append(RuleRate(counter, packets / float(elapsed), byte_count / float(elapsed)))
+        return rates
+
+    def by_comment(self):
+        """Returns an OrderedDict of comment -> [packets, bytes], the totals
+        of the rules with each comment (the kernel rules generated by a
+        rule share its comment)"""
+        totals = OrderedDict()
+        for counter in self.rules:
+            if counter.comment is not None:
+                total = totals.setdefault(counter.comment, [0, 0])
+                total[0] += counter.packets
+                total[1] += counter.bytes
+        return totals
+
+    def as_dict(self, rule_map=None):
+        """Returns the sample as a dictionary (for JSON)
+
+        rule_map - a RuleMap or CommentIndex, used to add the full comment
+                   and the debug info of the rules that generated each rule
+        """
+        rules = []
+        for counter in self.rules:
+            entry = OrderedDict(zip(('table', 'chain', 'position', 'packets', 'bytes', 'rule', 'comment'), counter))
+            if rule_map is not None:
+                entry['comment'], entry['sources'] = _origin(rule_map, counter)
+            rules.append(entry)
+        return OrderedDict([
+            ('time', self.time),
+            ('rules', rules),
+            ('policies', [counter._asdict() for counter in self.policies]),
+        ])
+
+    def to_json(self, rule_map=None, **kwargs):
+        """Returns the sample as JSON (see as_dict(), kwargs are passed to json.dumps())"""
+        return json.dumps(self.as_dict(rule_map), **kwargs)
+
+    def to_prometheus(self, rule_map=None, prefix='iptables'):
+        """Returns the counters in the Prometheus text exposition format
+
+        rule_map - a RuleMap or CommentIndex, used to add the full comment
+                   and a "source" label, the debug info of the (first)
+                   rule that generated each rule
+        prefix   - the prefix of the metric names
+        """
+        metrics = OrderedDict()
+        for kind in ('packets', 'bytes'):
+            metrics['%s_rule_%s_total' % (prefix, kind)] = (
+                'counter', '%s matched by the rule' % kind.capitalize(), [])
+            metrics['%s_policy_%s_total' % (prefix, kind)] = (
+                'counter', '%s which reached the policy of the chain' % kind.capitalize(), [])
+        rule_packets, rule_bytes = [metrics['%s_rule_%s_total' % (prefix, kind)][2] for kind in ('packets', 'bytes')]
+        for counter in self.rules:
+            labels = [('table', counter.table), ('chain', counter.chain), ('position', counter.position)]
+            comment = counter.comment
+            if rule_map is not None:
+                comment, sources = _origin(rule_map, counter)
+                if sources:
+                    labels.append(('source', sources[0]))
+            if comment is not None:
+                labels.append(('comment', comment))
+            labels = _labels(labels)
+            rule_packets.append((labels, counter.packets))
+            rule_bytes.append((labels, counter.bytes))
+        policy_packets, policy_bytes = [metrics['%s_policy_%s_total' % (prefix, kind)][2]
+                                        for kind in ('packets', 'bytes')]
+        for counter in self.policies:
+            labels = _labels([('table', counter.table), ('chain', counter.chain), ('policy', counter.policy)])
+            policy_packets.append((labels, counter.packets))
+            policy_bytes.append((labels, counter.bytes))
+        lines = []
+        for name, (metric_type, description, samples) in metrics.items():
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            lines.extend('%s{%s} %d' % (name, labels, value) for labels, value in samples)
+        return "\n".join(lines) + "\n"
+
+    def __repr__(self):
+        return "<CounterSample: %d rules, %d policies>" % (len(self.rules), len(self.policies))
+
+
+def _escape(value):
+    value = str(value)
+    if '\\' in value or '"' in value or '\n' in value:
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return value
+
+
+def _labels(labels):
+    return ",".join(['%s="%s"' % (name, _escape(value)) for name, value in labels])
+
+
+def _origin(rule_map, counter):
+    """Returns (comment, sources) of counter, from a RuleMap or CommentIndex"""
+    if isinstance(rule_map, RuleMap):
+        rule = rule_map[counter]
+        return counter.comment, [rule.debug_info()] if rule is not None else []
+    if counter.comment is not None and counter.comment in rule_map:
+        entry = rule_map[counter.comment]
+        return entry.comment, list(entry.sources)
+    return counter.comment, []
+
+
+class RuleMap(object):
+    """Maps RuleCounter objects to the Rule objects that generated them, see
+    module documentation"""
+
+    def __init__(self, tables, profile=None):
+        """Creates a RuleMap
+
+        tables  - the Tables object
+        profile - the profile the tables were written into the kernel with
+        """
+        super(RuleMap, self).__init__()
+        self._chains = {}
+        self._comments = {}
+        for line, table, chain, rule in tables.iter_iptables(profile=get_profile(profile)):
+            if not line.startswith('-A '):
+                continue
+            comment = _comment(line)
+            definition = line.split(' --comment ', 1)[0]
+            count = kernel_rule_count(tokenize(definition)) if ',' in definition else 1
+            self._chains.setdefault((table.name, chain.name), []).extend([(rule, comment)] * count)
+            if comment is not None:
+                rules = self._comments.setdefault((table.name, comment), [])
+                if rule not in rules:
+                    rules.append(rule)
+
+    def __getitem__(self, counter):
+        """Returns the Rule that generated the rule of counter (a RuleCounter),
+        or None if it can't be found"""
+        rules = self._chains.get((counter.table, counter.chain))
+        if rules is not None and counter.position <= len(rules):
+            rule, comment = rules[counter.position - 1]
+            if comment == counter.comment:
+                return rule
+        if counter.comment is not None:
+            rules = self._comments.get((counter.table, counter.comment))
+            if rules is not None and len(rules) == 1:
+                return rules[0]
+        return None
+
+    def __len__(self):
+        return sum(len(rules) for rules in self._chains.values())
+
+    def __repr__(self):
+        return "<RuleMap: %d rules>" % len(self)
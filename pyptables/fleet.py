@@ -0,0 +1,438 @@
+"""This module contains the FleetBase and HostTables classes, and the
+   render_fleet() batch driver.
+
+   When generating the rules of many hosts sharing most of their rules,
+   building and rendering a complete Tables for every host repeats the
+   same work for every host.  A FleetBase wraps the shared Tables, and
+   a HostTables is the overlay of a host on it, which adds chains,
+   replaces chains and adds rules to the start or end of chains, without
+   changing the base:
+
+   base = FleetBase(build_common_tables())
+   host = base.host('web01')
+   host.replace('filter', UserChain('services', rules=[...]))
+   host.add('filter', UserChain('admin_access', rules=[...]))
+   host.append('filter', 'INPUT', Jump('admin_access'))
+   output = host.to_iptables(profile='compact')
+
+   The base is rendered once per profile, and the output of a host is
+   made of the rendered text of the tables and chains it inherits
+   unchanged, and of the rendering of its own chains and rules, so
+   rendering a host costs the rendering of what is specific to it.  The
+   output is the same as that of the equivalent Tables (see
+   HostTables.tables()).
+
+   render_fleet() renders a number of hosts in parallel, writing the
+   output of each host to its own file, and reports the time taken and
+   memory used by each host:
+
+   hosts = dict((name, build_host(base, name)) for name in names)
+   for report in render_fleet(hosts, '/srv/firewall/rules', processes=8):
+       print(report)
+
+   The base must not be changed once it has been rendered.
+"""
+
+import multiprocessing
+import os
+import sys
+import time
+from collections import namedtuple, OrderedDict
+
+from pyptables.base import DebugObject
+from pyptables.chains import AbstractChain
+from pyptables.profiles import get_profile
+from pyptables.tables import Tables, Table
+from pyptables.util import write_atomic
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover
+    tracemalloc = None
+
+
+def _split(chain, profile):
+    """Returns the (line, rule) tuples of the output of chain, split into
+    (header, rules, tail): the header and tail are the "#" comment lines
+    before and after the rules (the tail is "# No rules" if there are none)
+    """
+    header, rules, tail = [], [], []
+    for line, rule in chain.iter_iptables(profile=profile):
+        if rule is not None:
+            rules.append((line, rule))
+        elif rules:
+            tail.append((line, rule))
+        else:
+            header.append((line, rule))
+    if not rules and header and profile.headers:
+        tail.append(header.pop())
+    return header, rules, tail
+
+
+def _text(lines):
+    return "\n".join([line for line, __ in lines]) or None
+
+
+class _RenderedChain(object):
+    """The output of a chain of the base, split into header, rules and tail"""
+
+    def __init__(self, chain, profile):
+        header, rules, tail = _split(chain, profile)
+        self.definition = chain._chain_definition()
+        self.header = _text(header)
+        self.rules = _text(rules)
+        self.tail = _text(tail)
+        self.text = "\n".join([part for part in (self.header, self.rules, self.tail) if part]) or None
+
+
+class _RenderedTable(object):
+    """The output of a table of the base, as a whole and by chain"""
+
+    def __init__(self, table, profile):
+        lines = [line for line, __, __ in table.iter_iptables(profile=profile)]
+        self.text = "\n".join(lines)
+        self.preamble = lines[:lines.index('*%s' % table.name) + 1]
+        self.chains = OrderedDict((name, _RenderedChain(chain, profile)) for name, chain in table.items())
+
+
+class _Rendered(object):
+    """The output of the base, rendered with a profile"""
+
+    def __init__(self, tables, profile):
+        self.header = '# Tables generated by PyPTables (%(debug)s)' % {'debug': tables.debug_info()}
+        self.tables = OrderedDict((name, _RenderedTable(table, profile)) for name, table in tables.items())
+
+
+class ExtendedChain(AbstractChain):
+    """A chain of the base with rules added to its start and end by a
+    HostTables (see HostTables.tables()).  The base chain is not changed.
+    """
+
+    def __init__(self, chain, prepended=(), appended=()):
+        super(ExtendedChain, self).__init__(chain.name, comment=chain.comment,
+                                            rules=list(prepended) + list(chain) + list(appended))
+        self.chain = chain
+        self.prepended = list(prepended)
+        self.appended = list(appended)
+        self.filename, self.lineno, self.function = chain.filename, chain.lineno, chain.function
+
+    def _rule_lines(self, rules, profile):
+        prefix = '-A %s' % (self.name,)
+        return [(line, rule) for rule in rules for line in rule.iter_iptables(prefix=prefix, profile=profile)]
+
+    def iter_iptables(self, profile=None):
+        """Yield (line, rule) tuples for the rules of this chain in iptables format
+
+        Note: the chain definition is not included, see _chain_definition()
+        """
+        profile = get_profile(profile)
+        header, rules, tail = _split(self.chain, profile)
+        rules = self._rule_lines(self.prepended, profile) + rules + self._rule_lines(self.appended, profile)
+        return iter(header + rules + ([] if rules else tail))
+
+    def _chain_definition(self):
+        return self.chain._chain_definition()
+
+    def __reduce__(self):
+        return self.__class__, (self.chain, self.prepended, self.appended), {}
+
+
+class FleetBase(object):
+    """The Tables shared by a fleet of hosts, see module documentation"""
+
+    def __init__(self, tables):
+        """Creates a FleetBase
+
+        tables - the shared Tables object (must not be changed once rendered)
+        """
+        super(FleetBase, self).__init__()
+        self.tables = tables
+        self._rendered = {}
+
+    def rendered(self, profile=None):
+        """Returns the base rendered with profile (rendered on first use)"""
+        profile = get_profile(profile)
+        rendered = self._rendered.get(profile)
+        if rendered is None:
+            rendered = self._rendered[profile] = _Rendered(self.tables, profile)
+        return rendered
+
+    def host(self, name):
+        """Returns a new, empty HostTables overlay on this base"""
+        return HostTables(self, name)
+
+    def to_iptables(self, profile=None):
+        """Returns the output of the base alone (as rendered by rendered())"""
+        profile = get_profile(profile)
+        rendered = self.rendered(profile)
+        parts = [rendered.header] if profile.headers else []
+        for table in rendered.tables.values():
+            if profile.headers:
+                parts.append('')
+            parts.append(table.text)
+        return "%s\n" % "\n".join(parts)
+
+    def __repr__(self):
+        return "<FleetBase: %s>" % ", ".join(self.tables)
+
+
+class HostTables(DebugObject):
+    """The overlay of a host on a FleetBase, see module documentation"""
+
+    def __init__(self, base, name):
+        """Creates a HostTables
+
+        base - the FleetBase (or a Tables, which is wrapped in a new FleetBase)
+        name - the name of the host (used for the output file of render_fleet())
+        """
+        super(HostTables, self).__init__()
+        self.base = base if isinstance(base, FleetBase) else FleetBase(base)
+        self.name = name
+        self._chains = {}
+        self._extensions = {}
+
+    def _base_table(self, table):
+        try:
+            return self.base.tables[table]
+        except KeyError:
+            raise KeyError('table %s is not in the base' % table)
+
+    def _own_chains(self, table):
+        self._base_table(table)
+        return self._chains.setdefault(table, OrderedDict())
+
+    def add(self, table, chain):
+        """Add a chain to the end of a table of the base"""
+        chains = self._own_chains(table)
+        if chain.name in self.base.tables[table] or chain.name in chains:
+            raise ValueError('chain %s already exists in table %s, use replace()' % (chain.name, table))
+        chains[chain.name] = chain
+        return chain
+
+    def replace(self, table, chain):
+        """Replace the chain of the base with the same name as chain (rules
+        added to the chain by append() and prepend() are discarded)"""
+        chains = self._own_chains(table)
+        if chain.name not in self.base.tables[table]:
+            raise KeyError('chain %s is not in table %s of the base, use add()' % (chain.name, table))
+        chains[chain.name] = chain
+        self._extensions.pop((table, chain.name), None)
+        return chain
+
+    def _extension(self, table, chain):
+        if chain not in self._base_table(table) and chain not in self._chains.get(table, ()):
+            raise KeyError('chain %s is not in table %s' % (chain, table))
+        return self._extensions.setdefault((table, chain), ([], []))
+
+    def prepend(self, table, chain, rule):
+        """Add a rule to the start of a chain (before the previously prepended rules)"""
+        self._extension(table, chain)[0].insert(0, rule)
+        return rule
+
+    def append(self, table, chain, rule):
+        """Add a rule to the end of a chain"""
+        self._extension(table, chain)[1].append(rule)
+        return rule
+
+    def chains(self, table):
+        """Yield the chains of a table, in order, as they appear in the output"""
+        base_table = self._base_table(table)
+        own = self._chains.get(table, {})
+        for name, chain in base_table.items():
+            yield self._chain(table, own.get(name, chain))
+        for name, chain in own.items():
+            if name not in base_table:
+                yield self._chain(table, chain)
+
+    def _chain(self, table, chain):
+        extension = self._extensions.get((table, chain.name))
+        if extension is None:
+            return chain
+        return ExtendedChain(chain, *extension)
+
+    def tables(self):
+        """Returns the equivalent Tables object (sharing the chains of the base)"""
+        tables = Tables()
+        tables.filename, tables.lineno, tables.function = (self.base.tables.filename, self.base.tables.lineno,
+                                                           self.base.tables.function)
+        for base_table in self.base.tables.values():
+            table = tables.append(Table(base_table.name, *self.chains(base_table.name)))
+            table.filename, table.lineno, table.function = base_table.filename, base_table.lineno, base_table.function
+        return tables
+
+    def iter_iptables(self, profile=None):
+        """Yield (line, table, chain, rule) tuples, see Tables.iter_iptables()"""
+        return self.tables().iter_iptables(profile=profile)
+
+    def to_iptables(self, profile=None, index=None):
+        """Returns the output of this host, in a format compatible with iptables-restore
+
+        profile - see Tables.to_iptables()
+        index   - a LineIndex, see Tables.to_iptables() (the output is
+                  generated from tables(), rather than the rendered base)
+        """
+        if index is not None:
+            return self.tables().to_iptables(profile=profile, index=index)
+        profile = get_profile(profile)
+        rendered = self.base.rendered(profile)
+        parts = [rendered.header] if profile.headers else []
+        changed = set(self._chains).union(table for table, __ in self._extensions)
+        for name, rendered_table in rendered.tables.items():
+            if profile.headers:
+                parts.append('')
+            if name not in changed:
+                parts.append(rendered_table.text)
+            else:
+                self._render_table(parts, name, rendered_table, profile)
+        return "%s\n" % "\n".join(parts)
+
+    def _render_table(self, parts, table, rendered_table, profile):
+        """Add the output of a table with chains changed by this host to parts"""
+        parts.extend(rendered_table.preamble)
+        chains = list(self.chains(table))
+        base_table = self.base.tables[table]
+        cached = []
+        for chain in chains:
+            base_chain = base_table.get(chain.name)
+            if base_chain is chain or (isinstance(chain, ExtendedChain) and base_chain is chain.chain):
+                cached.append(rendered_table.chains[chain.name])
+            else:
+                cached.append(None)
+        for chain, rendered_chain in zip(chains, cached):
+            parts.append(rendered_chain.definition if rendered_chain is not None else chain._chain_definition())
+        for chain, rendered_chain in zip(chains, cached):
+            if profile.headers:
+                parts.append('')
+            if rendered_chain is None:
+                text = _text(chain.iter_iptables(profile=profile))
+            elif isinstance(chain, ExtendedChain):
+                prepended = _text(chain._rule_lines(chain.prepended, profile))
+                appended = _text(chain._rule_lines(chain.appended, profile))
+                rules = [part for part in (prepended, rendered_chain.rules, appended) if part]
+                text = "\n".join([part for part in [rendered_chain.header] + (rules or [rendered_chain.tail])
+                                  if part]) or None
+            else:
+                text = rendered_chain.text
+            if text is not None:
+                parts.append(text)
+        if profile.headers:
+            parts.append('')
+        parts.append('COMMIT')
+
+    def __repr__(self):
+        return "<HostTables: %s - %d chains, %d extended>" % (
+            self.name, sum(len(chains) for chains in self._chains.values()), len(self._extensions))
+
+
+HostReport = namedtuple('HostReport', 'host path size seconds peak_memory max_rss')
+HostReport.__doc__ = """The report of render_fleet() for a host
+
+host        - the name of the host
+path        - the output file
+size        - the size of the output, in bytes
+seconds     - the time taken to render and write the output
+peak_memory - the peak memory allocated while rendering, in bytes (if
+              trace_memory was set, otherwise None)
+max_rss     - the maximum resident set size of the process which rendered
+              the host so far, in bytes (None where unavailable)
+"""
+
+
+def _max_rss():
+    if resource is None:  # pragma: no cover
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+_worker_state = None
+
+
+def _check_host_name(name):
+    """Raises ValueError if a host name can't be used as a file name in
+    the output directory"""
+    separators = [sep for sep in (os.sep, os.altsep, '/') if sep]
+    if not name or name in ('.', '..') or '\0' in name or any(sep in name for sep in separators):
+        raise ValueError('invalid host name for an output file: %r' % (name,))
+
+
+def _init_worker(*state):
+    global _worker_state
+    _worker_state = state
+
+
+def _render_host(name):
+    hosts, directory, profile, suffix, trace_memory = _worker_state
+    start = time.time()
+    peak_memory = None
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        output = hosts[name].to_iptables(profile=profile).encode('utf-8')
+        if trace_memory:
+            peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    path = os.path.join(directory, '%s%s' % (name, suffix))
+    write_atomic(path, output)
+    return HostReport(name, path, len(output), time.time() - start, peak_memory, _max_rss())
+
+
+def render_fleet(hosts, directory, profile=None, processes=None, suffix='.rules', trace_memory=False):
+    """Render the output of a number of hosts in parallel, writing the
+    output of each host to a file named after it.  Returns the list of
+    HostReport objects, in the order of hosts.
+
+    hosts        - a mapping of host name -> HostTables (or Tables)
+    directory    - the directory of the output files (created if necessary)
+    profile      - see Tables.to_iptables()
+    processes    - the number of worker processes (defaults to the number
+                   of CPUs), if 1, the hosts are rendered in this process
+    suffix       - the suffix of the output files
+    trace_memory - if true, the peak memory allocated while rendering each
+                   host is measured (this slows rendering down)
+
+    The bases of the hosts are rendered before the workers are started, so
+    that (where processes are forked) the workers share the rendered bases.
+    Note: a CommentIndex profile only records the comments of the hosts
+    rendered in this process.
+    """
+    if trace_memory and tracemalloc is None:  # pragma: no cover
+        raise ValueError('trace_memory requires the tracemalloc module')
+    profile = get_profile(profile)
+    for name in hosts:
+        _check_host_name(name)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    bases = {}
+    for host in hosts.values():
+        base = getattr(host, 'base', None)
+        if base is not None and id(base) not in bases:
+            bases[id(base)] = base
+            base.rendered(profile)
+    names = list(hosts)
+    state = (hosts, directory, profile, suffix, trace_memory)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes == 1 or len(names) <= 1:
+        _init_worker(*state)
+        try:
+            return [_render_host(name) for name in names]
+        finally:
+            _init_worker()
+    pool = multiprocessing.Pool(processes, _init_worker, state)
+    try:
+        reports = pool.map(_render_host, names, chunksize=max(1, len(names) // (processes * 4)))
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return reports
@@ -0,0 +1,213 @@
+"""This module contains the History class.
+
+   A History records each ruleset successfully written into the kernel
+   by restore(), so that a previous version can be written back
+   directly, without importing the configuration or rendering the
+   tables again:
+
+   history = History('/var/lib/pyptables/history', keep=50)
+   restore(tables, history=history)
+   ...
+   history.rollback()  # write the previous version back
+
+   or from the command line:
+
+   python -m pyptables --history /var/lib/pyptables/history
+   python -m pyptables --history /var/lib/pyptables/history --rollback [fingerprint|steps]
+
+   Payloads are stored gzip compressed, named by their fingerprint (a
+   sha256 hash of the payload), so re-applying an earlier version does
+   not store it again.  Each application is recorded in a log, with the
+   debug info of the Tables object that generated it.
+"""
+
+import gzip
+import hashlib
+import io
+import json
+import os
+import subprocess
+import time
+from collections import namedtuple
+
+from pyptables.util import write_atomic
+
+
+HistoryEntry = namedtuple('HistoryEntry', 'fingerprint time size profile source tables comment')
+HistoryEntry.__doc__ = """A ruleset recorded in a History
+
+fingerprint - sha256 hash of the payload
+time        - when the payload was applied (seconds since the epoch)
+size        - size of the payload in bytes
+profile     - name of the Profile the payload was rendered with, or None
+source      - debug info of the Tables object (where it was created), or None
+tables      - dictionary of table name -> number of chains, or None
+comment     - a comment (e.g. "rollback to ..."), or None
+"""
+
+
+def fingerprint(payload):
+    """Returns the fingerprint of a payload (str or bytes)"""
+    if not isinstance(payload, bytes):
+        payload = payload.encode('utf-8')
+    return hashlib.sha256(payload).hexdigest()
+
+
+def _gzip(payload):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as compressed:
+        compressed.write(payload)
+    return buf.getvalue()
+
+
+def _table_summary(tables):
+    """Returns a dictionary of table name -> number of chains of a Tables
+    object (or Snapshot), or None for other payload sources"""
+    if tables is None or not hasattr(tables, 'items'):
+        return None
+    return dict((name, len(table)) for name, table in tables.items())
+
+
+class History(object):
+    """A store of applied rulesets, see module documentation"""
+
+    def __init__(self, path, keep=100, max_bytes=None):
+        """Creates a History (the directory is created if necessary)
+
+        path      - the directory holding the history
+        keep      - the number of applications kept in the log
+        max_bytes - the maximum total size of the stored (compressed)
+                    payloads, older entries are removed to stay within it
+                    (the latest entry is always kept)
+        """
+        super(History, self).__init__()
+        if keep < 1:
+            raise ValueError('keep must be at least 1')
+        self.path = path
+        self.keep = keep
+        self.max_bytes = max_bytes
+        self._objects = os.path.join(path, 'objects')
+        self._log = os.path.join(path, 'log.jsonl')
+        if not os.path.isdir(self._objects):
+            os.makedirs(self._objects)
+
+    def _object_path(self, fingerprint):
+        return os.path.join(self._objects, '%s.gz' % fingerprint)
+
+    def record(self, payload, tables=None, profile=None, comment=None):
+        """Record an applied payload
+
+        payload - the iptables-restore input (str or bytes)
+        tables  - the Tables object the payload was rendered from
+        profile - the Profile the payload was rendered with
+        comment - a comment for the entry
+
+        Returns the HistoryEntry
+        """
+        if not isinstance(payload, bytes):
+            payload = payload.encode('utf-8')
+        entry = HistoryEntry(
+            fingerprint=fingerprint(payload),
+            time=time.time(),
+            size=len(payload),
+            profile=getattr(profile, 'name', profile),
+            source=tables.debug_info() if tables is not None and hasattr(tables, 'debug_info') else None,
+            tables=_table_summary(tables),
+            comment=comment,
+        )
+        object_path = self._object_path(entry.fingerprint)
+        if not os.path.exists(object_path):
+            write_atomic(object_path, _gzip(payload))
+        with open(self._log, 'a') as log:
+            log.write(json.dumps(entry._asdict(), sort_keys=True) + '\n')
+        self.prune()
+        return entry
+
+    def entries(self):
+        """Returns the list of HistoryEntry objects, newest first"""
+        if not os.path.exists(self._log):
+            return []
+        with open(self._log) as log:
+            entries = [HistoryEntry(**json.loads(line)) for line in log if line.strip()]
+        entries.reverse()
+        return entries
+
+    def get(self, ref=0):
+        """Returns a HistoryEntry
+
+        ref - the number of versions back from the latest (0 is the
+              latest), or a fingerprint (or unique prefix of one)
+        """
+        entries = self.entries()
+        if isinstance(ref, int) or (ref.isdigit() and len(ref) < 8):
+            ref = int(ref)
+            if not 0 <= ref < len(entries):
+                raise KeyError('history has %d entries, no entry %d' % (len(entries), ref))
+            return entries[ref]
+        matches = set(entry.fingerprint for entry in entries if entry.fingerprint.startswith(ref))
+        if not matches:
+            raise KeyError('no history entry %s' % ref)
+        if len(matches) > 1:
+            raise KeyError('ambiguous history entry %s' % ref)
+        fingerprint = matches.pop()
+        return [entry for entry in entries if entry.fingerprint == fingerprint][0]
+
+    def payload(self, entry):
+        """Returns the payload (str) of a HistoryEntry (or ref, see get())"""
+        if not isinstance(entry, HistoryEntry):
+            entry = self.get(entry)
+        with gzip.open(self._object_path(entry.fingerprint), 'rb') as stored:
+            return stored.read().decode('utf-8')
+
+    def rollback(self, ref=1, command=('iptables-restore',)):
+        """Write a recorded payload back into the kernel (with
+        iptables-restore), and record it as the latest entry.
+
+        ref     - the entry to restore, see get() (default: the
+                  version before the latest)
+        command - the iptables-restore command
+
+        Returns (entry, stdout, stderr), raises RuntimeError if the restore fails
+        """
+        entry = self.get(ref)
+        payload = self.payload(entry)
+        process = subprocess.Popen(
+            list(command),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        stdout, stderr = process.communicate(payload.encode('utf-8'))
+        if process.returncode:
+            raise RuntimeError('rollback to %s failed: %s' % (entry.fingerprint[:12],
+                                                              stderr.decode('utf-8', 'replace')))
+        self.record(payload, profile=entry.profile, comment='rollback to %s' % entry.fingerprint[:12])
+        return entry, stdout, stderr
+
+    def prune(self):
+        """Remove the entries (and payloads) beyond the retention limits"""
+        entries = self.entries()
+        kept = entries[:self.keep]
+        if self.max_bytes is not None:
+            sizes = {}
+            total = 0
+            for i, entry in enumerate(kept):
+                if entry.fingerprint not in sizes:
+                    sizes[entry.fingerprint] = os.path.getsize(self._object_path(entry.fingerprint))
+                    total += sizes[entry.fingerprint]
+                if total > self.max_bytes and i:
+                    kept = kept[:i]
+                    break
+        if len(kept) < len(entries):
+            lines = [json.dumps(entry._asdict(), sort_keys=True) + '\n' for entry in reversed(kept)]
+            write_atomic(self._log, "".join(lines).encode('utf-8'))
+        used = set('%s.gz' % entry.fingerprint for entry in kept)
+        for name in os.listdir(self._objects):
+            if name.endswith('.gz') and name not in used:
+                os.unlink(os.path.join(self._objects, name))
+
+    def __len__(self):
+        return len(self.entries())
+
+    def __repr__(self):
+        return "<History: %s - %d entries>" % (self.path, len(self))
@@ -0,0 +1,131 @@
+"""This module contains the LineIndex class.
+
+   A LineIndex maps the line numbers of generated output back
+   to the objects that generated each line, so that errors reported
+   by iptables-restore can be traced to the Rule that caused them.
+"""
+
+from array import array
+from collections import namedtuple
+
+
+IndexEntry = namedtuple('IndexEntry', 'table chain rule debug_info')
+IndexEntry.__doc__ = """The objects that generated a line of output
+
+table      - the Table (or None)
+chain      - the Chain (or None)
+rule       - the Rule (or None)
+debug_info - where the rule (or chain, or table) was created
+"""
+
+RestoreFailure = namedtuple('RestoreFailure', 'line message table chain rule debug_info')
+RestoreFailure.__doc__ = """An error reported by iptables-restore
+
+line       - the line number of the payload the error was reported for
+message    - the error message
+table      - the Table that generated the line (or None)
+chain      - the Chain that generated the line (or None)
+rule       - the Rule that generated the line (or None)
+debug_info - where the rule (or chain, or table) was created
+"""
+
+
+class LineIndex(object):
+    """Maps line numbers of generated output to (table, chain, rule).
+
+    Lines are recorded as they are generated, using one array slot per
+    line; consecutive lines generated by the same objects share a single
+    entry, so memory use is dominated by the array rather than the
+    number of lines.  Lookups are O(1).
+
+    Usage:
+    index = LineIndex()
+    output = tables.to_iptables(index=index)
+    entry = index[12]
+    """
+
+    def __init__(self):
+        super(LineIndex, self).__init__()
+        self._lines = array('i')
+        self._origins = []
+        self._last = None
+
+    def add(self, table, chain, rule):
+        """Record the objects that generated the next line"""
+        last = self._last
+        if last is None or last[0] is not table or last[1] is not chain or last[2] is not rule:
+            self._last = (table, chain, rule)
+            self._origins.append(self._last)
+        self._lines.append(len(self._origins) - 1)
+
+    def record(self, lines):
+        """Wraps a Tables.iter_iptables() generator, recording each line
+        as it is generated, and yielding the line text
+        """
+        add = self.add
+        for line, table, chain, rule in lines:
+            add(table, chain, rule)
+            yield line
+
+    def __len__(self):
+        return len(self._lines)
+
+    def __getitem__(self, line_no):
+        """Returns the IndexEntry for the (1-based) line number"""
+        if not 0 < line_no <= len(self._lines):
+            raise IndexError('line %s not in index' % line_no)
+        table, chain, rule = self._origins[self._lines[line_no - 1]]
+        for obj in (rule, chain, table):
+            if obj is not None:
+                debug_info = obj.debug_info()
+                break
+        else:
+            debug_info = None
+        return IndexEntry(table=table, chain=chain, rule=rule, debug_info=debug_info)
+
+    def get(self, line_no, default=None):
+        """Returns the IndexEntry for the (1-based) line number, or default"""
+        try:
+            return self[line_no]
+        except IndexError:
+            return default
+
+    def errors(self, stderr):
+        """Parse iptables-restore error output into a list of RestoreFailure"""
+        return parse_errors(stderr, self)
+
+    def __repr__(self):
+        return "<LineIndex: %s lines, %s entries>" % (len(self._lines), len(self._origins))
+
+
+def parse_errors(stderr, index=None):
+    """Parse iptables-restore error output into a list of RestoreFailure.
+
+    stderr - the error output
+    index  - the LineIndex recorded when generating the output
+    """
+    import re
+    line_number = re.compile(r'line:? (\d+)')
+    errors = []
+    message = []
+    for line in stderr.splitlines():
+        line = line.strip()
+        if not line or line.startswith('Try `'):
+            continue
+        message.append(line)
+        match = line_number.search(line)
+        if not match:
+            continue
+        line_no = int(match.group(1))
+        entry = index.get(line_no) if index is not None else None
+        if entry is None:
+            entry = IndexEntry(None, None, None, None)
+        errors.append(RestoreFailure(line=line_no,
+                                     message="\n".join(message),
+                                     table=entry.table,
+                                     chain=entry.chain,
+                                     rule=entry.rule,
+                                     debug_info=entry.debug_info,
+                                     ))
+        message = []
+    return errors
@@ -0,0 +1,342 @@
+"""This module contains an optimizer for the chain graph of Tables.
+
+   optimize() builds the graph of jumps between the chains of each
+   table, rejects loops, and returns an equivalent Tables object with:
+
+   - unconditional RETURN rules at the end of chains removed
+   - jumps to empty chains removed
+   - small chains inlined: an unconditional jump to a chain of at most
+     inline_limit rules is replaced by the rules, and a conditional
+     jump to a chain holding one unconditional rule takes that rule's
+     target (chains containing RETURN or goto rules are not inlined)
+   - chains not reachable from a built-in chain removed
+   - jumps in tail position (at the end of a chain, or followed by an
+     unconditional RETURN) converted to gotos, so the packet doesn't
+     return to the calling chain
+
+   optimized, report = optimize(tables)
+   print(report)
+   restore(optimized)
+
+   The rules that are rewritten are rendered with the profile passed to
+   optimize(), rules that are unchanged are the original rule objects.
+"""
+
+import re
+from collections import namedtuple, OrderedDict
+
+from pyptables.chains import BuiltinChain, UserChain
+from pyptables.parsing import tokenize, target, is_conditional
+from pyptables.profiles import get_profile, COMPACT
+from pyptables.rules.base import AbstractRule
+from pyptables.tables import Tables, Table
+
+
+JumpCount = namedtuple('JumpCount', 'jumps returns')
+JumpCount.__doc__ = """The worst case number of jumps a packet makes traversing a chain
+
+jumps   - jumps (and gotos) to user chains
+returns - returns to a calling chain (jumps, but not gotos, return)
+"""
+
+_COMMENT = re.compile(r'\s*(?:-m|--match)\s+comment\s+--comment\s+(?:"(?:[^"\\]|\\.)*"|\S+)')
+
+
+class OptimizedRule(AbstractRule):
+    """A rule rewritten by optimize(): rule definitions generated by
+    (and rewritten from) the original rule"""
+
+    def __init__(self, rule, definitions):
+        super(OptimizedRule, self).__init__(rule.comment)
+        self.rule = rule
+        self.definitions = list(definitions)
+        self.filename, self.lineno, self.function = rule.filename, rule.lineno, rule.function
+
+    def rule_definitions(self, profile=None):
+        """Return a list of individual iptables commands that implement this rule"""
+        return list(self.definitions)
+
+
+class _Definition(object):
+    """A rule definition, as a node of the chain graph"""
+    __slots__ = ('text', 'rule', 'target', 'goto', 'conditional', 'changed')
+
+    def __init__(self, text, rule, changed=False):
+        tokens = tokenize(text)
+        self.text = text
+        self.rule = rule
+        self.target, self.goto = target(tokens)
+        self.conditional = is_conditional(tokens)
+        self.changed = changed
+
+    def retarget(self, new_target, goto=False):
+        """Returns a copy of this definition with the target replaced"""
+        pattern = r'(?<!\S)(?:-j|--jump|-g|--goto)\s+%s(?!\S)' % re.escape(self.target)
+        replacement = '%s %s' % ('-g' if goto else '-j', new_target)
+        return _Definition(re.sub(pattern, lambda match: replacement, self.text, count=1), self.rule, True)
+
+    def is_return(self):
+        return self.target == 'RETURN' and not self.conditional
+
+
+class OptimizationReport(object):
+    """The result of optimize()"""
+
+    def __init__(self):
+        super(OptimizationReport, self).__init__()
+        self.removed_chains = []  # (table, chain, reason)
+        self.inlined = 0
+        self.gotos = 0
+        self.returns_removed = 0
+        self.jumps_removed = 0
+        self.rules_before = self.rules_after = 0
+        self.before = OrderedDict()  # (table, chain) -> JumpCount
+        self.after = OrderedDict()
+
+    def as_dict(self):
+        return {
+            'removed_chains': ["%s/%s: %s" % removed for removed in self.removed_chains],
+            'inlined': self.inlined,
+            'gotos': self.gotos,
+            'returns_removed': self.returns_removed,
+            'jumps_removed': self.jumps_removed,
+            'rules_before': self.rules_before,
+            'rules_after': self.rules_after,
+            'chains': dict(("/".join(name), {'before': before._asdict(), 'after': self.after[name]._asdict()})
+                           for name, before in self.before.items()),
+        }
+
+    def __str__(self):
+        lines = ["%-32s %15s %15s" % ('chain', 'jumps', 'returns')]
+        for name, before in self.before.items():
+            after = self.after[name]
+            if not before.jumps:
+                continue
+            lines.append("%-32s %6d -> %-6d %6d -> %-6d" % ("/".join(name), before.jumps, after.jumps,
+                                                           before.returns, after.returns))
+        lines.append("rules: %d -> %d, chains removed: %d, inlined: %d, gotos: %d, "
+                     "jumps removed: %d, returns removed: %d" % (
+                         self.rules_before,
+                         self.rules_after,
+                         len(self.removed_chains),
+                         self.inlined,
+                         self.gotos,
+                         self.jumps_removed,
+                         self.returns_removed,
+                     ))
+        return "\n".join(lines)
+
+
+class _TableOptimizer(object):
+    def __init__(self, table, profile, report, inline_limit, remove_unreferenced):
+        self.table = table
+        self.report = report
+        self.inline_limit = inline_limit
+        self.remove_unreferenced = remove_unreferenced
+        self.builtin = set()
+        self.chains = OrderedDict()
+        self.definition_counts = {}  # id(rule) -> number of rule definitions
+        for chain in table.values():
+            if chain._chain_definition().split()[1] != '-':
+                self.builtin.add(chain.name)
+            definitions = []
+            for rule in chain:
+                texts = rule.rule_definitions(profile)
+                self.definition_counts[id(rule)] = len(texts)
+                definitions.extend([_Definition(text, rule) for text in texts])
+            self.chains[chain.name] = definitions
+        report.rules_before += sum(len(definitions) for definitions in self.chains.values())
+
+    def _is_user_chain(self, name):
+        return name in self.chains and name not in self.builtin
+
+    def check_loops(self):
+        done = set()
+
+        def visit(name, stack):
+            if name in stack:
+                raise ValueError('chain loop: %s' % " -> ".join(stack[stack.index(name):] + (name,)))
+            if name in done:
+                return
+            for definition in self.chains[name]:
+                if self._is_user_chain(definition.target):
+                    visit(definition.target, stack + (name,))
+            done.add(name)
+        for name in self.chains:
+            visit(name, ())
+
+    def jump_counts(self):
+        counts = {}
+
+        def count(name):
+            if name not in counts:
+                jumps = returns = 0
+                for definition in self.chains[name]:
+                    if self._is_user_chain(definition.target):
+                        target_jumps, target_returns = count(definition.target)
+                        jumps += 1 + target_jumps
+                        returns += target_returns + (0 if definition.goto else 1)
+                        if definition.goto and not definition.conditional:
+                            break
+                    elif definition.target in ('ACCEPT', 'DROP', 'REJECT', 'RETURN') and not definition.conditional:
+                        break
+                counts[name] = JumpCount(jumps, returns)
+            return counts[name]
+        return OrderedDict(((self.table.name, name), count(name)) for name in self.chains if name in self.builtin)
+
+    def remove_returns(self):
+        changed = False
+        for name, definitions in self.chains.items():
+            while definitions and definitions[-1].is_return():
+                definitions.pop()
+                self.report.returns_removed += 1
+                changed = True
+        return changed
+
+    def remove_empty(self):
+        empty = set(name for name, definitions in self.chains.items()
+                    if not definitions and self._is_user_chain(name))
+        if not empty:
+            return False
+        for name, definitions in self.chains.items():
+            result = []
+            for definition in definitions:
+                if definition.target in empty:
+                    self.report.jumps_removed += 1
+                    if definition.goto:  # a goto to an empty chain returns
+                        result.append(definition.retarget('RETURN'))
+                    continue
+                result.append(definition)
+            definitions[:] = result
+        for name in empty:
+            self._remove(name, 'empty')
+        return True
+
+    def _inlinable(self, name):
+        return all(definition.target != 'RETURN' and not definition.goto
+                   for definition in self.chains[name])
+
+    def inline(self):
+        changed = False
+        for name, definitions in self.chains.items():
+            result = []
+            for definition in definitions:
+                callee = definition.target
+                if definition.goto or callee == name or not self._is_user_chain(callee) or \
+                        not self._inlinable(callee):
+                    result.append(definition)
+                    continue
+                callee_definitions = self.chains[callee]
+                if not definition.conditional and len(callee_definitions) <= self.inline_limit:
+                    result.extend(callee_definitions)
+                elif len(callee_definitions) == 1 and not callee_definitions[0].conditional:
+                    target_text = _COMMENT.sub('', callee_definitions[0].text).strip()
+                    pattern = r'(?<!\S)(?:-j|--jump)\s+%s(?!\S)' % re.escape(callee)
+                    text = re.sub(pattern, lambda match: target_text, definition.text, count=1)
+                    result.append(_Definition(text, definition.rule, True))
+                else:
+                    result.append(definition)
+                    continue
+                self.report.inlined += 1
+                changed = True
+            definitions[:] = result
+        return changed
+
+    def remove_unreachable(self):
+        reachable = set()
+        pending = list(self.builtin)
+        while pending:
+            name = pending.pop()
+            if name in reachable:
+                continue
+            reachable.add(name)
+            pending.extend(definition.target for definition in self.chains[name]
+                           if self._is_user_chain(definition.target))
+        unreachable = [name for name in self.chains if name not in reachable]
+        for name in unreachable:
+            self._remove(name, 'unreferenced')
+        return bool(unreachable)
+
+    def _remove(self, name, reason):
+        del self.chains[name]
+        self.report.removed_chains.append((self.table.name, name, reason))
+
+    def tail_gotos(self):
+        for name, definitions in self.chains.items():
+            for i, definition in enumerate(definitions):
+                if definition.goto or not self._is_user_chain(definition.target):
+                    continue
+                if i + 1 == len(definitions) or definitions[i + 1].is_return():
+                    definitions[i] = definition.retarget(definition.target, goto=True)
+                    self.report.gotos += 1
+
+    def optimize(self):
+        self.check_loops()
+        self.report.before.update(self.jump_counts())
+        changed = True
+        while changed:
+            changed = self.remove_returns()
+            changed = self.remove_empty() or changed
+            changed = self.inline() or changed
+            if self.remove_unreferenced:
+                changed = self.remove_unreachable() or changed
+        self.tail_gotos()
+        self.remove_returns()
+        self.report.after.update(self.jump_counts())
+        self.report.rules_after += sum(len(definitions) for definitions in self.chains.values())
+        return self._build()
+
+    def _rules(self, definitions):
+        """Group definitions into rules: the original rule if all of its
+        definitions are present and unchanged, otherwise an OptimizedRule"""
+        groups = []
+        for definition in definitions:
+            if groups and groups[-1][0] is definition.rule:
+                groups[-1][1].append(definition)
+            else:
+                groups.append((definition.rule, [definition]))
+        rules = []
+        for rule, group in groups:
+            if len(group) == self.definition_counts[id(rule)] and not any(definition.changed for definition in group):
+                rules.append(rule)
+            else:
+                rules.append(OptimizedRule(rule, [definition.text for definition in group]))
+        return rules
+
+    def _build(self):
+        chains = []
+        for name, definitions in self.chains.items():
+            original = self.table[name]
+            if name in self.builtin:
+                chain = BuiltinChain(name, original._chain_definition().split()[1], comment=original.comment)
+            else:
+                chain = UserChain(name, comment=original.comment)
+            chain.filename, chain.lineno, chain.function = original.filename, original.lineno, original.function
+            chain.extend(self._rules(definitions))
+            chains.append(chain)
+        table = Table(self.table.name, *chains)
+        table.filename, table.lineno, table.function = self.table.filename, self.table.lineno, self.table.function
+        return table
+
+
+def optimize(tables, profile=COMPACT, inline_limit=1, remove_unreferenced=True):
+    """Optimize the chain graph of tables, see module documentation.
+
+    tables              - the Tables object (which is not modified)
+    profile             - the Profile used to render the rules that are rewritten
+    inline_limit        - the maximum number of rules of a chain inlined in
+                          place of an unconditional jump
+    remove_unreferenced - remove chains that are not reachable from a
+                          built-in chain (disable if chains are jumped to
+                          by rules added outside of PyPTables)
+
+    Raises ValueError if a chain loop is found.
+
+    Returns a tuple (Tables, OptimizationReport)
+    """
+    profile = get_profile(profile)
+    report = OptimizationReport()
+    optimized = Tables(*[_TableOptimizer(table, profile, report, inline_limit, remove_unreferenced).optimize()
+                         for table in tables.values()])
+    optimized.filename, optimized.lineno, optimized.function = tables.filename, tables.lineno, tables.function
+    return optimized, report
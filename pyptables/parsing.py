@@ -0,0 +1,130 @@
+"""This module contains utility functions for parsing generated
+   iptables rule definitions, used by the analysis tools.
+"""
+
+import re
+
+# options which select the packets a rule applies to (as opposed to
+# target options), mapped to their preferred short name
+MATCH_OPTIONS = {
+    '-s': '-s', '--source': '-s', '--src': '-s',
+    '-d': '-d', '--destination': '-d', '--dst': '-d',
+    '-i': '-i', '--in-interface': '-i',
+    '-o': '-o', '--out-interface': '-o',
+    '-p': '-p', '--proto': '-p', '--protocol': '-p',
+    '-f': '-f', '--fragment': '-f',
+}
+
+JUMP_OPTIONS = ('-j', '--jump')
+GOTO_OPTIONS = ('-g', '--goto')
+MATCH_MODULE_OPTIONS = ('-m', '--match')
+
+# targets that end the traversal of the ruleset (or of the chain, for RETURN);
+# CT (like NOTRACK, MARK, LOG, ...) continues with the next rule
+TERMINAL_TARGETS = frozenset(['ACCEPT', 'DROP', 'REJECT', 'RETURN', 'QUEUE', 'NFQUEUE',
+                              'DNAT', 'SNAT', 'MASQUERADE', 'REDIRECT'])
+
+
+# a token: unquoted characters, backslash escapes and double quoted
+# strings (an unterminated quote runs to the end of the line)
+_TOKEN = re.compile(r'(?:[^\s"\\]+|\\.?|"(?:[^"\\]|\\.?)*"?)+', re.S)
+_UNQUOTE = re.compile(r'\\(.?)|"', re.S)
+_COMMENT = re.compile(r'--comment\s+("(?:[^"\\]|\\.)*"|\S+)', re.S)
+
+
+def _unquote(match):
+    return match.group(1) or ''
+
+
+def tokenize(line):
+    """Split a rule definition into tokens, handling double quoted
+    values (with backslash escapes) as generated by PyPTables
+    """
+    if '"' not in line:
+        return line.split()
+    parts = line.split('"')
+    if '\\' in line or not len(parts) % 2:
+        return [_UNQUOTE.sub(_unquote, token) if '"' in token or '\\' in token else token
+                for token in _TOKEN.findall(line)]
+    # balanced quotes without escapes: odd parts are quoted
+    tokens = []
+    joined = False  # the last token continues into the next part
+    for i, part in enumerate(parts):
+        if i % 2:
+            if joined:
+                tokens[-1] += part
+            else:
+                tokens.append(part)
+            joined = True
+        elif part:
+            words = part.split()
+            if joined and words and not part[0].isspace():
+                tokens[-1] += words.pop(0)
+            tokens.extend(words)
+            joined = not part[-1].isspace()
+    return tokens
+
+
+def comment(line):
+    """Returns the (unquoted) comment of a rule definition, or None,
+    without tokenizing the whole line
+    """
+    if '--comment' not in line:
+        return None
+    match = _COMMENT.search(line)
+    if match is None:
+        return None
+    value = match.group(1)
+    if '\\' not in value and len(value) > 1 and value[0] == value[-1] == '"':
+        return value[1:-1]
+    return _UNQUOTE.sub(_unquote, value) if '"' in value or '\\' in value else value
+
+
+def options(tokens):
+    """Group tokens into a list of (inverse, option, [values]) tuples"""
+    result = []
+    inverse = False
+    current = None
+    for token in tokens:
+        if token == '!':
+            inverse = True
+        elif token.startswith('-') and len(token) > 1 and not token[1].isdigit():
+            current = (inverse, token, [])
+            result.append(current)
+            inverse = False
+        elif current is not None:
+            current[2].append(token)
+    return result
+
+
+def target(tokens):
+    """Returns (target, is_goto) for a tokenized rule, or (None, False)"""
+    for i, token in enumerate(tokens[:-1]):
+        if token in JUMP_OPTIONS:
+            return tokens[i + 1], False
+        if token in GOTO_OPTIONS:
+            return tokens[i + 1], True
+    return None, False
+
+
+def is_conditional(tokens):
+    """Returns True if a tokenized rule has any match criteria (other than a comment)"""
+    parsed = options(tokens)
+    for inverse, option, values in parsed:
+        if option in MATCH_OPTIONS:
+            return True
+        if option in MATCH_MODULE_OPTIONS and values and values[0] != 'comment':
+            return True
+    return False
+
+
+def kernel_rule_count(tokens):
+    """Returns the number of kernel rules a rule definition expands to
+    (iptables creates a rule for each combination of comma separated
+    source and destination addresses)
+    """
+    count = 1
+    for inverse, option, values in options(tokens):
+        if MATCH_OPTIONS.get(option) in ('-s', '-d') and values:
+            count *= values[0].count(',') + 1
+    return count
@@ -0,0 +1,66 @@
+"""This module contains the rendering profiles.
+
+   A profile controls how much annotation is included when
+   rendering Tables into iptables-restore format.
+"""
+
+
+class Profile(object):
+    """Describes how much annotation to include in generated output"""
+
+    # true if kernel_comment() records the comments it is given, so it
+    # must see the comment of every rule (see pyptables.comments)
+    records_comments = False
+
+    def __init__(self, name, headers=True, comments=True, canonical=False):
+        """Creates a Profile
+
+        name      - profile name
+        headers   - if true, "#" comment lines (table marquees, chain
+                    and rule headers) are included in the output
+        comments  - if true, rule comments are attached to the rules
+                    in the kernel with "-m comment"
+        canonical - if true, rules are rendered in the form iptables-save
+                    lists them in (see pyptables.canonical)
+        """
+        super(Profile, self).__init__()
+        self.name = name
+        self.headers = headers
+        self.comments = comments
+        self.canonical = canonical
+
+    def kernel_comment(self, comment, rule=None):
+        """Returns the comment to attach to a rule in the kernel, or None
+
+        comment - the comment of the rule
+        rule    - the rule (or None)
+        """
+        if self.comments:
+            return comment
+        return None
+
+    def __repr__(self):
+        return "<Profile: %s>" % self.name
+
+
+VERBOSE = Profile('verbose')
+COMPACT = Profile('compact', headers=False)
+MINIMAL = Profile('minimal', headers=False, comments=False)
+CANONICAL = Profile('canonical', headers=False, canonical=True)
+
+PROFILES = dict((profile.name, profile) for profile in (VERBOSE, COMPACT, MINIMAL, CANONICAL))
+
+
+def get_profile(profile=None):
+    """Returns a Profile, given a Profile, a profile name or None (verbose)"""
+    if profile is None:
+        return VERBOSE
+    if isinstance(profile, Profile):
+        return profile
+    try:
+        return PROFILES[profile]
+    except KeyError:
+        raise ValueError('unknown profile "%s", must be one of: %s' % (
+            profile,
+            ", ".join(sorted(PROFILES)),
+        ))
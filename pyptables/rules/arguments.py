@@ -219,7 +219,8 @@ class ArgumentList(object):
     def _update_args(self, args, kwargs):
         args, kwargs = list(args), dict(kwargs)  # don't modify passed data
         for arglist in args:
-            arglist.known_args.extend(self.known_args)
+            # arglists (e.g. channels) are shared by many rules, only add the known args once
+            arglist.known_args.extend([arg for arg in self.known_args if arg not in arglist.known_args])
         args.extend(self.args)
         kwargs.update(self.kwargs)
         return args, kwargs
@@ -256,6 +257,14 @@ class ArgumentList(object):
         """Return arguments in iptables format, suitable for use in an iptables format rule""" 
         return " ".join([arg.to_iptables() for arg in self])
     
+    def to_canonical(self):
+        """Return the arguments in the form iptables-save lists them in, a list
+        with an entry for each combination of comma separated addresses
+        (see pyptables.canonical)
+        """
+        from pyptables.canonical import normalize
+        return normalize(self.to_iptables())
+    
     def __str__(self):
         return str(self.to_iptables())
     
@@ -1,6 +1,7 @@
 import itertools
 
 from pyptables.base import DebugObject
+from pyptables.profiles import get_profile
 
 from pyptables.rules.arguments import UnboundArgument, ArgumentList
 from pyptables.rules.matches import Match
@@ -13,13 +14,32 @@ class AbstractRule(DebugObject):
         super(AbstractRule, self).__init__()
         self.comment = comment
         
-    def to_iptables(self, prefix=''):
-        """Return rule in iptables format, suitable for use with iptables-restore"""
+    def to_iptables(self, prefix='', profile=None):
+        """Return rule in iptables format, suitable for use with iptables-restore
+        
+        profile - a Profile (or profile name) controlling the amount of
+                  annotation in the output (default: verbose)
+        """
+        return "\n".join(self.iter_iptables(prefix=prefix, profile=profile))
+    
+    def iter_iptables(self, prefix='', profile=None):
+        """Yield the lines of this rule in iptables format, as they are generated"""
         try: 
-            return '%(header)s\n%(rules)s' % {
-                'header': self._header(),
-                'rules': self._rule_definition(prefix),
-                }
+            profile = get_profile(profile)
+            if prefix:
+                prefix += ' '
+            if profile.headers:
+                yield self._header()
+            definitions = self.iter_definitions(profile)
+            if profile.canonical:
+                from pyptables.canonical import iter_normalized
+                definitions = iter_normalized(definitions)
+            empty = True
+            for rule in definitions:
+                empty = False
+                yield '%s%s' % (prefix, rule)
+            if empty and profile.headers:
+                yield ''
         except Exception as e:  # pragma: no cover
             e.iptables_path = getattr(e, 'iptables_path', [])
             e.iptables_path.insert(0, "Rule:\n    created: %s\n    comment: %s" % (self.debug_info(), self.comment))
@@ -31,15 +51,28 @@ class AbstractRule(DebugObject):
                     'debug': self.debug_info(),
                     }
     
-    def _rule_definition(self, prefix):
-        if prefix:
-            prefix += ' '
-        return "\n".join(['%s%s' % (prefix, rule) for rule in self.rule_definitions()])
+    def rule_definitions(self, profile=None):
+        """Return a list of individual iptables commands that implement this rule
         
-    def rule_definitions(self):
-        """Return a list of individual iptables commands that implement this rule"""
+        profile - a Profile (or profile name) controlling whether
+                  comments are included (default: verbose)
+        """
         raise NotImplementedError()  # pragma: no cover
     
+    def iter_definitions(self, profile=None):
+        """Yield the individual iptables commands that implement this rule,
+        as they are generated (subclasses expanding to many commands
+        generate them lazily, rather than building a list)
+        """
+        return iter(self.rule_definitions(profile))
+    
+    def canonical_definitions(self, profile=None):
+        """Return the list of the iptables commands that implement this rule,
+        in the form iptables-save lists them in (see pyptables.canonical)
+        """
+        from pyptables.canonical import iter_normalized
+        return list(iter_normalized(self.iter_definitions(profile)))
+    
     def __repr__(self):
         return "<%s: %s>" % (self.__class__.__name__, self.rule_definitions())
 
@@ -50,12 +83,13 @@ class CustomRule(AbstractRule):
         super(CustomRule, self).__init__(comment)
         self.rule = rule
     
-    def rule_definitions(self):
+    def rule_definitions(self, profile=None):
         """Return a list of individual iptables commands that implement this rule"""
-        if self.comment:
+        comment = get_profile(profile).kernel_comment(self.comment, self)
+        if comment:
             return ['%s -m comment --comment "%s"' % (
                         self.rule,
-                        self.comment.replace('"', '\\"'),
+                        comment.replace('"', '\\"'),
                         )]
         return [self.rule]
 
@@ -115,11 +149,12 @@ class Rule(AbstractRule):
         rule.arguments = self.arguments(args=args, **kwargs)
         return rule
     
-    def rule_definitions(self):
+    def rule_definitions(self, profile=None):
         """Return a list of individual iptables commands that implement this rule"""
         arguments = list(self.arguments)
-        if self.comment:
-            arguments.append(Match('comment', comment=self.comment))
+        comment = get_profile(profile).kernel_comment(self.comment, self)
+        if comment:
+            arguments.append(Match('comment', comment=comment))
         return [" ".join([arg.to_iptables() for arg in arguments])]
 
 
@@ -129,6 +164,10 @@ class CompositeRule(AbstractRule):
         super(CompositeRule, self).__init__(comment)
         self._rules = rules
     
-    def rule_definitions(self):
+    def rule_definitions(self, profile=None):
         """Return a list of individual iptables commands that implement this rule"""
-        return itertools.chain(*(rule.rule_definitions() for rule in self._rules))
+        return list(self.iter_definitions(profile))
+    
+    def iter_definitions(self, profile=None):
+        """Yield the individual iptables commands that implement this rule"""
+        return itertools.chain.from_iterable(rule.iter_definitions(profile) for rule in self._rules)
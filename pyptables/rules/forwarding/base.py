@@ -1,3 +1,4 @@
+from pyptables.base import debug_source
 from pyptables.rules import Accept, Drop, AbstractRule, Rule, Reject
 
 
@@ -7,7 +8,8 @@ class ForwardingRule(AbstractRule):
     """
     
     def __init__(self, policy, sources, destinations, channels=(), log=False,
-                 log_id=None, log_cls=None, comment=None, args=None):
+                 log_id=None, log_cls=None, comment=None, args=None, limits=(), limit_first=False,
+                 log_chains=None):
         """Creates a ForwardingRule
            
         policy       - the action to take (ACCEPT, DROP, REJECT, etc.) on matching the rule
@@ -17,6 +19,14 @@ class ForwardingRule(AbstractRule):
         log          - boolean indicated if "hits" on this rule should be logged
         comment      - a comment for the rule
         args         - list of ArgumentLists of additional arguments to match
+        limits       - LimitChannels (or other ArgumentLists) that every
+                       generated rule must also match
+        limit_first  - check the limits before the other matches, so that
+                       packets over the limit skip them. Note: the limits
+                       then count every packet, not only matching packets
+        log_chains   - LogChains: if log is set, jump to the shared
+                       log-and-verdict chain for the policy, rather than
+                       generating a log rule and a verdict rule
         """
         super(ForwardingRule, self).__init__(comment)
         self.policy = policy
@@ -27,15 +37,34 @@ class ForwardingRule(AbstractRule):
         self.log_id = log_id
         self.log_cls = log_cls
         self.args = args
+        self.limits = list(limits)
+        self.limit_first = limit_first
+        self.log_chains = log_chains
     
-    def rule_definitions(self):
+    def rule_definitions(self, profile=None):
         """Generate the iptables rules for this rule"""
-        result = []
-        for rule in self._rules():
-            result.extend(rule.rule_definitions())
-        return result
+        return list(self.iter_definitions(profile))
+    
+    def iter_definitions(self, profile=None):
+        """Yield the iptables rules for this rule, as they are generated: the
+        derived rules are created one at a time (see _rules()), so memory
+        use doesn't depend on the number of rules generated. The derived
+        rules are created with the debug info of this rule.
+        """
+        with debug_source(self.filename, self.lineno, self.function):
+            rules = self._rules()
+        while True:
+            with debug_source(self.filename, self.lineno, self.function):
+                rule = next(rules, None)
+            if rule is None:
+                break
+            for definition in rule.rule_definitions(profile):
+                yield definition
     
     def _base_rules(self):
+        if self.log and self.log_chains is not None:
+            return [Rule(jump=self.log_chains.chain(self.policy).name, comment=self.comment)]
+        
         rules = []
         if self.log:
             rules.append(self.log_cls(prefix='FWD %s %s' % (self.log_id, self.policy.upper()[0]),
@@ -61,71 +90,79 @@ class ForwardingRule(AbstractRule):
         return rules
     
     def _rules(self):
-        rules = self._base_rules()
+        """Returns an iterator of the derived rules: each stage lazily derives
+        rules from the rules of the previous stage, so only one rule per
+        stage exists at a time"""
+        rules = iter(self._base_rules())
+        if not self.limit_first:
+            rules = self._add_limits(rules)
         rules = self._add_routes(rules)
         rules = self._add_channels(rules)
         rules = self._add_args(rules)
+        if self.limit_first:
+            rules = self._add_limits(rules)  # arguments added last are rendered first
         return rules
     
     def _add_routes(self, rules):
         if not (self.sources or self.destinations):
             return rules
-        
-        result = []
+        return self._routes(rules)
+    
+    def _routes(self, rules):
         for rule in rules:
             if not self.sources:
                 for destination in self.destinations:
-                    result.append(rule(
+                    yield rule(
                         args=(destination.as_output(),),
                         comment="%s: route any -> %s" % (
                             rule.comment,
                             destination,
                         ),
-                    ))
+                    )
             elif not self.destinations:
                 for source in self.sources:
-                    result.append(rule(
+                    yield rule(
                         args=(source.as_input(),),
                         comment="%s: route %s -> any" % (
                             rule.comment,
                             source,
                         ),
-                    ))
+                    )
             else:
                 for source in self.sources:
                     for destination in self.destinations:
-                        result.append(rule(
+                        yield rule(
                             args=(source.as_input(), destination.as_output()),
                             comment="%s: route %s -> %s" % (
                                rule.comment,
                                source,
                                destination,
                             ),
-                        ))
-        return result
+                        )
     
     def _add_channels(self, rules):
         if not self.channels:
             return rules
-        result = []
-        for rule in rules:
-            for channel in self.channels:
-                result.append(rule(
-                    args=[channel],
-                    comment="%s, channel %s" % (rule.comment, channel),
-                ))
-        return result
+        return (rule(args=[channel], comment="%s, channel %s" % (rule.comment, channel))
+                for rule in rules
+                for channel in self.channels)
 
+    def _add_limits(self, rules):
+        if not self.limits:
+            return rules
+        return (rule(args=self.limits,
+                     comment="%s, limit %s" % (
+                         rule.comment,
+                         ", ".join(map(str, self.limits)),
+                     ))
+                for rule in rules)
+    
     def _add_args(self, rules):
         if not self.args:
             return rules
-        result = []
-        for rule in rules:
-            result.append(rule(
-                args=self.args,
-                comment="%s, plus %s" % (
-                    rule.comment,
-                    ", ".join(map(str, self.args)),
-                ),
-            ))
-        return result
+        return (rule(args=self.args,
+                     comment="%s, plus %s" % (
+                         rule.comment,
+                         ", ".join(map(str, self.args)),
+                     ))
+                for rule in rules)
@@ -3,6 +3,8 @@
    a L2 protocol (or above).
 """
 
+import zlib
+
 from pyptables.rules.arguments import ArgumentList, UnboundArgument
 from pyptables.rules.matches import Match
 
@@ -99,4 +101,127 @@ class ICMPChannel(StatefulChannel):
         return "%s, type %s" % (super(ICMPChannel, self).__str__(), icmp_type)
 
 
-__all__ = [Channel, StatefulChannel, PortChannel, TCPChannel, UDPChannel, ICMPChannel]
+class LimitChannel(Channel):
+    """A Channel that matches on a connection or packet rate limit,
+    optionally restricted to a protocol"""
+    
+    def __init__(self, args=None, **kwargs):
+        super(LimitChannel, self).__init__(args=args or [], **kwargs)
+    
+    def _proto_str(self):
+        if 'p' in self:
+            return "%s, " % super(LimitChannel, self).__str__()
+        return ''
+
+
+class HashLimitChannel(LimitChannel):
+    """A LimitChannel limiting the packet rate per source and/or
+    destination (hashlimit match).
+    
+    With above=False (the default) the channel matches packets up to the
+    rate (use with ACCEPT), with above=True it matches packets over the
+    rate (use with DROP).
+    """
+    
+    def __init__(self, rate, mode='srcip', above=False, burst=None, expire=None, size=None,
+                 srcmask=None, dstmask=None, name=None, args=None, **kwargs):
+        """Creates a HashLimitChannel
+        
+           rate    - the rate, e.g. "10/second", "100/minute"
+           mode    - the bucket key, comma separated list of srcip,
+                     srcport, dstip and dstport (default: srcip)
+           above   - match packets over the rate, rather than up to it
+           burst   - the maximum burst
+           expire  - milliseconds after which idle buckets expire
+           size    - the number of buckets in the hash table
+           srcmask - prefix length of the source addresses (buckets per subnet)
+           dstmask - prefix length of the destination addresses
+           name    - the name of the hash table (/proc/net/ipt_hashlimit/<name>),
+                     derived from the limit if not specified. Rules with
+                     the same name share buckets.
+        """
+        limit_args = {
+            'hashlimit_above' if above else 'hashlimit_upto': rate,
+            'hashlimit_mode': mode,
+        }
+        if burst is not None:
+            limit_args['hashlimit_burst'] = str(burst)
+        if expire is not None:
+            limit_args['hashlimit_htable_expire'] = str(expire)
+        if size is not None:
+            limit_args['hashlimit_htable_size'] = str(size)
+        if srcmask is not None:
+            limit_args['hashlimit_srcmask'] = str(srcmask)
+        if dstmask is not None:
+            limit_args['hashlimit_dstmask'] = str(dstmask)
+        args = list(args or [])
+        if name is None:
+            # every option (and any extra match) is part of the key, so
+            # only identical limits share a hash table
+            key = " ".join(["%s=%s" % item for item in sorted(limit_args.items())] +
+                           [arg.to_iptables() for arg in args])
+            name = 'hl_%08x' % (zlib.crc32(key.encode('utf-8')) & 0xffffffff)
+        limit_args['hashlimit_name'] = name
+        args.append(Match('hashlimit', **limit_args))
+        super(HashLimitChannel, self).__init__(args=args, **kwargs)
+        self.rate = rate
+        self.mode = mode
+        self.above = above
+        self.burst = burst
+        self.name = name
+    
+    def __str__(self):
+        result = "%srate %s %s per %s" % (self._proto_str(),
+                                          'above' if self.above else 'up to',
+                                          self.rate,
+                                          self.mode)
+        if self.burst is not None:
+            result += " (burst %s)" % self.burst
+        return result
+
+
+class ConnLimitChannel(LimitChannel):
+    """A LimitChannel limiting the number of concurrent connections per
+    source or destination address (or subnet) (connlimit match).
+    
+    With above (use with DROP or REJECT) the channel matches connections
+    over the limit, with upto (use with ACCEPT) it matches connections up
+    to the limit.
+    """
+    
+    def __init__(self, above=None, upto=None, mask=None, daddr=False, args=None, **kwargs):
+        """Creates a ConnLimitChannel
+        
+           above - match if there are more than this many connections
+           upto  - match if there are this many connections or fewer
+           mask  - prefix length grouping addresses (default: 32, per address)
+           daddr - count connections per destination, rather than per source
+        """
+        if (above is None) == (upto is None):
+            raise ValueError('exactly one of above and upto must be specified')
+        limit_args = {}
+        if above is not None:
+            limit_args['connlimit_above'] = str(above)
+        else:
+            limit_args['connlimit_upto'] = str(upto)
+        if mask is not None:
+            limit_args['connlimit_mask'] = str(mask)
+        limit_args['connlimit_daddr' if daddr else 'connlimit_saddr'] = None
+        args = list(args or [])
+        args.append(Match('connlimit', **limit_args))
+        super(ConnLimitChannel, self).__init__(args=args, **kwargs)
+        self.above = above
+        self.upto = upto
+        self.mask = mask
+        self.daddr = daddr
+    
+    def __str__(self):
+        return "%sconnections %s %s per %s%s" % (self._proto_str(),
+                                                 'above' if self.above is not None else 'up to',
+                                                 self.above if self.above is not None else self.upto,
+                                                 'destination' if self.daddr else 'source',
+                                                 '/%s' % self.mask if self.mask is not None else '')
+
+
+__all__ = ['Channel', 'StatefulChannel', 'PortChannel', 'TCPChannel', 'UDPChannel', 'ICMPChannel',
+           'LimitChannel', 'HashLimitChannel', 'ConnLimitChannel']
@@ -1,37 +1,363 @@
 """This module contains the IPSet class.
-   
-   IPSet represent an ipset.
+
+   IPSet represent an ipset.  An IPSet created with only a name is
+   managed elsewhere, and is only used in "-m set" matches.  An IPSet
+   created with a type also holds the options and members of the set,
+   and generates the "ipset restore" scripts creating and updating it:
+
+   blocklist = IPSet('blocklist', 'hash:net', timeout=86400)
+   blocklist.update(load_blocklist())
+   ipset_restore(blocklist.update_script(previous=IPSet.from_save(saved)['blocklist']))
+
+   A set is updated atomically by filling a temporary set and swapping
+   it with the set (see swap_script()), or, when only a few members
+   changed, by deleting and adding those members (see diff_script()).
 """
 
+import subprocess
+from collections import OrderedDict
+
 from pyptables.base import DebugObject
 from pyptables.rules.matches import Match
 
 
+SET_TYPES = (
+    'bitmap:ip', 'bitmap:ip,mac', 'bitmap:port',
+    'hash:ip', 'hash:mac', 'hash:ip,mac', 'hash:net', 'hash:net,net', 'hash:ip,port', 'hash:net,port',
+    'hash:ip,port,ip', 'hash:ip,port,net', 'hash:ip,mark', 'hash:net,port,net', 'hash:net,iface',
+    'list:set',
+)
+FAMILIES = ('inet', 'inet6')
+MAX_SET_NAME = 31
+DEFAULT_MAXELEM = 65536
+
+
+_VALUE_OPTIONS = frozenset(['family', 'hashsize', 'maxelem', 'timeout', 'range', 'netmask', 'markmask', 'size',
+                            'bucketsize', 'initval', 'packets', 'bytes', 'comment', 'skbmark', 'skbprio',
+                            'skbqueue'])
+
+
+def _options(words):
+    """Returns a dictionary of the options of an ipset save command (flags have a value of None)"""
+    options = {}
+    words = iter(words)
+    for word in words:
+        options[word] = next(words, None) if word in _VALUE_OPTIONS else None
+    return options
+
+
+def _int_option(options, option):
+    value = options.get(option)
+    return int(value) if value is not None else None
+
+
 class IPSet(DebugObject):
     """Represents a linux ipset"""
-    
-    def __init__(self, name):
+
+    def __init__(self, name, set_type=None, family='inet', members=(), hashsize=None, maxelem=None,
+                 timeout=None, range=None):
         """Creates an ipset
-        
-        name - ipset name
+
+        name     - ipset name
+        set_type - the type of the set (hash:ip, hash:net, hash:ip,port,
+                   bitmap:port, etc., see SET_TYPES), or None if the set
+                   is managed elsewhere
+        family   - inet or inet6 (hash types only)
+        members  - the initial members of the set
+        hashsize - the initial hash size (hash types only)
+        maxelem  - the maximum number of members (hash types only),
+                   defaults to 65536, or the power of two above twice
+                   the number of members
+        timeout  - the default timeout of the members, in seconds
+                   (members can only be given a timeout if this is set,
+                   0 means no timeout by default)
+        range    - the range of the set (bitmap types only, required),
+                   e.g. 192.168.0.0/16 or 1024-65535
         """
         super(IPSet, self).__init__()
         self.name = name
-    
+        if set_type is not None:
+            if set_type not in SET_TYPES:
+                raise ValueError('unknown set type %s' % set_type)
+            if family not in FAMILIES:
+                raise ValueError('unknown set family %s' % family)
+            if set_type.startswith('bitmap:') and range is None:
+                raise ValueError('%s sets require a range' % set_type)
+        self.set_type = set_type
+        self.family = family
+        self.hashsize = hashsize
+        self.maxelem = maxelem
+        self.timeout = timeout
+        self.range = range
+        self._members = OrderedDict()
+        self.update(members)
+
+    @property
+    def dimensions(self):
+        """The number of values of each member (e.g. 2 for hash:ip,port)"""
+        if self.set_type is None:
+            return 1
+        return len(self.set_type.split(':')[1].split(','))
+
+    def _flags(self, direction):
+        return ",".join([direction] * self.dimensions)
+
     def as_input(self):
         """Return iptables ArgumentLists for this ipset
         for matching against packet sources
         """
-        return Match('set', match_set=[self.name, 'src'])
-    
+        return Match('set', match_set=[self.name, self._flags('src')])
+
     def as_output(self):
         """Return iptables ArgumentLists for this ipset
         for matching against packet destinations
         """
-        return Match('set', match_set=[self.name, 'dst'])
+        return Match('set', match_set=[self.name, self._flags('dst')])
+
+    def _managed(self):
+        if self.set_type is None:
+            raise ValueError('ipset %s has no type, it is managed elsewhere' % self.name)
+
+    def _normalize(self, member):
+        """Returns member as listed by ipset save"""
+        self._managed()
+        member = str(member).strip()
+        values = member.split(',')
+        if len(values) != self.dimensions:
+            raise ValueError('invalid member %s of %s set %s' % (member, self.set_type, self.name))
+        kinds = self.set_type.split(':')[1].split(',')
+        for i, (kind, value) in enumerate(zip(kinds, values)):
+            if kind == 'port' and self.set_type.startswith('hash:') and ':' not in value:
+                values[i] = 'tcp:%s' % value
+            elif kind == 'net' and self.family == 'inet' and value.endswith('/32'):
+                values[i] = value[:-3]
+            elif kind == 'net' and self.family == 'inet6' and value.endswith('/128'):
+                values[i] = value[:-4]
+            elif kind == 'mac':
+                values[i] = value.upper()
+        return ",".join(values)
+
+    def add(self, member, timeout=None):
+        """Add a member (with a timeout, in seconds, if the set has a timeout)"""
+        self._managed()
+        if timeout is not None and self.timeout is None:
+            raise ValueError('ipset %s has no timeout, members cannot have one' % self.name)
+        self._members[self._normalize(member)] = timeout
+
+    def update(self, members):
+        """Add a number of members (an iterable of members, or a mapping of member -> timeout)"""
+        if hasattr(members, 'items'):
+            members = members.items()
+        else:
+            members = ((member, None) for member in members)
+        for member, timeout in members:
+            self.add(member, timeout)
+
+    def remove(self, member):
+        """Remove a member"""
+        self._managed()
+        del self._members[self._normalize(member)]
+
+    def __contains__(self, member):
+        return self._normalize(member) in self._members
+
+    def __iter__(self):
+        return iter(self._members)
+
+    def __len__(self):
+        return len(self._members)
+
+    def timeout_of(self, member):
+        """Returns the timeout of a member, or None if it has the default timeout"""
+        return self._members[self._normalize(member)]
+
+    def _default_maxelem(self):
+        """Returns the smallest power of two at least twice the number of members, and DEFAULT_MAXELEM"""
+        maxelem = DEFAULT_MAXELEM
+        while maxelem < 2 * len(self):
+            maxelem *= 2
+        return maxelem
+
+    def _options(self):
+        options = []
+        if self.set_type.startswith('hash:'):
+            options.extend(['family', self.family])
+            if self.hashsize is not None:
+                options.extend(['hashsize', str(self.hashsize)])
+            options.extend(['maxelem', str(self.maxelem or self._default_maxelem())])
+        if self.range is not None:
+            options.extend(['range', str(self.range)])
+        if self.timeout is not None:
+            options.extend(['timeout', str(self.timeout)])
+        return options
+
+    def create_line(self, name=None, exist=True):
+        """Returns the ipset restore command creating the set
+
+        name  - the name of the set created (defaults to the name of this set)
+        exist - if true, the command doesn't fail if the set exists
+        """
+        self._managed()
+        name = name or self.name
+        if len(name) > MAX_SET_NAME:
+            raise ValueError('ipset name %s is longer than %d characters' % (name, MAX_SET_NAME))
+        return " ".join(['create', name, self.set_type] + self._options() + (['-exist'] if exist else []))
+
+    def add_line(self, member, name=None, exist=False):
+        """Returns the ipset restore command adding member (see create_line())"""
+        timeout = self._members.get(member)
+        return " ".join(['add', name or self.name, member] +
+                        (['timeout', str(timeout)] if timeout is not None else []) +
+                        (['-exist'] if exist else []))
+
+    def restore_script(self, previous=None):
+        """Returns the ipset restore script creating the set (if necessary)
+        and replacing its members, in place (the set is empty while the
+        script is restored, see swap_script())
+
+        previous - the set currently in the kernel (e.g. from from_save()),
+                   if known: the set is then only flushed, not created.
+                   The options of a set can't be changed in place, use
+                   swap_script() if they differ.
+        """
+        if previous is None:
+            lines = [self.create_line()]
+        elif not self._compatible(previous):
+            raise ValueError('the options of ipset %s changed, it must be swapped (see swap_script())' % self.name)
+        else:
+            lines = []
+        lines.append('flush %s' % self.name)
+        lines.extend(self.add_line(member) for member in self._members)
+        return "\n".join(lines) + "\n"
+
+    def temporary_name(self):
+        """Returns the name of the temporary set used by swap_script()"""
+        return '%s-tmp' % self.name[:MAX_SET_NAME - 4]
+
+    def swap_script(self, temporary=None, previous=None):
+        """Returns the ipset restore script replacing the members of the set
+        atomically: the members are added to a temporary set, which is
+        swapped with the set, and destroyed.  The swap also gives the set
+        the options of this set (e.g. a larger maxelem).
+
+        temporary - the name of the temporary set (see temporary_name())
+        previous  - the set currently in the kernel (e.g. from from_save()),
+                    or None if the set may not exist: it is then created
+                    (empty, so the swap can take place), which fails if
+                    it exists with other options
+        """
+        temporary = temporary or self.temporary_name()
+        if previous is not None and (previous.set_type, previous.family) != (self.set_type, self.family):
+            raise ValueError('ipset %s changed from %s %s to %s %s, it can not be swapped' % (
+                self.name, previous.set_type, previous.family, self.set_type, self.family))
+        lines = [self.create_line(temporary), 'flush %s' % temporary]
+        lines.extend(self.add_line(member, temporary) for member in self._members)
+        if previous is None:
+            lines.append(self.create_line())
+        lines.extend(['swap %s %s' % (temporary, self.name), 'destroy %s' % temporary])
+        return "\n".join(lines) + "\n"
+
+    def diff(self, previous):
+        """Returns (added, removed), the lists of the members of this set not
+        in previous, and of the members of previous not in this set
+
+        previous - the previous IPSet (e.g. from from_save()), or an
+                   iterable of its members
+        """
+        self._managed()
+        if isinstance(previous, IPSet):
+            if previous.set_type not in (None, self.set_type):
+                raise ValueError('ipset %s changed type from %s to %s' % (self.name, previous.set_type,
+                                                                          self.set_type))
+            previous = previous._members
+        else:
+            previous = OrderedDict((self._normalize(member), None) for member in previous)
+        added = [member for member in self._members if member not in previous]
+        removed = [member for member in previous if member not in self._members]
+        return added, removed
+
+    def diff_script(self, previous):
+        """Returns the ipset restore script deleting the removed members and
+        adding the new members of the set, since previous (see diff()).
+        Members in both keep their current timeouts.
+        """
+        added, removed = self.diff(previous)
+        lines = ['del %s %s -exist' % (self.name, member) for member in removed]
+        lines.extend(self.add_line(member, exist=True) for member in added)
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def _compatible(self, previous):
+        """Returns true if the options of previous are those of this set
+        (the hash size is ignored, it grows as needed, and the default
+        maximum number of members only needs to be large enough)"""
+        if (previous.set_type, previous.family, previous.timeout, previous.range) != (
+                self.set_type, self.family, self.timeout, self.range):
+            return False
+        if not self.set_type.startswith('hash:'):
+            return True
+        if self.maxelem is not None:
+            return previous.maxelem == self.maxelem
+        return (previous.maxelem or DEFAULT_MAXELEM) >= 2 * len(self)
+
+    def update_script(self, previous=None, max_changes=None):
+        """Returns the ipset restore script updating the set from previous:
+        a diff_script() if the options of the set haven't changed and at
+        most max_changes members were added or removed, otherwise a
+        swap_script()
+
+        previous    - the previous IPSet (e.g. from from_save()), or None
+                      if the set may not exist
+        max_changes - defaults to 1000, or a tenth of the members
+        """
+        if previous is None or not self._compatible(previous):
+            return self.swap_script(previous=previous)
+        if max_changes is None:
+            max_changes = max(1000, len(self) // 10)
+        added, removed = self.diff(previous)
+        if len(added) + len(removed) > max_changes:
+            return self.swap_script(previous=previous)
+        return self.diff_script(previous)
+
+    @classmethod
+    def from_save(cls, output):
+        """Returns an OrderedDict of set name -> IPSet of the sets in the
+        output of ipset save (timeouts are the remaining timeouts)
+        """
+        sets = OrderedDict()
+        for line in output.splitlines():
+            words = line.split()
+            if not words:
+                continue
+            if words[0] == 'create':
+                options = _options(words[3:])
+                sets[words[1]] = cls(words[1], words[2], family=options.get('family', 'inet'),
+                                     hashsize=_int_option(options, 'hashsize'),
+                                     maxelem=_int_option(options, 'maxelem'),
+                                     timeout=_int_option(options, 'timeout'), range=options.get('range'))
+            elif words[0] == 'add':
+                options = _options(words[3:])
+                sets[words[1]]._members[words[2]] = _int_option(options, 'timeout')
+        return sets
 
     def __repr__(self):
-        return "<IPSet: %s>" % (self.name,)
-    
+        if self.set_type is None:
+            return "<IPSet: %s>" % (self.name,)
+        return "<IPSet: %s %s - %d members>" % (self.name, self.set_type, len(self))
+
     def __str__(self):
         return self.name
+
+
+def ipset_restore(script, command=('ipset', 'restore')):
+    """Run an ipset restore script (see IPSet.restore_script(), etc.)
+
+    Returns a tuple (returncode, stdout, stderr)
+    """
+    process = subprocess.Popen(
+        list(command),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    stdout, stderr = process.communicate(script.encode('utf-8'))
+    return process.returncode, stdout, stderr
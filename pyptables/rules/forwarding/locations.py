@@ -3,7 +3,14 @@
    Locations represent a network location.
 """
 
-from pyptables.base import DebugObject
+import csv
+import json
+import socket
+from collections import OrderedDict
+
+import six
+
+from pyptables.base import DebugObject, debug_source, set_debug_line
 from pyptables.rules.arguments import ArgumentList
 from pyptables.rules.forwarding.hosts import Hosts
 
@@ -24,6 +31,75 @@ class Location(DebugObject):
             result.append(Location(name, zone, hosts))
         return result
     
+    @staticmethod
+    def bulk_load(records, zones=None, source='<records>'):
+        """Generate Locations from an iterable of (name, zone, ips) records,
+        grouped by zone.
+        
+        records - iterable of (name, zone, ips) tuples, where zone is a
+                  Zone, a zone name or None, and ips is a string as
+                  accepted by from_ip_list()
+        zones   - dictionary of zone name -> Zone, used to resolve zone
+                  names, so that all Locations in a zone share a Zone
+        source  - name of the source of the records, used as the debug
+                  info of the Locations created, in place of (slow)
+                  stack inspection
+        
+        Addresses are validated as they are loaded, a ValueError
+        identifying the record is raised for invalid addresses.
+        
+        Returns an OrderedDict of Zone (or None) -> list of Locations
+        """
+        zones = zones or {}
+        hosts_cache = {}
+        result = OrderedDict()
+        with debug_source(source, 0, 'bulk_load'):
+            for record_no, (name, zone, ips) in enumerate(records, 1):
+                set_debug_line(record_no)
+                if not zone:
+                    zone = None
+                elif isinstance(zone, six.string_types):
+                    try:
+                        zone = zones[zone]
+                    except KeyError:
+                        raise ValueError('%s:%s: unknown zone "%s"' % (source, record_no, zone))
+                if not (zone or ips):
+                    raise ValueError('%s:%s: location "%s" has no zone or ips' % (source, record_no, name))
+                hosts_list = hosts_cache.get(ips)
+                if hosts_list is None:
+                    try:
+                        _validate_ip_list(ips)
+                    except ValueError as e:
+                        raise ValueError('%s:%s: %s' % (source, record_no, e))
+                    hosts_list = hosts_cache[ips] = Hosts.from_ip_list(ips) if ips else [None]
+                locations = result.setdefault(zone, [])
+                locations.extend([Location(name, zone, hosts) for hosts in hosts_list])
+        return result
+    
+    @staticmethod
+    def from_csv(fileobj, zones=None, source=None):
+        """Generate Locations from CSV data with name, zone and ips columns
+        (with a header row), grouped by zone, see bulk_load()
+        """
+        reader = csv.DictReader(fileobj)
+        records = ((row['name'], row['zone'], row['ips']) for row in reader)
+        return Location.bulk_load(records, zones, source or getattr(fileobj, 'name', '<csv>'))
+    
+    @staticmethod
+    def from_json(fileobj, zones=None, source=None):
+        """Generate Locations from JSON data, either a list of objects with
+        name, zone and ips keys, or one such object per line, grouped by
+        zone, see bulk_load()
+        """
+        source = source or getattr(fileobj, 'name', '<json>')
+        first = fileobj.readline()
+        if first.lstrip().startswith('['):
+            objects = json.loads(first + fileobj.read())
+        else:
+            objects = (json.loads(line) for line in _chain_lines(first, fileobj) if line.strip())
+        records = ((obj['name'], obj.get('zone'), obj.get('ips')) for obj in objects)
+        return Location.bulk_load(records, zones, source)
+    
     def __init__(self, name, zone, hosts=None):
         """Creates a Location
            
@@ -69,3 +145,38 @@ class Location(DebugObject):
         if self.hosts:
             return "%s: %s" % (self.zone and self.zone.name or "Anywhere", self.name)
         return self.name
+
+
+def _chain_lines(first, fileobj):
+    yield first
+    for line in fileobj:
+        yield line
+
+
+def _parse_address(address):
+    """Return the packed form of an IPv4 or IPv6 address, or raise ValueError"""
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            return socket.inet_pton(family, address)
+        except (socket.error, ValueError):
+            pass
+    raise ValueError('"%s" is not a valid IP address' % address)
+
+
+def _validate_ip_list(string):
+    """Raise ValueError if a string as accepted by from_ip_list()
+    contains invalid addresses, subnets or ranges
+    """
+    if not string:
+        return
+    for part in string.replace(' ', '').split(','):
+        if '-' in part:
+            start, end = part.split('-', 1)
+            start, end = _parse_address(start), _parse_address(end)
+            if len(start) != len(end) or start > end:
+                raise ValueError('invalid range "%s"' % part)
+        else:
+            address, __, prefix = part.partition('/')
+            address = _parse_address(address)
+            if prefix and not (prefix.isdigit() and int(prefix) <= len(address) * 8):
+                raise ValueError('invalid prefix length in "%s"' % part)
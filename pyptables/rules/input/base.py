@@ -1,3 +1,4 @@
+from pyptables.base import debug_source
 from pyptables.rules import Accept, Drop, AbstractRule, Rule, Reject
 
 
@@ -6,7 +7,8 @@ class InputRule(AbstractRule):
     packets from one location to another.
     """
     
-    def __init__(self, policy, sources=(), channels=(), log=False, log_id=None, log_cls=None, comment=None):
+    def __init__(self, policy, sources=(), channels=(), log=False, log_id=None, log_cls=None, comment=None,
+                 limits=(), limit_first=False, log_chains=None):
         """Creates a ForwardingRule
            
         policy       - the action to take (ACCEPT, DROP, REJECT, etc.) on matching the rule
@@ -14,6 +16,14 @@ class InputRule(AbstractRule):
         channels     - the channel(s) to match
         log          - boolean indicated if "hits" on this rule should be logged
         comment      - a comment for the rule
+        limits       - LimitChannels (or other ArgumentLists) that every
+                       generated rule must also match
+        limit_first  - check the limits before the other matches, so that
+                       packets over the limit skip them. Note: the limits
+                       then count every packet, not only matching packets
+        log_chains   - LogChains: if log is set, jump to the shared
+                       log-and-verdict chain for the policy, rather than
+                       generating a log rule and a verdict rule
         """
         super(InputRule, self).__init__(comment)
         self.policy = policy
@@ -22,15 +32,34 @@ class InputRule(AbstractRule):
         self.log = log
         self.log_id = log_id
         self.log_cls = log_cls
+        self.limits = list(limits)
+        self.limit_first = limit_first
+        self.log_chains = log_chains
     
-    def rule_definitions(self):
+    def rule_definitions(self, profile=None):
         """Generate the iptables rules for this rule"""
-        result = []
-        for rule in self._rules():
-            result.extend(rule.rule_definitions())
-        return result
+        return list(self.iter_definitions(profile))
+    
+    def iter_definitions(self, profile=None):
+        """Yield the iptables rules for this rule, as they are generated: the
+        derived rules are created one at a time (see _rules()), so memory
+        use doesn't depend on the number of rules generated. The derived
+        rules are created with the debug info of this rule.
+        """
+        with debug_source(self.filename, self.lineno, self.function):
+            rules = self._rules()
+        while True:
+            with debug_source(self.filename, self.lineno, self.function):
+                rule = next(rules, None)
+            if rule is None:
+                break
+            for definition in rule.rule_definitions(profile):
+                yield definition
     
     def _base_rules(self):
+        if self.log and self.log_chains is not None:
+            return [Rule(jump=self.log_chains.chain(self.policy).name, comment=self.comment)]
+        
         rules = []
         if self.log:
             rules.append(self.log_cls(prefix='IN %s %s' % (self.log_id, self.policy.upper()[0]),
@@ -51,35 +80,42 @@ class InputRule(AbstractRule):
         return rules
     
     def _rules(self):
-        rules = self._base_rules()
+        """Returns an iterator of the derived rules: each stage lazily derives
+        rules from the rules of the previous stage, so only one rule per
+        stage exists at a time"""
+        rules = iter(self._base_rules())
+        if not self.limit_first:
+            rules = self._add_limits(rules)
         rules = self._add_routes(rules)
         rules = self._add_channels(rules)
+        if self.limit_first:
+            rules = self._add_limits(rules)  # arguments added last are rendered first
         return rules
     
     def _add_routes(self, rules):
         if not self.sources:
             return rules
-        
-        result = []
-        for rule in rules:
-            for source in self.sources:
-                result.append(rule(
-                    args=(source.as_input(),),
-                    comment="%s: route %s -> any" % (
-                        rule.comment,
-                        source,
-                    ),
-                ))
-        return result
+        return (rule(args=(source.as_input(),),
+                     comment="%s: route %s -> any" % (
+                         rule.comment,
+                         source,
+                     ))
+                for rule in rules
+                for source in self.sources)
     
     def _add_channels(self, rules):
         if not self.channels:
             return rules
-        result = []
-        for rule in rules:
-            for channel in self.channels:
-                result.append(rule(
-                    args=[channel],
-                    comment="%s, channel %s" % (rule.comment, channel),
-                ))
-        return result
+        return (rule(args=[channel], comment="%s, channel %s" % (rule.comment, channel))
+                for rule in rules
+                for channel in self.channels)
+    
+    def _add_limits(self, rules):
+        if not self.limits:
+            return rules
+        return (rule(args=self.limits,
+                     comment="%s, limit %s" % (
+                         rule.comment,
+                         ", ".join(map(str, self.limits)),
+                     ))
+                for rule in rules)
@@ -0,0 +1,105 @@
+"""This module contains utility classes for logging packets
+
+   NFLog rules send packets to userspace over netlink (to ulogd, for
+   example), in batches, rather than writing each packet to the kernel
+   log.  It can be used as the log_cls of ForwardingRule and InputRule,
+   with the options bound using functools.partial:
+
+   log_cls = partial(NFLog, group=1, threshold=20, copy_range=128)
+
+   Rather than generating a log rule before every verdict rule, rules
+   can jump to a shared log-and-verdict chain for their policy, halving
+   the number of rules in the chains packets traverse:
+
+   log_chains = LogChains('fwd_log', prefix='FWD', log_cls=log_cls)
+   log_chains.install(tables['filter'])
+   chain.append(ForwardingRule('DROP', sources, destinations, log=True, log_chains=log_chains))
+
+   Note: packets logged by the shared chains are logged with the prefix
+   of the chain, not the log_id of the rule.
+"""
+
+from collections import OrderedDict
+
+from pyptables.chains import UserChain
+from pyptables.rules import Rule, Accept, Drop, Reject
+
+
+class NFLog(Rule):
+    """A Rule that logs matching packets to a netlink log group"""
+    NFLOG = 'NFLOG'
+
+    def __init__(self, prefix=None, group=None, threshold=None, copy_range=None, *args, **kwargs):
+        """Creates a NFLog rule
+
+        prefix     - a prefix for the log messages (at most 64 characters)
+        group      - the netlink group (0 - 65535) to log to
+        threshold  - the number of packets queued in the kernel before
+                     they are sent to userspace
+        copy_range - the number of bytes of each packet to copy to userspace
+        """
+        if group is not None:
+            kwargs['nflog_group'] = str(group)
+        if prefix is not None:
+            if len(prefix) > 64:
+                raise ValueError('NFLOG prefix must be at most 64 characters: %s' % prefix)
+            kwargs['nflog_prefix'] = prefix
+        if copy_range is not None:
+            kwargs['nflog_range'] = str(copy_range)
+        if threshold is not None:
+            kwargs['nflog_threshold'] = str(threshold)
+        super(NFLog, self).__init__(jump=NFLog.NFLOG, *args, **kwargs)
+        self.prefix = prefix
+        self.group = group
+        self.threshold = threshold
+        self.copy_range = copy_range
+
+
+class LogChains(object):
+    """Shared log-and-verdict chains, one per policy, see module documentation"""
+
+    _verdicts = OrderedDict([
+        (Rule.ACCEPT, Accept),
+        (Rule.DROP, Drop),
+        (Rule.REJECT, Reject),
+        (Rule.NONE, None),
+    ])
+
+    def __init__(self, name='log', prefix='LOG', log_cls=NFLog):
+        """Creates LogChains
+
+        name    - the chain name prefix, the chains are named
+                  <name>_accept, <name>_drop, etc.
+        prefix  - the log prefix, the first letter of the policy is appended
+        log_cls - the log Rule class (called with prefix and comment)
+        """
+        super(LogChains, self).__init__()
+        self.name = name
+        self.prefix = prefix
+        self.log_cls = log_cls
+        self._chains = OrderedDict()
+        for policy, verdict in self._verdicts.items():
+            chain = UserChain('%s_%s' % (name, policy.lower()), comment='log and %s' % policy.lower())
+            chain.append(log_cls(prefix='%s %s' % (prefix, policy[0]), comment=chain.comment))
+            if verdict is not None:
+                chain.append(verdict(comment=chain.comment))
+            self._chains[policy] = chain
+
+    def chain(self, policy):
+        """Returns the chain for policy (ACCEPT, DROP, REJECT or NONE)"""
+        try:
+            return self._chains[policy.upper()]
+        except KeyError:
+            raise ValueError('policy must be either %s' % ", ".join(self._verdicts))
+
+    def chains(self):
+        """Returns the list of chains"""
+        return list(self._chains.values())
+
+    def install(self, table):
+        """Add the chains to table"""
+        for chain in self._chains.values():
+            table.append(chain)
+
+    def __repr__(self):
+        return "<LogChains: %s>" % ", ".join(chain.name for chain in self._chains.values())
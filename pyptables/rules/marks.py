@@ -1,9 +1,43 @@
-"""This module contains utility classes for handling iptables marks"""
+"""This module contains utility classes for handling iptables marks
 
+   Marks are allocated by name from a MarkSpace, a range of mark bits
+   selected by a mask.  The mark for a name is stable: it is derived
+   from a hash of the name, so regenerating an unchanged configuration
+   gives identical marks.  Subsystems sharing the mark can each reserve
+   their own bits, so that their marks never collide:
+
+   marks = MarkSpace(0xffff0000)
+   qos = marks.reserve('qos', 0x00ff0000)
+   routing = marks.reserve('routing', 0xff000000)
+   chain.append(qos.mark('bulk', p='tcp', dport='873'))
+   chain.append(qos.marked('bulk', j='CLASSIFY', set_class='1:30'))
+
+   The mark can be saved to (and restored from) the connection mark,
+   so that a classification chain is only run for the first packets
+   of a connection:
+
+   cached = ConnMarkCache(classify, mask=qos)
+   mangle.append(classify)
+   mangle.append(cached)
+   mangle['PREROUTING'].append(Jump(cached))
+"""
+
+import sys
+import zlib
 from functools import partial
-from random import Random
 
-from pyptables.rules import Rule
+import six
+
+from pyptables.base import debug_source
+from pyptables.chains import UserChain
+from pyptables.rules import Rule, Jump
+from pyptables.validator import MAX_CHAIN_NAME
+
+
+def _mark_arg(mark, mask):
+    if mask is None:
+        return str(mark)
+    return '0x%x/0x%x' % (mark, mask)
 
 
 class Mark(Rule):
@@ -14,9 +48,16 @@ class Mark(Rule):
         """Creates a Mark rule
         
         mark - the value to mark matching packets with
+        mask - (keyword only) only change the bits of the mark in
+               mask (--set-xmark)
         """
-        super(Mark, self).__init__(jump=Mark.MARK, set_mark=str(mark), *args, **kwargs)
+        mask = kwargs.pop('mask', None)
+        if mask is None:
+            super(Mark, self).__init__(jump=Mark.MARK, set_mark=str(mark), *args, **kwargs)
+        else:
+            super(Mark, self).__init__(jump=Mark.MARK, set_xmark=_mark_arg(mark, mask), *args, **kwargs)
         self.mark = mark
+        self.mask = mask
 
 
 class Marked(Rule):
@@ -28,23 +69,263 @@ class Marked(Rule):
         mark - match this mark value (can be the the Mark
                rule used originally mark the packets, or
                a literal value
+        mask - (keyword only) only compare the bits of the mark
+               in mask (defaults to the mask of the Mark rule)
         """
-        if not isinstance(mark, int):
+        mask = kwargs.pop('mask', None)
+        if not isinstance(mark, six.integer_types):
+            if mask is None:
+                mask = mark.mask
             mark = mark.mark
-        super(Marked, self).__init__(match='mark', mark=str(mark), *args, **kwargs)
+        super(Marked, self).__init__(match='mark', mark=_mark_arg(mark, mask), *args, **kwargs)
         self.mark = mark
+        self.mask = mask
+
+
+class ConnMark(Rule):
+    """A Rule that marks the connection of matching packets with the specified mark value"""
+    CONNMARK = 'CONNMARK'
+    
+    def __init__(self, mark, *args, **kwargs):
+        """Creates a ConnMark rule
+        
+        mark - the value to mark the connection with
+        mask - (keyword only) only change the bits of the connection
+               mark in mask
+        """
+        mask = kwargs.pop('mask', None)
+        if mask is None:
+            super(ConnMark, self).__init__(jump=ConnMark.CONNMARK, set_mark=str(mark), *args, **kwargs)
+        else:
+            super(ConnMark, self).__init__(jump=ConnMark.CONNMARK, set_xmark=_mark_arg(mark, mask), *args, **kwargs)
+        self.mark = mark
+        self.mask = mask
+
+
+class ConnMarked(Rule):
+    """A rule that matches packets whose connection has the specified mark"""
+    
+    def __init__(self, mark, *args, **kwargs):
+        """Created a ConnMarked rule
+        
+        mark - match this connection mark value (can be the ConnMark
+               or Mark rule used to mark the connection, or a literal value)
+        mask - (keyword only) only compare the bits of the connection
+               mark in mask
+        """
+        mask = kwargs.pop('mask', None)
+        if not isinstance(mark, six.integer_types):
+            if mask is None:
+                mask = mark.mask
+            mark = mark.mark
+        super(ConnMarked, self).__init__(match='connmark', mark=_mark_arg(mark, mask), *args, **kwargs)
+        self.mark = mark
+        self.mask = mask
+
+
+def _mask_value(mask):
+    """Returns the mask value of an int or MarkSpace"""
+    return getattr(mask, 'mask', mask)
+
+
+class SaveConnMark(Rule):
+    """A Rule that copies the packet mark to the connection mark"""
+    
+    def __init__(self, mask=None, *args, **kwargs):
+        """Creates a SaveConnMark rule
+        
+        mask - only copy the bits in mask (an int or MarkSpace)
+        """
+        mask = _mask_value(mask)
+        if mask is None:
+            super(SaveConnMark, self).__init__(jump=ConnMark.CONNMARK, save_mark=None, *args, **kwargs)
+        else:
+            super(SaveConnMark, self).__init__(jump=ConnMark.CONNMARK, save_mark=None,
+                                               nfmask='0x%x' % mask, ctmask='0x%x' % mask, *args, **kwargs)
+        self.mask = mask
+
+
+class RestoreConnMark(Rule):
+    """A Rule that copies the connection mark to the packet mark"""
+    
+    def __init__(self, mask=None, *args, **kwargs):
+        """Creates a RestoreConnMark rule
+        
+        mask - only copy the bits in mask (an int or MarkSpace)
+        """
+        mask = _mask_value(mask)
+        if mask is None:
+            super(RestoreConnMark, self).__init__(jump=ConnMark.CONNMARK, restore_mark=None, *args, **kwargs)
+        else:
+            super(RestoreConnMark, self).__init__(jump=ConnMark.CONNMARK, restore_mark=None,
+                                                  nfmask='0x%x' % mask, ctmask='0x%x' % mask, *args, **kwargs)
+        self.mask = mask
+
+
+class ConnMarkCache(UserChain):
+    """A UserChain that caches the result of a classification chain
+    (which marks packets) in the connection mark.
+    
+    The first packets of a connection traverse the classification chain,
+    and the resulting mark is saved to the connection.  Subsequent packets
+    have the mark restored and return after two rules.  Packets the
+    classification chain leaves unmarked are classified again.
+    """
+    
+    def __init__(self, classifier, mask=0xffffffff, name=None, comment=None):
+        """Creates a ConnMarkCache
+        
+        classifier - the classification UserChain (or its name)
+        mask       - the mark bits set by the classifier (an int or MarkSpace)
+        name       - chain name (default: the classifier name with a
+                     "_cached" suffix, shortened with a hash of the
+                     classifier name if longer than iptables allows)
+        comment    - chain comment
+        """
+        classifier_name = getattr(classifier, 'name', classifier)
+        mask = _mask_value(mask)
+        if name is None:
+            name = '%s_cached' % classifier_name
+            if len(name) > MAX_CHAIN_NAME:
+                suffix = '_%08x_cached' % (zlib.crc32(classifier_name.encode('utf-8')) & 0xffffffff)
+                name = classifier_name[:MAX_CHAIN_NAME - len(suffix)] + suffix
+        elif len(name) > MAX_CHAIN_NAME:
+            raise ValueError('chain name %s is %d characters long, at most %d are allowed' % (
+                name, len(name), MAX_CHAIN_NAME))
+        super(ConnMarkCache, self).__init__(name,
+                                            comment=comment or 'connmark cache for %s' % classifier_name)
+        self.classifier = classifier
+        self.mask = mask
+        self.extend([
+            RestoreConnMark(mask, comment='restore %s mark' % classifier_name),
+            Rule(match='mark', mark__not=_mark_arg(0, mask), jump=Rule.RETURN,
+                 comment='connection already classified'),
+            Jump(classifier),
+            SaveConnMark(mask, comment='save %s mark' % classifier_name),
+        ])
 
 
 DropMarked = partial(Marked, jump=Rule.DROP)
 AcceptMarked = partial(Marked, jump=Rule.ACCEPT)
 
-_random_mark_value = partial(Random().randint, 1, 65535)
-_marks = []
 
+class MarkSpace(object):
+    """A range of mark bits, from which marks are allocated by name"""
+
+    def __init__(self, mask=0xffffffff, name=None):
+        """Creates a MarkSpace
+
+        mask - the (contiguous) mark bits used by this space
+        name - a name for the space, used in error messages
+        """
+        super(MarkSpace, self).__init__()
+        if not 0 < mask <= 0xffffffff:
+            raise ValueError('mark mask must be a non-zero 32 bit value: 0x%x' % mask)
+        self.shift = (mask & -mask).bit_length() - 1
+        self.size = (mask >> self.shift) + 1
+        if self.size & (self.size - 1):
+            raise ValueError('mark mask must be contiguous: 0x%x' % mask)
+        self.mask = mask
+        self.name = name
+        self._used = {0: 1}  # sparse bitmap of 64 bit words, 0 means "not marked"
+        self._values = {}
+        self._reserved = {}
+
+    def reserve(self, name, mask):
+        """Returns a new MarkSpace for a subsystem, using the bits of
+        mask, which must be within this space and not overlap any
+        other reserved space
+        """
+        space = self._reserved.get(name)
+        if space is not None:
+            if space.mask != mask:
+                raise ValueError('mark space %s already reserved with mask 0x%x' % (name, space.mask))
+            return space
+        if self._values:
+            raise ValueError('cannot reserve bits of mark space %s, marks have been allocated from it' % self)
+        if mask & ~self.mask:
+            raise ValueError('mask 0x%x is not within mark space %s' % (mask, self))
+        for other in self._reserved.values():
+            if mask & other.mask:
+                raise ValueError('mask 0x%x overlaps mark space %s' % (mask, other))
+        space = self._reserved[name] = MarkSpace(mask, name)
+        return space
+
+    def allocate(self, name):
+        """Returns the (shifted) mark value for name, allocating it if
+        necessary.  The value is chosen by hashing the name, and if that
+        value is taken, the next free value is used.
+        """
+        value = self._values.get(name)
+        if value is not None:
+            return value
+        if self._reserved:
+            raise ValueError('cannot allocate from mark space %s, its bits are reserved' % self)
+        slots = self.size - 1
+        if len(self._values) >= slots:
+            raise ValueError('mark space %s is full (%d marks)' % (self, slots))
+        preferred = zlib.crc32(name.encode('utf-8')) % slots + 1
+        slot = self._free(preferred)
+        if slot is None:
+            slot = self._free(1)
+        self._used[slot >> 6] = self._used.get(slot >> 6, 0) | 1 << (slot & 63)
+        value = self._values[name] = slot << self.shift
+        return value
+
+    def _free(self, start):
+        """Returns the first free slot at or after start, or None"""
+        slot = start
+        while slot < self.size:
+            free = (~self._used.get(slot >> 6, 0) & 0xffffffffffffffff) >> (slot & 63)
+            if free:
+                slot += (free & -free).bit_length() - 1
+                return slot if slot < self.size else None
+            slot = ((slot >> 6) + 1) << 6
+        return None
+
+    def mark(self, name, *args, **kwargs):
+        """Returns a Mark rule setting the mark for name"""
+        return Mark(self.allocate(name), mask=self.mask, *args, **kwargs)
+
+    def marked(self, name, *args, **kwargs):
+        """Returns a Marked rule matching the mark for name"""
+        return Marked(self.allocate(name), mask=self.mask, *args, **kwargs)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, name):
+        return name in self._values
+
+    def __repr__(self):
+        return "<MarkSpace: %s0x%08x %d/%d>" % ('%s ' % self.name if self.name else '',
+                                               self.mask,
+                                               len(self._values),
+                                               self.size - 1,
+                                               )
+
+    def __str__(self):
+        return self.name or '0x%08x' % self.mask
+
+
+_anonymous_marks = MarkSpace(0xffff, 'random_mark')
+_anonymous_calls = {}
+
+
+def random_mark(name=None, *args, **kwargs):
+    """Generate a Mark rule with a unique value (in the range 1-65535),
+    args and kwargs are passed to Mark
 
-def random_mark():
-    """Generate a Mark rule with a random value""" 
-    mark = _random_mark_value()
-    while mark in _marks:
-        mark = _random_mark_value()  # pragma: no cover
-    return Mark(mark=mark)
+    Despite the name, the value is stable: it is allocated from a shared
+    MarkSpace by name.  Unnamed marks are named after the source line of
+    the call (and the number of earlier calls from it), so their values
+    don't depend on the order of calls from elsewhere.
+    """
+    frame = sys._getframe(1)
+    filename, lineno, function = frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name
+    if name is None:
+        site = '%s:%s %s' % (filename, lineno, function)
+        count = _anonymous_calls[site] = _anonymous_calls.get(site, 0) + 1
+        name = 'anonymous %s #%d' % (site, count)
+    with debug_source(filename, lineno, function):
+        return Mark(_anonymous_marks.allocate(name), *args, **kwargs)
@@ -0,0 +1,6 @@
+"""This package contains classes to generate "nat"
+rules for iptables.
+"""
+
+from pyptables.rules.nat.base import DNAT, SNAT, Masquerade
+from pyptables.rules.nat.portforward import PortForward, PortForwardTable
@@ -0,0 +1,43 @@
+from pyptables.rules import Rule
+
+
+class DNAT(Rule):
+    """A Rule that rewrites the destination address (and port) of matching packets"""
+    DNAT = 'DNAT'
+    
+    def __init__(self, to_destination, *args, **kwargs):
+        """Creates a DNAT rule
+        
+        to_destination - the new destination, address[:port]
+        """
+        super(DNAT, self).__init__(jump=DNAT.DNAT, to_destination=to_destination, *args, **kwargs)
+        self.to_destination = to_destination
+
+
+class SNAT(Rule):
+    """A Rule that rewrites the source address (and port) of matching packets"""
+    SNAT = 'SNAT'
+    
+    def __init__(self, to_source, *args, **kwargs):
+        """Creates a SNAT rule
+        
+        to_source - the new source, address[-address][:port[-port]]
+        """
+        super(SNAT, self).__init__(jump=SNAT.SNAT, to_source=to_source, *args, **kwargs)
+        self.to_source = to_source
+
+
+class Masquerade(Rule):
+    """A Rule that rewrites the source address of matching packets
+    to the address of the outgoing interface"""
+    MASQUERADE = 'MASQUERADE'
+    
+    def __init__(self, to_ports=None, *args, **kwargs):
+        """Creates a Masquerade rule
+        
+        to_ports - source port (range) to use
+        """
+        if to_ports is not None:
+            kwargs['to_ports'] = str(to_ports)
+        super(Masquerade, self).__init__(jump=Masquerade.MASQUERADE, *args, **kwargs)
+        self.to_ports = to_ports
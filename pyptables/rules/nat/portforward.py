@@ -0,0 +1,206 @@
+"""This module contains the PortForwardTable class.
+
+   A PortForwardTable holds a large number of port forwards (DNAT rules),
+   and generates them as a tree of chains: the root chain dispatches on
+   the destination address (by address range, when there are many
+   addresses), and each address dispatches on the protocol and
+   destination port range, so a packet is evaluated against a number of
+   rules proportional to the logarithm of the number of forwards, rather
+   than the number of forwards.
+
+   Optionally, the jump into the tree is guarded by an ipset holding
+   every forwarded address and port, so that packets which are not
+   forwarded are evaluated against a single rule:
+
+   forwards = PortForwardTable('port_fwd', in_interface='eth0', ipset='port_fwd')
+   forwards.add('203.0.113.1', 8080, '10.0.0.5', 80)
+   forwards.install(tables['nat'])
+"""
+
+import socket
+import struct
+from collections import namedtuple, OrderedDict
+
+from pyptables.chains import UserChain
+from pyptables.rules import Rule
+from pyptables.rules.forwarding.ipsets import IPSet
+from pyptables.rules.matches import Match
+from pyptables.rules.nat.base import DNAT
+
+
+PortForward = namedtuple('PortForward', 'proto address port to_address to_port comment')
+PortForward.__doc__ = """A port forward
+
+proto      - the protocol (tcp, udp, etc.)
+address    - the (public) destination address
+port       - the (public) destination port
+to_address - the address to forward to
+to_port    - the port to forward to
+comment    - a comment for the DNAT rule
+"""
+
+
+def _address_key(address):
+    try:
+        return struct.unpack('!I', socket.inet_pton(socket.AF_INET, address))[0]
+    except (socket.error, OSError):
+        raise ValueError('invalid IPv4 address: %s' % address)
+
+
+def _port(port):
+    port = int(port)
+    if not 0 < port <= 65535:
+        raise ValueError('invalid port: %s' % port)
+    return port
+
+
+class PortForwardTable(object):
+    """A tree of chains implementing a set of port forwards, see module documentation"""
+
+    def __init__(self, name='port_forwards', in_interface=None, ipset=None, bucket_size=16, fanout=8):
+        """Creates a PortForwardTable
+
+        name         - name of the root chain (other chains are named
+                       after it, with a numeric suffix)
+        in_interface - only forward packets arriving on this interface
+        ipset        - name of a hash:ip,port ipset to guard the jump to the
+                       root chain (see ipset_restore())
+        bucket_size  - the maximum number of rules in a chain before it is split
+        fanout       - the number of chains a chain is split into
+        """
+        super(PortForwardTable, self).__init__()
+        if bucket_size < 1 or fanout < 2:
+            raise ValueError('bucket_size must be at least 1, and fanout at least 2')
+        self.name = name
+        self.in_interface = in_interface
+        self.ipset = ipset
+        self.bucket_size = bucket_size
+        self.fanout = fanout
+        self._forwards = OrderedDict()
+
+    def add(self, address, port, to_address, to_port=None, proto='tcp', comment=None):
+        """Add a port forward
+
+        address    - the (public) destination address
+        port       - the (public) destination port
+        to_address - the address to forward to
+        to_port    - the port to forward to (default: port)
+        proto      - the protocol (default: tcp)
+        comment    - a comment for the DNAT rule
+        """
+        _address_key(address)
+        _address_key(to_address)
+        port = _port(port)
+        to_port = port if to_port is None else _port(to_port)
+        key = (proto, address, port)
+        if key in self._forwards:
+            raise ValueError('duplicate port forward %s %s:%s' % key)
+        forward = self._forwards[key] = PortForward(proto, address, port, to_address, to_port, comment)
+        return forward
+
+    def __len__(self):
+        return len(self._forwards)
+
+    def __iter__(self):
+        return iter(self._forwards.values())
+
+    def chains(self):
+        """Generate the chains implementing the port forwards,
+        the first chain is the root chain"""
+        self._chains = [UserChain(self.name, comment='%s port forwards' % len(self._forwards))]
+        by_address = OrderedDict()
+        for forward in sorted(self._forwards.values(), key=lambda f: (_address_key(f.address), f.proto, f.port)):
+            by_address.setdefault(forward.address, []).append(forward)
+        addresses = list(by_address.items())
+        self._chains[0].extend(self._split(
+            addresses,
+            lambda first, last: {'args': [Match('iprange', dst_range='%s-%s' % (first[0], last[0]))]},
+            self._address_rules,
+        ))
+        return self._chains
+
+    def _new_chain(self):
+        chain = UserChain('%s_%d' % (self.name, len(self._chains)))
+        self._chains.append(chain)
+        return chain
+
+    def _split(self, items, match, leaf):
+        """Returns the rules for items, a sorted list.  If there are more
+        than bucket_size items, they are split into fanout groups, each in
+        a new chain, jumped to by a rule matching the range of the group.
+        """
+        if len(items) <= self.bucket_size:
+            rules = []
+            for item in items:
+                rules.extend(leaf(item))
+            return rules
+        size = -(-len(items) // self.fanout)
+        rules = []
+        for start in range(0, len(items), size):
+            group = items[start:start + size]
+            if len(group) == 1:
+                rules.extend(leaf(group[0]))
+                continue
+            chain = self._new_chain()
+            chain.extend(self._split(group, match, leaf))
+            rules.append(Rule(jump=chain.name, **match(group[0], group[-1])))
+        return rules
+
+    def _address_rules(self, item):
+        address, forwards = item
+        if len(forwards) <= self.bucket_size:
+            return [self._dnat(forward, d=address) for forward in forwards]
+        chain = self._new_chain()
+        by_proto = OrderedDict()
+        for forward in forwards:
+            by_proto.setdefault(forward.proto, []).append(forward)
+        for proto, proto_forwards in by_proto.items():
+            chain.extend(self._split(
+                proto_forwards,
+                lambda first, last: {'p': proto, 'dport': '%d:%d' % (first.port, last.port)},
+                lambda forward: [self._dnat(forward)],
+            ))
+        return [Rule(d=address, jump=chain.name)]
+
+    @staticmethod
+    def _dnat(forward, **kwargs):
+        return DNAT('%s:%d' % (forward.to_address, forward.to_port),
+                    p=forward.proto,
+                    dport=str(forward.port),
+                    comment=forward.comment,
+                    **kwargs)
+
+    def jump(self):
+        """Returns the rule jumping from the nat PREROUTING chain to the root chain"""
+        kwargs = {}
+        if self.in_interface:
+            kwargs['i'] = self.in_interface
+        if self.ipset:
+            kwargs['args'] = [Match('set', match_set=[self.ipset, 'dst,dst'])]
+        return Rule(jump=self.name, comment='port forwards', **kwargs)
+
+    def install(self, table, chain='PREROUTING'):
+        """Add the chains to table (a nat Table), and the jump to the root
+        chain to the end of chain.  Returns the root chain.
+        """
+        chains = self.chains()
+        for new_chain in chains:
+            table.append(new_chain)
+        table[chain].append(self.jump())
+        return chains[0]
+
+    def ip_set(self):
+        """Returns the guard ipset, an IPSet holding every forwarded address and port"""
+        if not self.ipset:
+            raise ValueError('this PortForwardTable does not use an ipset')
+        return IPSet(self.ipset, 'hash:ip,port',
+                     members=['%s,%s:%d' % (forward.address, forward.proto, forward.port)
+                              for forward in self._forwards.values()])
+
+    def ipset_restore(self):
+        """Returns the ipset restore script creating the guard ipset (see
+        ip_set() for atomic and incremental updates)"""
+        return self.ip_set().restore_script()
+
+    def __repr__(self):
+        return "<PortForwardTable: %s - %d forwards>" % (self.name, len(self._forwards))
@@ -0,0 +1,144 @@
+"""This module contains utility classes for exempting traffic from
+   connection tracking
+
+   Connection tracking is expensive for high volume services with short
+   exchanges, such as DNS and NTP.  A StatelessService generates the raw
+   table rules exempting the requests and the replies of a service from
+   connection tracking, and the filter rules accepting them (as the
+   packets are untracked, stateful rules can't accept the replies):
+
+   dns = StatelessService(UDPChannel(dports='53'), sources=[lan], destinations=[dns_servers])
+   dns.install(tables)
+
+   Channels must not match connection state.  The replies are matched by
+   swapping the source and destination ports of a PortChannel (other
+   channels are used unchanged).  In the raw PREROUTING chain the output
+   interface is not yet known, so forwarded traffic is matched on the
+   destination addresses only.
+"""
+
+from collections import OrderedDict
+
+from pyptables.rules import Rule
+from pyptables.rules.arguments import ArgumentList
+from pyptables.rules.forwarding.channels import PortChannel
+
+
+class NoTrack(Rule):
+    """A Rule that exempts matching packets from connection tracking
+    (raw table only)"""
+    CT = 'CT'
+    NOTRACK = 'NOTRACK'
+
+    def __init__(self, legacy=False, *args, **kwargs):
+        """Creates a NoTrack rule
+
+        legacy - use the NOTRACK target (for old kernels), rather than CT --notrack
+        """
+        if legacy:
+            super(NoTrack, self).__init__(jump=NoTrack.NOTRACK, *args, **kwargs)
+        else:
+            super(NoTrack, self).__init__(jump=NoTrack.CT, notrack=None, *args, **kwargs)
+        self.legacy = legacy
+
+
+def _reply_channel(channel):
+    """Returns a channel matching the replies to packets matching channel"""
+    if 'ctstate' in channel:
+        raise ValueError('a stateless service can not match connection state: %s' % channel)
+    if not isinstance(channel, PortChannel):
+        return channel
+    return PortChannel(proto=channel['p'].value,
+                       sports=channel['dports'].value if 'dports' in channel else '',
+                       dports=channel['sports'].value if 'sports' in channel else '')
+
+
+def _addresses(location, output):
+    """Returns the ArgumentList matching the addresses (but not the zone) of location"""
+    if location.hosts:
+        return location.hosts.as_output() if output else location.hosts.as_input()
+    return ArgumentList()
+
+
+class StatelessService(object):
+    """The raw and filter rules for a service exempt from connection
+    tracking, see module documentation"""
+
+    def __init__(self, channel, sources=(), destinations=None, comment=None, legacy=False):
+        """Creates a StatelessService
+
+        channel      - the Channel of the requests
+        sources      - the client Locations (default: anywhere)
+        destinations - the server Locations for a forwarded service, or
+                       None for a service on this host (INPUT)
+        comment      - a comment for the rules
+        legacy       - use the NOTRACK target, rather than CT --notrack
+        """
+        super(StatelessService, self).__init__()
+        self.channel = channel
+        self.reply_channel = _reply_channel(channel)
+        self.sources = list(sources) or [None]
+        self.destinations = None if destinations is None else list(destinations) or [None]
+        self.comment = comment or 'stateless %s' % channel
+        self.legacy = legacy
+
+    def _rules(self, rule, pairs, channel, direction):
+        result = []
+        for source, destination, args in pairs:
+            result.append(rule(
+                args=[arglist for arglist in args if arglist is not None] + [channel],
+                comment="%s: %s %s -> %s" % (self.comment, direction, source or 'any', destination or 'any'),
+            ))
+        return result
+
+    def _pairs(self, raw):
+        """Returns the (source, destination, ArgumentLists) of the requests and replies"""
+        requests, replies = [], []
+        if self.destinations is None:
+            for source in self.sources:
+                requests.append((source, None, [source and source.as_input()]))
+                replies.append((None, source, [source and source.as_output()]))
+            return requests, replies
+        for source in self.sources:
+            for destination in self.destinations:
+                if raw:  # the output interface is not known in raw PREROUTING
+                    requests.append((source, destination, [source and source.as_input(),
+                                                           destination and _addresses(destination, True)]))
+                    replies.append((destination, source, [destination and destination.as_input(),
+                                                          source and _addresses(source, True)]))
+                else:
+                    requests.append((source, destination, [source and source.as_input(),
+                                                           destination and destination.as_output()]))
+                    replies.append((destination, source, [destination and destination.as_input(),
+                                                          source and source.as_output()]))
+        return requests, replies
+
+    def raw_rules(self):
+        """Returns an OrderedDict of raw chain name -> list of NoTrack rules"""
+        notrack = NoTrack(legacy=self.legacy)
+        requests, replies = self._pairs(raw=True)
+        requests = self._rules(notrack, requests, self.channel, 'request')
+        replies = self._rules(notrack, replies, self.reply_channel, 'reply')
+        if self.destinations is None:
+            return OrderedDict([('PREROUTING', requests), ('OUTPUT', replies)])
+        return OrderedDict([('PREROUTING', requests + replies)])
+
+    def filter_rules(self):
+        """Returns an OrderedDict of filter chain name -> list of rules
+        accepting the requests and replies"""
+        accept = Rule(jump=Rule.ACCEPT)
+        requests, replies = self._pairs(raw=False)
+        requests = self._rules(accept, requests, self.channel, 'request')
+        replies = self._rules(accept, replies, self.reply_channel, 'reply')
+        if self.destinations is None:
+            return OrderedDict([('INPUT', requests), ('OUTPUT', replies)])
+        return OrderedDict([('FORWARD', requests + replies)])
+
+    def install(self, tables):
+        """Append the rules to the raw and filter tables of tables"""
+        for table_name, rules in (('raw', self.raw_rules()), ('filter', self.filter_rules())):
+            for chain_name, chain_rules in rules.items():
+                tables[table_name][chain_name].extend(chain_rules)
+
+    def __repr__(self):
+        return "<StatelessService: %s>" % self.comment
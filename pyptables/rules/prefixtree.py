@@ -0,0 +1,196 @@
+"""This module contains the PrefixTree class.
+
+   Where a large number of addresses each need their own action (so a
+   single ipset isn't enough), a flat chain of "-s address -j action"
+   rules makes every packet walk the whole chain.  A PrefixTree holds a
+   mapping of CIDR -> target (a built-in target or a chain) and
+   generates a tree of chains splitting the address space by prefix: the
+   root chain matches the longest prefix common to its addresses, and
+   dispatches on the next bits of the address to a chain for each
+   sub-prefix, and so on, so a packet is evaluated against a number of
+   rules proportional to the logarithm of the number of entries, rather
+   than the number of entries:
+
+   tree = PrefixTree('per_host', {'10.1.0.0/16': 'lan_hosts', '10.1.2.3': 'DROP'})
+   tree.add('192.0.2.0/24', quarantine_chain)
+   tree.install(tables['filter'], 'FORWARD')
+
+   Overlapping entries are resolved by longest prefix match (the most
+   specific entry wins), exactly as if the entries were sorted from the
+   longest prefix to the shortest in a flat chain (see flat_rules()).
+   Packets matching no entry return from the tree.
+"""
+
+import socket
+import struct
+from collections import namedtuple, OrderedDict
+
+from pyptables.chains import UserChain
+from pyptables.rules import Rule
+
+
+PrefixEntry = namedtuple('PrefixEntry', 'network length target comment')
+PrefixEntry.__doc__ = """An entry of a PrefixTree
+
+network - the network address, as an integer
+length  - the prefix length
+target  - the target (a built-in target or chain name)
+comment - a comment for the rule
+"""
+
+
+def _parse(cidr):
+    """Returns (network, length) of an IPv4 address or CIDR"""
+    address, _, length = cidr.partition('/')
+    try:
+        network = struct.unpack('!I', socket.inet_pton(socket.AF_INET, address))[0]
+        length = int(length) if length else 32
+    except (socket.error, OSError, ValueError):
+        raise ValueError('invalid IPv4 address or network: %s' % cidr)
+    if not 0 <= length <= 32:
+        raise ValueError('invalid IPv4 address or network: %s' % cidr)
+    return network & _mask(length), length
+
+
+def _mask(length):
+    return (0xffffffff << (32 - length)) & 0xffffffff
+
+
+def _format(network, length):
+    return '%s/%d' % (socket.inet_ntoa(struct.pack('!I', network)), length)
+
+
+class PrefixTree(object):
+    """A tree of chains dispatching on addresses by prefix, see module documentation"""
+
+    def __init__(self, name, entries=None, destination=False, bucket_size=16, bits=3):
+        """Creates a PrefixTree
+
+        name        - name of the root chain (other chains are named
+                      after it, with a numeric suffix)
+        entries     - a mapping (or iterable of pairs) of CIDR -> target
+        destination - match the destination address, rather than the source
+        bucket_size - the maximum number of entries in a chain before it is split
+        bits        - the number of address bits each level of the tree
+                      dispatches on (a chain jumps to at most 2 ** bits chains)
+        """
+        super(PrefixTree, self).__init__()
+        if bucket_size < 1 or not 1 <= bits <= 8:
+            raise ValueError('bucket_size must be at least 1, and bits between 1 and 8')
+        self.name = name
+        self.destination = destination
+        self.bucket_size = bucket_size
+        self.bits = bits
+        self._entries = OrderedDict()
+        if entries is not None:
+            self.update(entries)
+
+    def add(self, cidr, target, comment=None):
+        """Add an entry
+
+        cidr    - an IPv4 address or network
+        target  - a built-in target (ACCEPT, DROP, etc.), chain name, or Chain
+        comment - a comment for the rule
+        """
+        network, length = _parse(cidr)
+        if (network, length) in self._entries:
+            raise ValueError('duplicate prefix %s' % _format(network, length))
+        entry = self._entries[network, length] = PrefixEntry(network, length, getattr(target, 'name', target),
+                                                             comment)
+        return entry
+
+    def update(self, entries):
+        """Add the entries of a mapping (or iterable of pairs) of CIDR -> target"""
+        if hasattr(entries, 'items'):
+            entries = entries.items()
+        for cidr, target in entries:
+            self.add(cidr, target)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries.values())
+
+    def lookup(self, address):
+        """Returns the target of the longest prefix matching address, or None"""
+        address = _parse(address)[0]
+        for length in range(32, -1, -1):
+            entry = self._entries.get((address & _mask(length), length))
+            if entry is not None:
+                return entry.target
+        return None
+
+    def _rule(self, network, length, **kwargs):
+        kwargs['d' if self.destination else 's'] = _format(network, length)
+        return Rule(**kwargs)
+
+    def _entry_rule(self, entry):
+        return self._rule(entry.network, entry.length, jump=entry.target, comment=entry.comment)
+
+    def flat_rules(self):
+        """Returns the equivalent flat list of rules (longest prefix first)"""
+        entries = sorted(self._entries.values(), key=lambda entry: (-entry.length, entry.network))
+        return [self._entry_rule(entry) for entry in entries]
+
+    def chains(self):
+        """Generate the chains implementing the tree, the first chain is the root chain"""
+        self._chains = [UserChain(self.name, comment='%d prefixes' % len(self._entries))]
+        entries = sorted(self._entries.values(), key=lambda entry: (entry.network, entry.length))
+        self._chains[0].extend(self._node(entries))
+        return self._chains
+
+    def _new_chain(self, network, length):
+        chain = UserChain('%s_%d' % (self.name, len(self._chains)), comment=_format(network, length))
+        self._chains.append(chain)
+        return chain
+
+    def _node(self, entries):
+        """Returns the rules for entries (sorted by network): flat, if there
+        are at most bucket_size entries, otherwise the entries are split
+        by the bits following their common prefix, each group in a new
+        chain, jumped to by a rule matching the prefix of the group.  The
+        entries with shorter prefixes follow the jumps.
+        """
+        if len(entries) <= self.bucket_size:
+            return [self._entry_rule(entry)
+                    for entry in sorted(entries, key=lambda entry: (-entry.length, entry.network))]
+        first, last = entries[0].network, max(entry.network | ~_mask(entry.length) & 0xffffffff
+                                              for entry in entries)
+        common = 32 - (first ^ last).bit_length()
+        length = min(common + self.bits, 32)
+        groups = OrderedDict()
+        covering = []
+        for entry in entries:
+            if entry.length < length:
+                covering.append(entry)
+            else:
+                groups.setdefault(entry.network & _mask(length), []).append(entry)
+        rules = []
+        for network, group in groups.items():
+            if len(group) == 1:
+                rules.append(self._entry_rule(group[0]))
+                continue
+            chain = self._new_chain(network, length)
+            chain.extend(self._node(group))
+            rules.append(self._rule(network, length, jump=chain.name))
+        covering.sort(key=lambda entry: (-entry.length, entry.network))
+        return rules + [self._entry_rule(entry) for entry in covering]
+
+    def jump(self, **kwargs):
+        """Returns a rule jumping to the root chain (kwargs are passed to the Rule)"""
+        kwargs.setdefault('comment', 'prefix tree %s' % self.name)
+        return Rule(jump=self.name, **kwargs)
+
+    def install(self, table, chain, **kwargs):
+        """Add the chains to table, and the jump to the root chain to the
+        end of chain (kwargs are passed to jump()).  Returns the root chain.
+        """
+        chains = self.chains()
+        for new_chain in chains:
+            table.append(new_chain)
+        table[chain].append(self.jump(**kwargs))
+        return chains[0]
+
+    def __repr__(self):
+        return "<PrefixTree: %s - %d prefixes>" % (self.name, len(self._entries))
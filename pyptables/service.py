@@ -0,0 +1,278 @@
+"""This module contains the ApplyService class.
+
+   The ApplyService is a long running asyncio service that accepts
+   Tables updates, coalesces bursts of updates and writes the changes
+   into the kernel, rewriting only the chains that changed where
+   possible.
+"""
+
+import asyncio
+import time
+
+from pyptables.profiles import get_profile, COMPACT
+
+
+class ApplyError(Exception):
+    """Raised when iptables-restore fails to apply an update"""
+
+    def __init__(self, message, returncode=None, stderr=''):
+        super(ApplyError, self).__init__(message)
+        self.returncode = returncode
+        self.stderr = stderr
+
+
+class ApplyMetrics(object):
+    """Counters and timings collected by an ApplyService"""
+
+    def __init__(self):
+        self.submitted = 0
+        self.applied = 0
+        self.coalesced = 0
+        self.full_applies = 0
+        self.delta_applies = 0
+        self.failures = 0
+        self.queue_depth = 0
+        self.last_latency = None
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+    @property
+    def average_latency(self):
+        """Average time from first submission of a batch to it being applied"""
+        if not self.applied:
+            return None
+        return self.total_latency / self.applied
+
+    def as_dict(self):
+        return {
+            'submitted': self.submitted,
+            'applied': self.applied,
+            'coalesced': self.coalesced,
+            'full_applies': self.full_applies,
+            'delta_applies': self.delta_applies,
+            'failures': self.failures,
+            'queue_depth': self.queue_depth,
+            'last_latency': self.last_latency,
+            'max_latency': self.max_latency,
+            'average_latency': self.average_latency,
+        }
+
+    def __repr__(self):
+        return "<ApplyMetrics: %s>" % ", ".join("%s=%s" % item for item in sorted(self.as_dict().items()))
+
+
+def render_chains(tables, profile=None):
+    """Render Tables into a structure suitable for computing deltas:
+    an ordered list of (table name, [(chain name, definition, rules), ...])
+    """
+    profile = get_profile(profile)
+    result = []
+    for table in tables.values():
+        chains = []
+        for chain in table.values():
+            chain_result = chain.to_iptables(profile=profile)
+            chains.append((chain.name, chain_result.header_content, chain_result.rules))
+        result.append((table.name, chains))
+    return result
+
+
+def _is_builtin(definition):
+    return definition.split()[1] != '-'
+
+
+def full_payload(rendered):
+    """Render an iptables-restore payload replacing the full ruleset"""
+    lines = []
+    for table, chains in rendered:
+        lines.append('*%s' % table)
+        lines.extend([definition for __, definition, __ in chains])
+        lines.extend([rules for __, __, rules in chains if rules])
+        lines.append('COMMIT')
+    return "%s\n" % "\n".join(lines)
+
+
+def delta_payload(old, new):
+    """Render an iptables-restore --noflush payload changing the old ruleset
+    into the new ruleset, rewriting only the chains that have changed.
+
+    Returns None if there are no changes.
+    """
+    old_tables = dict((table, dict((chain[0], chain) for chain in chains)) for table, chains in old)
+    lines = []
+    for table, chains in new:
+        old_chains = old_tables.get(table, {})
+        new_names = set(chain[0] for chain in chains)
+        changed = [chain for chain in chains if old_chains.get(chain[0]) != chain]
+        removed = [name for name in old_chains if name not in new_names]
+        if not (changed or removed):
+            continue
+        lines.append('*%s' % table)
+        lines.extend([definition for __, definition, __ in changed])
+        lines.extend(['-F %s' % name for name, __, __ in changed if name in old_chains])
+        lines.extend(['-F %s' % name for name in removed])
+        lines.extend(['-X %s' % name for name in removed if not _is_builtin(old_chains[name][1])])
+        lines.extend([rules for __, __, rules in changed if rules])
+        lines.append('COMMIT')
+    if not lines:
+        return None
+    return "%s\n" % "\n".join(lines)
+
+
+class ApplyService(object):
+    """Applies Tables updates in the background.
+
+    Updates submitted within the debounce window of each other are
+    coalesced, and only the most recent is applied.  The first update
+    (and any update following a failure) is applied in full with a new
+    iptables-restore process, later updates only rewrite the chains
+    that changed, with "iptables-restore --noflush".  Every update is
+    only considered applied once its iptables-restore process has exited
+    successfully.
+
+    Usage:
+    service = ApplyService()
+    await service.start()
+    await service.submit(tables)
+    await service.stop()
+    """
+
+    def __init__(self, command=('iptables-restore',), debounce=0.1, profile=COMPACT):
+        """Creates an ApplyService
+
+        command  - the iptables-restore command (a fake can be used for testing)
+        debounce - seconds to wait for further updates before applying
+        profile  - the Profile used to render the updates
+        """
+        super(ApplyService, self).__init__()
+        self.command = list(command)
+        self.debounce = debounce
+        self.profile = get_profile(profile)
+        self.metrics = ApplyMetrics()
+        self._applied = None
+        self._pending = None
+        self._waiters = []
+        self._applying = []
+        self._first_submitted = None
+        self._wakeup = None
+        self._task = None
+
+    async def start(self):
+        """Start processing updates"""
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Apply any pending update (or finish applying the current
+        update), then stop the service"""
+        waiters = self._waiters or self._applying
+        if waiters:
+            await asyncio.wait([waiters[-1]])
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    def submit(self, tables):
+        """Queue Tables to be applied, replacing any queued update.
+
+        Returns a future, which completes once the update (or an update
+        coalesced with it) has been applied.
+        """
+        future = asyncio.get_event_loop().create_future()
+        if self._pending is not None:
+            self.metrics.coalesced += 1
+        else:
+            self._first_submitted = time.time()
+        self._pending = tables
+        self._waiters.append(future)
+        self.metrics.submitted += 1
+        self.metrics.queue_depth = len(self._waiters)
+        self._wakeup.set()
+        return future
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            await self._debounce()
+            self._wakeup.clear()
+            tables, waiters, submitted = self._pending, self._waiters, self._first_submitted
+            self._pending, self._waiters = None, []
+            self._applying = waiters
+            self.metrics.queue_depth = 0
+            try:
+                await self._apply(tables)
+            except asyncio.CancelledError:
+                # the update may have been partially applied
+                self._applied = None
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_exception(ApplyError('the service was stopped while applying the update'))
+                raise
+            except Exception as e:
+                self.metrics.failures += 1
+                self._applied = None
+                # drop the traceback, it references the frame of this (still
+                # running) task, which must not be cleared by the receivers
+                e = e.with_traceback(None)
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_exception(e)
+            else:
+                latency = time.time() - submitted
+                self.metrics.applied += 1
+                self.metrics.last_latency = latency
+                self.metrics.max_latency = max(self.metrics.max_latency, latency)
+                self.metrics.total_latency += latency
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(latency)
+            finally:
+                self._applying = []
+
+    async def _debounce(self):
+        """Wait until no update has arrived for the debounce period"""
+        while True:
+            count = self.metrics.submitted
+            await asyncio.sleep(self.debounce)
+            if count == self.metrics.submitted:
+                return
+
+    async def _apply(self, tables):
+        loop = asyncio.get_event_loop()
+        rendered = await loop.run_in_executor(None, render_chains, tables, self.profile)
+        if self._applied is None:
+            await self._apply_full(full_payload(rendered))
+        else:
+            payload = delta_payload(self._applied, rendered)
+            if payload is not None:
+                await self._apply_delta(payload)
+        self._applied = rendered
+
+    async def _communicate(self, command, payload):
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            __, stderr = await process.communicate(payload.encode('utf-8'))
+        except asyncio.CancelledError:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+        if process.returncode:
+            raise ApplyError('iptables-restore failed with exit code %s' % process.returncode,
+                             returncode=process.returncode,
+                             stderr=stderr.decode('utf-8', 'replace'),
+                             )
+
+    async def _apply_full(self, payload):
+        await self._communicate(self.command, payload)
+        self.metrics.full_applies += 1
+
+    async def _apply_delta(self, payload):
+        await self._communicate(self.command + ['--noflush'], payload)
+        self.metrics.delta_applies += 1
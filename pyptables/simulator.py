@@ -0,0 +1,716 @@
+"""This module contains a packet classification simulator for Tables.
+
+   The Simulator compiles the rules of a Tables object into predicates
+   over columns of packet fields, and classifies a batch of packets
+   through the built-in chains (following jumps and gotos into user
+   chains), returning the verdict for each packet, the resulting packet
+   marks, and the number of packets that hit each rule.
+
+   Rules are evaluated one at a time, each against every packet still
+   traversing the chain, so the cost is proportional to the number of
+   rules rather than the number of packets.  Requires numpy.
+
+   simulator = Simulator(tables, sets={'blacklist': ['10.0.0.0/8']})
+   packets = read_packets(open('flows.csv'))
+   result = simulator.classify(packets, path=[('mangle', 'FORWARD'), ('filter', 'FORWARD')])
+   print(result.counts())
+
+   Supported matches are interfaces, protocol, addresses, iprange,
+   tcp/udp ports, multiport, icmp type, state/conntrack state, mark,
+   connmark and set.  The connection mark of each packet is a packet
+   field (ctmark), updated by CONNMARK targets.  NAT and logging targets are not simulated (NAT targets
+   are treated as ACCEPT, logging targets are ignored).  Rules with
+   comma separated addresses (which iptables expands into several
+   kernel rules) are counted as a single rule.
+"""
+
+import csv
+import socket
+import struct
+import sys
+from collections import namedtuple, OrderedDict
+
+import numpy
+import six
+
+from pyptables.parsing import tokenize, options, target, MATCH_OPTIONS
+from pyptables.profiles import MINIMAL
+
+
+PACKET_DTYPE = numpy.dtype([
+    ('in_interface', 'U15'),
+    ('out_interface', 'U15'),
+    ('src', 'u4'),
+    ('dst', 'u4'),
+    ('proto', 'u1'),
+    ('sport', 'u2'),
+    ('dport', 'u2'),
+    ('icmp_type', 'u1'),
+    ('ctstate', 'u1'),
+    ('mark', 'u4'),
+    ('ctmark', 'u4'),
+])
+
+INTERFACE_FIELDS = ('in_interface', 'out_interface')
+
+PROTOCOLS = {'icmp': 1, 'igmp': 2, 'tcp': 6, 'udp': 17, 'gre': 47, 'esp': 50, 'ah': 51, 'sctp': 132}
+
+CTSTATES = OrderedDict([
+    ('INVALID', 1),
+    ('NEW', 2),
+    ('ESTABLISHED', 4),
+    ('RELATED', 8),
+    ('UNTRACKED', 16),
+    ('SNAT', 32),
+    ('DNAT', 64),
+])
+
+ICMP_TYPES = {
+    'any': None,
+    'echo-reply': 0, 'pong': 0,
+    'destination-unreachable': 3,
+    'source-quench': 4,
+    'redirect': 5,
+    'echo-request': 8, 'ping': 8,
+    'router-advertisement': 9,
+    'router-solicitation': 10,
+    'time-exceeded': 11, 'ttl-exceeded': 11,
+    'parameter-problem': 12,
+    'timestamp-request': 13,
+    'timestamp-reply': 14,
+}
+
+# verdict codes, the index of the name in VERDICTS
+VERDICTS = ('NONE', 'ACCEPT', 'DROP', 'REJECT', 'QUEUE')
+_ACCEPT = VERDICTS.index('ACCEPT')
+
+_VERDICT_TARGETS = {
+    'ACCEPT': _ACCEPT,
+    'DROP': VERDICTS.index('DROP'),
+    'REJECT': VERDICTS.index('REJECT'),
+    'QUEUE': VERDICTS.index('QUEUE'),
+    'NFQUEUE': VERDICTS.index('QUEUE'),
+    # address translation is not simulated, but ends traversal of the table
+    'DNAT': _ACCEPT,
+    'SNAT': _ACCEPT,
+    'MASQUERADE': _ACCEPT,
+    'REDIRECT': _ACCEPT,
+    'NETMAP': _ACCEPT,
+}
+
+# targets which do not affect the classification of a packet
+IGNORED_TARGETS = frozenset(['LOG', 'NFLOG', 'ULOG', 'AUDIT', 'TRACE', 'CT', 'NOTRACK', 'TCPMSS',
+                             'CLASSIFY', 'DSCP', 'TOS', 'TTL', 'SET'])
+
+# options which do not affect whether a rule matches
+_IGNORED_OPTIONS = frozenset(['-m', '--match', '--comment', '-j', '--jump', '-g', '--goto'])
+
+_MARK_OPTIONS = ('--set-mark', '--set-xmark', '--and-mark', '--or-mark', '--xor-mark')
+_CONNMARK_OPTIONS = ('--save-mark', '--restore-mark')
+
+# rule kinds
+_NONE, _VERDICT, _RETURN, _JUMP, _GOTO, _MARK, _CONNMARK = range(7)
+
+SimulatedRule = namedtuple('SimulatedRule', 'table chain rule line')
+SimulatedRule.__doc__ = """A rule definition compiled by the Simulator
+
+table - the table name
+chain - the chain name
+rule  - the Rule object
+line  - the rule definition
+"""
+
+
+def ip_to_int(address):
+    """Convert a dotted quad IPv4 address to an integer"""
+    try:
+        return struct.unpack('!I', socket.inet_aton(address))[0]
+    except (socket.error, OSError):
+        raise ValueError('invalid IPv4 address: %s' % address)
+
+
+def _network(value):
+    """Returns (network, mask) for an address, with optional /prefix or /netmask"""
+    if '/' in value:
+        address, prefix = value.split('/', 1)
+        if '.' in prefix:
+            mask = ip_to_int(prefix)
+        else:
+            bits = int(prefix)
+            if not 0 <= bits <= 32:
+                raise ValueError('invalid prefix length: %s' % value)
+            mask = (0xffffffff << (32 - bits)) & 0xffffffff
+    else:
+        address, mask = value, 0xffffffff
+    return ip_to_int(address) & mask, mask
+
+
+def _ranges(members):
+    """Returns sorted, merged (starts, ends) arrays covering the addresses,
+    networks (a.b.c.d/n) and ranges (a.b.c.d-e.f.g.h) in members
+    """
+    ranges = []
+    for member in members:
+        member = str(member).strip()
+        if '-' in member:
+            first, last = member.split('-', 1)
+            ranges.append((ip_to_int(first), ip_to_int(last)))
+        else:
+            network, mask = _network(member)
+            ranges.append((network, network | (~mask & 0xffffffff)))
+    ranges.sort()
+    merged = []
+    for first, last in ranges:
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+    starts = numpy.array([first for first, __ in merged], dtype=numpy.uint32)
+    ends = numpy.array([last for __, last in merged], dtype=numpy.uint32)
+    return starts, ends
+
+
+def _in_ranges(column, starts, ends):
+    if not len(starts):
+        return numpy.zeros(len(column), dtype=bool)
+    position = numpy.searchsorted(starts, column, side='right') - 1
+    found = position >= 0
+    position[~found] = 0
+    return found & (column <= ends[position])
+
+
+def _port(value):
+    if value.isdigit():
+        return int(value)
+    try:
+        return socket.getservbyname(value)
+    except (socket.error, OSError):
+        raise ValueError('unknown port: %s' % value)
+
+
+def _port_ranges(value):
+    """Returns [(first, last), ...] for a port list like 22,80:90"""
+    result = []
+    for item in value.split(','):
+        if ':' in item:
+            first, last = item.split(':', 1)
+            result.append((_port(first) if first else 0, _port(last) if last else 65535))
+        else:
+            port = _port(item)
+            result.append((port, port))
+    return result
+
+
+def _interface_match(interface, name):
+    if name.endswith('+'):
+        return interface.startswith(name[:-1])
+    return interface == name
+
+
+def _mark(value):
+    """Returns (value, mask) for a mark specification like 0x10/0xff"""
+    if '/' in value:
+        value, mask = value.split('/', 1)
+        return int(value, 0), int(mask, 0)
+    return int(value, 0), 0xffffffff
+
+
+def _single(option, values, line):
+    if len(values) != 1:
+        raise ValueError('expected a single value for %s in rule: %s' % (option, line))
+    return values[0]
+
+
+def _encode(packets, field):
+    """Returns ([name, ...], codes) for a string field of packets.
+
+    Sorting strings is slow, so the characters of each name are packed
+    into a pair of 64 bit words, which are combined into a single key,
+    and only the keys are sorted.  Names with characters above 255, or
+    with colliding keys, fall back to sorting the strings.
+    """
+    dtype, offset = packets.dtype.fields[field][:2]
+    length = dtype.itemsize // 4
+    raw = packets.view(numpy.uint8).reshape(len(packets), packets.dtype.itemsize)[:, offset:offset + dtype.itemsize]
+    low = 0 if sys.byteorder == 'little' else 3
+    packed = numpy.zeros((len(packets), (length + 7) // 8 * 8), dtype=numpy.uint8)
+    packed[:, :length] = raw[:, low::4]
+    words = packed.view(numpy.uint64)
+    keys = words[:, 0].copy()
+    for word in range(1, words.shape[1]):
+        keys ^= words[:, word] * numpy.uint64(0x9E3779B97F4A7C15)
+    __, first, codes = numpy.unique(keys, return_index=True, return_inverse=True)
+    codes = codes.reshape(-1).astype(numpy.int32)
+    wide = [high for high in range(4) if high != low]
+    if raw[:, wide[0]::4].any() or raw[:, wide[1]::4].any() or raw[:, wide[2]::4].any() or \
+            not (words[first][codes] == words).all():  # pragma: no cover
+        names, codes = numpy.unique(packets[field], return_inverse=True)
+        return [str(name) for name in names], codes.reshape(-1).astype(numpy.int32)
+    return [str(name) for name in packets[field][first]], codes
+
+
+class _View(object):
+    """The columns of a subset of the packets in a batch, gathered on first use"""
+    __slots__ = ('batch', 'index', 'cache')
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+        self.cache = {}
+
+    def __getitem__(self, field):
+        column = self.cache.get(field)
+        if column is None:
+            column = self.cache[field] = self.batch.columns[field][self.index]
+        return column
+
+
+class _Batch(object):
+    """The state of a batch of packets being classified"""
+
+    def __init__(self, packets, rule_count):
+        packets = numpy.ascontiguousarray(packets, dtype=PACKET_DTYPE)
+        self.columns = {}
+        self.interfaces = {}
+        self._interface_tests = {}
+        for field in PACKET_DTYPE.names:
+            if field in INTERFACE_FIELDS:
+                # interface names are replaced by codes, so interface tests
+                # are only evaluated once per distinct name
+                names, codes = _encode(packets, field)
+                self.interfaces[field] = names
+                self.columns[field] = codes
+            else:
+                self.columns[field] = numpy.array(packets[field])
+        self.verdicts = numpy.zeros(len(packets), dtype=numpy.uint8)
+        self.hits = numpy.zeros(rule_count, dtype=numpy.int64)
+        self.policies = OrderedDict()
+
+    def interface_test(self, field, inverse, name):
+        key = (field, inverse, name)
+        result = self._interface_tests.get(key)
+        if result is None:
+            result = self._interface_tests[key] = numpy.array(
+                [_interface_match(interface, name) != inverse for interface in self.interfaces[field]],
+                dtype=bool,
+            )
+        return result
+
+
+class _CompiledRule(object):
+    """A rule definition compiled into a list of column predicates"""
+
+    def __init__(self, number, line, chains, sets):
+        self.number = number
+        self.tests = []
+        self.mark = None
+        self.connmark = None
+        self.masks = {'--nfmask': 0xffffffff, '--ctmask': 0xffffffff}
+        tokens = tokenize(line)
+        self.target, goto = target(tokens)
+        module = None
+        for inverse, option, values in options(tokens):
+            if option in ('-m', '--match') and values:
+                module = values[0]
+            self._compile_option(inverse, MATCH_OPTIONS.get(option, option), values, line, sets, module)
+        if self.target is None:
+            self.kind = _NONE
+        elif self.target in chains:
+            self.kind = _GOTO if goto else _JUMP
+        elif goto:
+            raise ValueError('goto to unknown chain %s in rule: %s' % (self.target, line))
+        elif self.target == 'RETURN':
+            self.kind = _RETURN
+        elif self.target in _VERDICT_TARGETS:
+            self.kind = _VERDICT
+            self.verdict = _VERDICT_TARGETS[self.target]
+        elif self.target == 'MARK':
+            if self.mark is None:
+                raise ValueError('MARK target without a mark operation in rule: %s' % line)
+            self.kind = _MARK
+        elif self.target == 'CONNMARK':
+            if self.mark is None and self.connmark is None:
+                raise ValueError('CONNMARK target without a mark operation in rule: %s' % line)
+            self.kind = _CONNMARK
+        elif self.target in IGNORED_TARGETS:
+            self.kind = _NONE
+        else:
+            raise ValueError('unsupported target %s in rule: %s' % (self.target, line))
+
+    def _compile_option(self, inverse, option, values, line, sets, module):
+        tests = self.tests
+        if option in _IGNORED_OPTIONS or option.startswith('--log-') or option.startswith('--nflog-') or \
+                option in ('--reject-with', '--to-destination', '--to-source', '--to-ports', '--queue-num',
+                           '--notrack'):
+            return
+        if option in ('-s', '-d'):
+            field = 'src' if option == '-s' else 'dst'
+            networks = [_network(value) for value in _single(option, values, line).split(',')]
+            if inverse and len(networks) > 1:
+                raise ValueError('! not allowed with multiple addresses in rule: %s' % line)
+            tests.append(self._network_test(field, networks, inverse))
+        elif option in ('-i', '-o'):
+            field = 'in_interface' if option == '-i' else 'out_interface'
+            name = _single(option, values, line)
+            tests.append(lambda view: view.batch.interface_test(field, inverse, name)[view[field]])
+        elif option == '-p':
+            name = _single(option, values, line).lower()
+            if name == 'all' or name == '0':
+                if inverse:
+                    tests.append(lambda view: numpy.zeros(len(view.index), dtype=bool))
+                return
+            proto = int(name) if name.isdigit() else PROTOCOLS.get(name)
+            if proto is None:
+                raise ValueError('unknown protocol %s in rule: %s' % (name, line))
+            tests.append(self._value_test('proto', proto, inverse))
+        elif option == '-f':
+            # simulated packets are never fragments
+            tests.append(lambda view: numpy.zeros(len(view.index), dtype=bool) != inverse)
+        elif option in ('--dport', '--destination-port', '--sport', '--source-port',
+                        '--dports', '--destination-ports', '--sports', '--source-ports'):
+            field = 'dport' if option.startswith('--d') else 'sport'
+            tests.append(self._port_test([field], _port_ranges(_single(option, values, line)), inverse))
+        elif option == '--ports':
+            tests.append(self._port_test(['sport', 'dport'], _port_ranges(_single(option, values, line)),
+                                         inverse))
+        elif option in ('--src-range', '--dst-range'):
+            field = 'src' if option == '--src-range' else 'dst'
+            starts, ends = _ranges([_single(option, values, line)])
+            tests.append(self._range_test(field, starts, ends, inverse))
+        elif option == '--icmp-type':
+            name = _single(option, values, line).split('/')[0]
+            icmp_type = int(name) if name.isdigit() else ICMP_TYPES.get(name, -1)
+            if icmp_type == -1:
+                raise ValueError('unknown icmp type %s in rule: %s' % (name, line))
+            if icmp_type is not None:
+                tests.append(self._value_test('icmp_type', icmp_type, inverse))
+        elif option in ('--state', '--ctstate'):
+            states = 0
+            for state in _single(option, values, line).upper().split(','):
+                if state not in CTSTATES:
+                    raise ValueError('unknown state %s in rule: %s' % (state, line))
+                states |= CTSTATES[state]
+            tests.append(self._bits_test('ctstate', states, inverse))
+        elif option == '--mark':
+            value, mask = _mark(_single(option, values, line))
+            tests.append(self._masked_test('ctmark' if module == 'connmark' else 'mark', value, mask, inverse))
+        elif option == '--match-set':
+            if len(values) != 2:
+                raise ValueError('expected a set name and flags for --match-set in rule: %s' % line)
+            name, flags = values
+            if flags not in ('src', 'dst'):
+                raise ValueError('unsupported set flags %s in rule: %s' % (flags, line))
+            if name not in sets:
+                raise ValueError('unknown set %s in rule: %s' % (name, line))
+            starts, ends = sets[name]
+            tests.append(self._range_test(flags, starts, ends, inverse))
+        elif option in _MARK_OPTIONS:
+            self.mark = (option,) + _mark(_single(option, values, line))
+        elif option in _CONNMARK_OPTIONS:
+            self.connmark = option
+        elif option in ('--nfmask', '--ctmask'):
+            self.masks[option] = int(_single(option, values, line), 0)
+        elif option == '--mask':
+            self.masks['--nfmask'] = self.masks['--ctmask'] = int(_single(option, values, line), 0)
+        else:
+            raise ValueError('unsupported option %s in rule: %s' % (option, line))
+
+    @staticmethod
+    def _value_test(field, value, inverse):
+        if inverse:
+            return lambda view: view[field] != value
+        return lambda view: view[field] == value
+
+    @staticmethod
+    def _bits_test(field, bits, inverse):
+        if inverse:
+            return lambda view: (view[field] & bits) == 0
+        return lambda view: (view[field] & bits) != 0
+
+    @staticmethod
+    def _masked_test(field, value, mask, inverse):
+        value = numpy.uint32(value)
+        mask = numpy.uint32(mask)
+        if inverse:
+            return lambda view: (view[field] & mask) != value
+        return lambda view: (view[field] & mask) == value
+
+    @staticmethod
+    def _network_test(field, networks, inverse):
+        networks = [(numpy.uint32(network), numpy.uint32(mask)) for network, mask in networks]
+
+        def test(view):
+            column = view[field]
+            result = None
+            for network, mask in networks:
+                match = (column & mask) == network
+                result = match if result is None else result | match
+            return ~result if inverse else result
+        return test
+
+    @staticmethod
+    def _range_test(field, starts, ends, inverse):
+        def test(view):
+            result = _in_ranges(view[field], starts, ends)
+            return ~result if inverse else result
+        return test
+
+    @staticmethod
+    def _port_test(fields, ranges, inverse):
+        def test(view):
+            result = None
+            for field in fields:
+                column = view[field]
+                for first, last in ranges:
+                    if first == last:
+                        match = column == first
+                    else:
+                        match = (column >= first) & (column <= last)
+                    result = match if result is None else result | match
+            return ~result if inverse else result
+        return test
+
+    def matches(self, view):
+        """Returns a boolean array of the packets in view matching this rule,
+        or True if the rule matches all packets
+        """
+        result = True
+        for test in self.tests:
+            match = test(view)
+            result = match if result is True else result & match
+        return result
+
+    def apply_mark(self, column, index):
+        option, value, mask = self.mark
+        marks = column[index]
+        value = numpy.uint32(value)
+        if option == '--set-mark':
+            marks = (marks & numpy.uint32(~mask & 0xffffffff)) | value
+        elif option == '--set-xmark':
+            marks = (marks & numpy.uint32(~mask & 0xffffffff)) ^ value
+        elif option == '--and-mark':
+            marks = marks & value
+        elif option == '--or-mark':
+            marks = marks | value
+        else:
+            marks = marks ^ value
+        column[index] = marks
+
+    def apply_connmark(self, columns, index):
+        if self.connmark is None:
+            self.apply_mark(columns['ctmark'], index)
+            return
+        nfmask = numpy.uint32(self.masks['--nfmask'])
+        ctmask = numpy.uint32(self.masks['--ctmask'])
+        marks = columns['mark'][index]
+        ctmarks = columns['ctmark'][index]
+        if self.connmark == '--save-mark':
+            columns['ctmark'][index] = (ctmarks & ~ctmask) ^ (marks & nfmask)
+        else:
+            columns['mark'][index] = (marks & ~nfmask) ^ (ctmarks & ctmask)
+
+
+class _CompiledChain(object):
+    def __init__(self, name, policy, rules):
+        self.name = name
+        self.policy = policy
+        self.rules = rules
+
+
+class Classification(object):
+    """The result of Simulator.classify()
+
+    verdicts - array of verdict codes (indexes into VERDICTS), one per packet
+    marks    - array of packet marks after classification
+    ctmarks  - array of connection marks after classification
+    hits     - array of hit counts, one per Simulator.rules entry
+    policies - OrderedDict of (table, chain) to the number of packets
+               the chain policy was applied to
+    """
+
+    def __init__(self, rules, verdicts, marks, ctmarks, hits, policies):
+        super(Classification, self).__init__()
+        self.rules = rules
+        self.verdicts = verdicts
+        self.marks = marks
+        self.ctmarks = ctmarks
+        self.hits = hits
+        self.policies = policies
+
+    def verdict(self, packet):
+        """Returns the verdict name for the packet (by position in the batch)"""
+        return VERDICTS[self.verdicts[packet]]
+
+    def counts(self):
+        """Returns an OrderedDict of verdict name to the number of packets"""
+        counts = numpy.bincount(self.verdicts, minlength=len(VERDICTS))
+        return OrderedDict((name, int(count)) for name, count in zip(VERDICTS, counts) if count)
+
+    def rule_hits(self):
+        """Returns a list of (SimulatedRule, hits) for rules that were hit"""
+        return [(self.rules[i], int(self.hits[i])) for i in numpy.flatnonzero(self.hits)]
+
+    def __repr__(self):
+        return "<Classification: %s>" % ", ".join("%s=%s" % item for item in self.counts().items())
+
+
+class Simulator(object):
+    """Classifies batches of packets against a Tables object, see module documentation"""
+
+    def __init__(self, tables, sets=None):
+        """Creates a Simulator, compiling the rules of tables
+
+        tables - the Tables object
+        sets   - dictionary of ipset name to the members of the set
+                 (addresses, networks and ranges), or a list of IPSet
+                 objects of address types (hash:ip, hash:net, etc.), for
+                 rules matching sets
+        """
+        super(Simulator, self).__init__()
+        if sets is not None and not hasattr(sets, 'items'):
+            sets = dict((ip_set.name, ip_set) for ip_set in sets)
+        compiled_sets = dict((name, _ranges(members)) for name, members in (sets or {}).items())
+        self.rules = []
+        self._tables = {}
+        for table in tables.values():
+            chains = self._tables[table.name] = {}
+            for chain in table.values():
+                policy = chain._chain_definition().split()[1]
+                rules = []
+                for rule in chain:
+                    for line in rule.rule_definitions(MINIMAL):
+                        rules.append(_CompiledRule(len(self.rules), line, table, compiled_sets))
+                        self.rules.append(SimulatedRule(table.name, chain.name, rule, line))
+                chains[chain.name] = _CompiledChain(chain.name, _VERDICT_TARGETS.get(policy), rules)
+
+    def classify(self, packets, path=(('filter', 'FORWARD'),)):
+        """Classify a batch of packets.
+
+        packets - a numpy array with PACKET_DTYPE (see make_packets()
+                  and read_packets())
+        path    - the (table, chain) built-in chains the packets traverse,
+                  in order; packets not accepted by one chain do not
+                  traverse the following chains
+
+        Returns a Classification
+        """
+        if path and isinstance(path[0], six.string_types):
+            path = (path,)
+        batch = _Batch(packets, len(self.rules))
+        index = numpy.arange(len(packets))
+        for table, chain in path:
+            compiled = self._tables[table][chain]
+            if compiled.policy is None:
+                raise ValueError('%s/%s is not a built-in chain' % (table, chain))
+            remaining = self._traverse(batch, table, compiled, index, ())
+            batch.verdicts[remaining] = compiled.policy
+            batch.policies[(table, chain)] = len(remaining)
+            index = index[batch.verdicts[index] == _ACCEPT]
+        return Classification(self.rules, batch.verdicts, batch.columns['mark'], batch.columns['ctmark'],
+                              batch.hits, batch.policies)
+
+    def _traverse(self, batch, table, chain, index, stack):
+        """Classify the packets in index through the chain, returning the
+        index of the packets that reach the end of the chain or RETURN
+        """
+        if chain.name in stack:
+            raise ValueError('chain loop: %s' % " -> ".join(stack + (chain.name,)))
+        stack += (chain.name,)
+        returned = []
+        for rule in chain.rules:
+            if not len(index):
+                break
+            match = rule.matches(_View(batch, index))
+            if match is True:
+                matched, rest = index, index[:0]
+            else:
+                matched, rest = index[match], index[~match]
+            count = len(matched)
+            if not count:
+                continue
+            batch.hits[rule.number] += count
+            kind = rule.kind
+            if kind == _VERDICT:
+                batch.verdicts[matched] = rule.verdict
+                index = rest
+            elif kind == _RETURN:
+                returned.append(matched)
+                index = rest
+            elif kind == _JUMP:
+                back = self._traverse(batch, table, self._tables[table][rule.target], matched, stack)
+                index = numpy.sort(numpy.concatenate((rest, back))) if len(rest) else back
+            elif kind == _GOTO:
+                returned.append(self._traverse(batch, table, self._tables[table][rule.target], matched, stack))
+                index = rest
+            elif kind == _MARK:
+                rule.apply_mark(batch.columns['mark'], matched)
+            elif kind == _CONNMARK:
+                rule.apply_connmark(batch.columns, matched)
+        returned.append(index)
+        return numpy.concatenate(returned) if len(returned) > 1 else index
+
+
+def make_packets(count, **fields):
+    """Returns an array of count packets, with fields set from the keyword
+    arguments (scalars or arrays, addresses may be dotted quads,
+    protocols and states may be names)
+    """
+    packets = numpy.zeros(count, dtype=PACKET_DTYPE)
+    for field, value in fields.items():
+        packets[field] = _convert(field, value)
+    return packets
+
+
+def read_packets(fileobj):
+    """Read packets from a CSV file with a header row naming the fields
+    (see PACKET_DTYPE), missing fields are zero (or empty)
+    """
+    reader = csv.reader(fileobj)
+    header = [field.strip() for field in next(reader)]
+    for field in header:
+        if field not in PACKET_DTYPE.names:
+            raise ValueError('unknown packet field: %s' % field)
+    converters = [_converter(field) for field in header]
+    rows = []
+    for row in reader:
+        if row:
+            rows.append(tuple(convert(value.strip()) for convert, value in zip(converters, row)))
+    packets = numpy.zeros(len(rows), dtype=PACKET_DTYPE)
+    if rows:
+        for position, field in enumerate(header):
+            packets[field] = [row[position] for row in rows]
+    return packets
+
+
+def _converter(field):
+    if field in ('src', 'dst'):
+        return lambda value: ip_to_int(value) if value else 0
+    if field == 'proto':
+        return lambda value: int(value) if value.isdigit() else PROTOCOLS[value.lower()] if value else 0
+    if field == 'ctstate':
+        return _ctstate
+    if field in ('mark', 'ctmark'):
+        return lambda value: int(value, 0) if value else 0
+    if field in INTERFACE_FIELDS:
+        return str
+    return lambda value: int(value) if value else 0
+
+
+def _ctstate(value):
+    if isinstance(value, six.integer_types) or not value:
+        return value or 0
+    if value.isdigit():
+        return int(value)
+    states = 0
+    for state in value.upper().split(','):
+        states |= CTSTATES[state]
+    return states
+
+
+def _convert(field, value):
+    if isinstance(value, (six.string_types, six.integer_types)):
+        return _converter(field)(value) if isinstance(value, six.string_types) else value
+    if isinstance(value, numpy.ndarray) and (value.dtype.kind in 'biu' or field in INTERFACE_FIELDS):
+        return value
+    convert = _converter(field)
+    return [convert(item) if isinstance(item, six.string_types) else item for item in value]
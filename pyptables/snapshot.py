@@ -0,0 +1,216 @@
+"""This module contains the Snapshot class.
+
+   A Snapshot is a compiled form of a Tables object saved to disk.
+   It holds the pre-rendered output, so that it can be written into
+   the kernel without importing the configuration or building the
+   object model, alongside the object model itself, which is loaded
+   one chain at a time, on first access.
+
+   Snapshots are keyed by a hash of the configuration source, so that
+   a stale snapshot is never used:
+
+   snapshot = cached_snapshot('/var/cache/firewall.snap', ['firewall.py'], build_tables)
+   restore(snapshot.to_iptables())
+"""
+
+import hashlib
+import os
+import pickle
+import zlib
+
+from pyptables.profiles import get_profile, COMPACT
+
+
+MAGIC = b'PYPTSNAP1\n'
+
+
+def source_hash(*paths):
+    """Returns a hash of the contents of the configuration source files"""
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as source:
+            digest.update(source.read())
+    return digest.hexdigest()
+
+
+class SnapshotTable(object):
+    """A read-only, dictionary-like view of a table in a Snapshot,
+    chains are loaded on first access"""
+
+    def __init__(self, name, state, chains):
+        super(SnapshotTable, self).__init__()
+        self.name = name
+        self._state = state
+        self._names = [chain_name for chain_name, __ in chains]
+        self._blobs = dict(chains)
+        self._chains = {}
+
+    def __getitem__(self, name):
+        chain = self._chains.get(name)
+        if chain is None:
+            chain = self._chains[name] = pickle.loads(self._blobs[name])
+        return chain
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return name in self._blobs
+
+    def keys(self):
+        return list(self._names)
+
+    def values(self):
+        return [self[name] for name in self._names]
+
+    def items(self):
+        return [(name, self[name]) for name in self._names]
+
+    def load(self):
+        """Returns the Table object, loading all chains"""
+        from pyptables.tables import Table
+        table = Table(self.name, *self.values())
+        table.__dict__.update(self._state)
+        return table
+
+    def __repr__(self):
+        return "<SnapshotTable: %s - %s>" % (self.name, self._names)
+
+
+class Snapshot(object):
+    """A compiled Tables object, see module documentation"""
+
+    def __init__(self, source_hash, profile, output, state, tables):
+        """Creates a Snapshot (use save_snapshot() and load_snapshot())
+
+        source_hash - hash of the configuration source
+        profile     - name of the Profile used to render output
+        output      - the pre-rendered output
+        state       - attributes of the Tables object
+        tables      - list of (table name, table attributes, [(chain name, pickled chain), ...])
+        """
+        super(Snapshot, self).__init__()
+        self.source_hash = source_hash
+        self.profile = profile
+        self.output = output
+        self._state = state
+        self._names = [name for name, __, __ in tables]
+        self._tables = dict((name, SnapshotTable(name, table_state, chains))
+                            for name, table_state, chains in tables)
+        self._loaded = None
+
+    def __getitem__(self, name):
+        return self._tables[name]
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return name in self._tables
+
+    def keys(self):
+        return list(self._names)
+
+    def values(self):
+        return [self._tables[name] for name in self._names]
+
+    def items(self):
+        return [(name, self._tables[name]) for name in self._names]
+
+    @property
+    def tables(self):
+        """The Tables object, loading all chains"""
+        if self._loaded is None:
+            from pyptables.tables import Tables
+            self._loaded = Tables(*[table.load() for table in self.values()])
+            self._loaded.__dict__.update(self._state)
+        return self._loaded
+
+    def to_iptables(self, profile=None, index=None):
+        """Returns the tables in a format compatible with iptables-restore.
+
+        The pre-rendered output is returned if the profile matches the
+        profile the snapshot was saved with (or is None), otherwise the
+        tables are loaded and rendered.
+        """
+        if index is None and (profile is None or get_profile(profile).name == self.profile):
+            return self.output
+        return self.tables.to_iptables(profile=profile, index=index)
+
+    def __repr__(self):
+        return "<Snapshot: %s [%s]>" % (self.source_hash, ", ".join(self._names))
+
+
+def save_snapshot(tables, path, source_hash=None, profile=COMPACT):
+    """Save a snapshot of tables to path.
+
+    tables      - the Tables object
+    path        - the snapshot file
+    source_hash - hash of the configuration source (see source_hash())
+    profile     - the Profile used to pre-render the output
+
+    Returns the Snapshot.
+    """
+    profile = get_profile(profile)
+    output = tables.to_iptables(profile=profile)
+    structure = []
+    for table in tables.values():
+        chains = [(chain.name, pickle.dumps(chain, pickle.HIGHEST_PROTOCOL)) for chain in table.values()]
+        structure.append((table.name, dict(table.__dict__), chains))
+    data = {
+        'source_hash': source_hash,
+        'profile': profile.name,
+        'output': output,
+        'state': dict(tables.__dict__),
+        'tables': structure,
+    }
+    payload = zlib.compress(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+    temp = '%s.%s.tmp' % (path, os.getpid())
+    with open(temp, 'wb') as snapshot:
+        snapshot.write(MAGIC)
+        snapshot.write(payload)
+    os.rename(temp, path)
+    return Snapshot(source_hash, profile.name, output, data['state'], structure)
+
+
+def load_snapshot(path, source_hash=None):
+    """Load a snapshot from path.
+
+    If source_hash is given, and does not match the hash the snapshot
+    was saved with, None is returned.  None is also returned if the
+    file does not exist.
+    """
+    try:
+        with open(path, 'rb') as snapshot:
+            magic = snapshot.read(len(MAGIC))
+            payload = snapshot.read()
+    except IOError:
+        return None
+    if magic != MAGIC:
+        raise ValueError('%s is not a PyPTables snapshot' % path)
+    data = pickle.loads(zlib.decompress(payload))
+    if source_hash is not None and data['source_hash'] != source_hash:
+        return None
+    return Snapshot(data['source_hash'], data['profile'], data['output'], data['state'], data['tables'])
+
+
+def cached_snapshot(path, sources, build, profile=COMPACT):
+    """Load the snapshot at path, or if it is missing or stale, call build()
+    to create the Tables object, and save a new snapshot.
+
+    path    - the snapshot file
+    sources - the configuration source files
+    build   - function returning a Tables object
+    profile - the Profile used to pre-render the output
+    """
+    current_hash = source_hash(*sources)
+    snapshot = load_snapshot(path, current_hash)
+    if snapshot is None:
+        snapshot = save_snapshot(build(), path, current_hash, profile)
+    return snapshot
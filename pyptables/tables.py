@@ -1,6 +1,7 @@
 from collections import OrderedDict
 
 from pyptables.base import DebugObject
+from pyptables.profiles import get_profile
 
 
 class Tables(DebugObject, OrderedDict):
@@ -10,22 +11,45 @@ class Tables(DebugObject, OrderedDict):
         for table in tables:
             self.append(table)
     
-    def to_iptables(self):
-        """Returns this list of tables in a format compatible with iptables-restore"""
+    def to_iptables(self, profile=None, index=None):
+        """Returns this list of tables in a format compatible with iptables-restore
+        
+        profile - a Profile (or profile name, "verbose", "compact" or "minimal")
+                  controlling the amount of annotation in the output:
+                  verbose - headers and debug comments for every table,
+                            chain and rule (default)
+                  compact - no "#" comment lines, rule comments kept
+                  minimal - no "#" comment lines and no rule comments
+                  canonical - no "#" comment lines, rules in the form
+                              iptables-save lists them in
+        index   - a LineIndex, which records the table, chain and rule
+                  that generated each line of the output
+        """
+        lines = self.iter_iptables(profile=profile)
+        if index is not None:
+            return "%s\n" % "\n".join(index.record(lines))
+        return "%s\n" % "\n".join([line for line, __, __, __ in lines])
+    
+    def iter_iptables(self, profile=None):
+        """Yield (line, table, chain, rule) tuples for this list of tables in
+        iptables format, as they are generated.  table, chain and rule are the
+        objects the line was generated by, or None.
+        """
         try:
-            header = '# Tables generated by PyPTables (%(debug)s)' % {'debug': self.debug_info()}
-            table_output = [table.to_iptables() for table in self.values()]
-            table_output = "\n\n".join(table_output)
-            return "%(header)s\n\n%(tables)s\n" % {
-                'header': header,
-                'tables': table_output,
-                }
+            profile = get_profile(profile)
+            if profile.headers:
+                yield '# Tables generated by PyPTables (%(debug)s)' % {'debug': self.debug_info()}, None, None, None
+            for table in self.values():
+                if profile.headers:
+                    yield '', None, None, None
+                for line, chain, rule in table.iter_iptables(profile=profile):
+                    yield line, table, chain, rule
         except Exception as e:  # pragma: no cover
             e.iptables_path = getattr(e, 'iptables_path', [])
             e.iptables_path.insert(0, "Tables")
             e.message = "Iptables error at:\n    %s\n\nError message: %s" % (
                 "\n".join(e.iptables_path).replace('\n', '\n    '),
-                e.message,
+                getattr(e, 'message', e),
             )
             raise
     
@@ -37,6 +61,9 @@ class Tables(DebugObject, OrderedDict):
         super(Tables, self).__setitem__(table.name, table)
         return table
     
+    def __reduce__(self):
+        return self.__class__, tuple(self.values()), self.__dict__
+    
     def __repr__(self):
         return "<Tables: [%s]>" % ", ".join(['<Table: %s ...>' % t.name for t in self.values()])
 
@@ -49,26 +76,36 @@ class Table(DebugObject, OrderedDict):
         for chain in chains:
             self.append(chain)
     
-    def to_iptables(self):
+    def to_iptables(self, profile=None):
         """Returns this table in a format compatible with iptables-restore"""
+        return "\n".join([line for line, __, __ in self.iter_iptables(profile=profile)])
+    
+    def iter_iptables(self, profile=None):
+        """Yield (line, chain, rule) tuples for this table in iptables format,
+        as they are generated.  chain and rule are the objects the line was
+        generated by, or None.
+        """
         try:
-            header_content = "# %(name)s table (%(debug)s) #" % {
-                'name': self.name,
-                'debug': self.debug_info(),
-                }
-            header = "%(marquee)s\n%(content)s\n%(marquee)s\n*%(name)s" % {
-                'content': header_content,
-                'marquee': "#"*len(header_content),
-                'name': self.name, 
-                }
-            chain_results = [chain.to_iptables() for chain in self.values()]
-        
-            return "%(header)s\n%(chains)s\n\n%(rules)s\n\n%(footer)s" % {
-                'header': header,
-                'chains': "\n".join([result.header_content for result in chain_results]),
-                'rules': "\n\n".join([result.rules for result in chain_results]),
-                'footer': 'COMMIT'
-                }
+            profile = get_profile(profile)
+            if profile.headers:
+                header_content = "# %(name)s table (%(debug)s) #" % {
+                    'name': self.name,
+                    'debug': self.debug_info(),
+                    }
+                marquee = "#"*len(header_content)
+                for line in (marquee, header_content, marquee):
+                    yield line, None, None
+            yield '*%s' % self.name, None, None
+            for chain in self.values():
+                yield chain._chain_definition(), chain, None
+            for chain in self.values():
+                if profile.headers:
+                    yield '', None, None
+                for line, rule in chain.iter_iptables(profile=profile):
+                    yield line, chain, rule
+            if profile.headers:
+                yield '', None, None
+            yield 'COMMIT', None, None
         except Exception as e:  # pragma: no cover
             e.iptables_path = getattr(e, 'iptables_path', [])
             e.iptables_path.insert(0, self.name)
@@ -82,5 +119,8 @@ class Table(DebugObject, OrderedDict):
         super(Table, self).__setitem__(chain.name, chain)
         return chain
     
+    def __reduce__(self):
+        return self.__class__, (self.name,) + tuple(self.values()), self.__dict__
+    
     def __repr__(self):
         return "<Table: %s - %s>" % (self.name, list(self.values()))
@@ -0,0 +1,235 @@
+"""This module contains the ChainTemplate class.
+
+   A ChainTemplate is a UserChain containing ${placeholders} in its
+   name, comment and rule arguments.  The template is rendered once
+   per profile, and each instance is created by substituting values
+   into the rendered output, so creating and rendering many similar
+   chains costs a string substitution per chain, rather than building
+   and rendering the rules of each chain:
+
+   template = ChainTemplate('tenant_${id}')
+   template.append(Rule(i='${interface}', s='${network}', j='ACCEPT'))
+   for tenant in tenants:
+       chain = filter_table.append(template.instantiate(id=tenant.id,
+                                                        interface=tenant.interface,
+                                                        network=tenant.network))
+       filter_table['FORWARD'].append(Jump(chain))
+
+   The template must not be changed once it has been instantiated.
+
+   Profiles which record the comments of the rules (e.g. a CommentIndex)
+   are given the comment of each instance, with the values substituted.
+"""
+
+from pyptables.chains import AbstractChain, UserChain
+from pyptables.profiles import get_profile, Profile, VERBOSE
+from pyptables.rules.base import AbstractRule
+
+
+def _placeholder_pattern():
+    import re
+    return re.compile(r'\$\{(\w+)\}')
+
+
+def _substitute(string, values):
+    return _placeholder_pattern().sub(r'%(\1)s', string.replace('%', '%%')) % values
+
+
+class _TemplateProfile(Profile):
+    """Stands in for a canonical profile, or a profile that records
+    comments, while a template is compiled.  The rules are rendered as
+    written, as they can only be normalized once the values have been
+    substituted, and with a profile that records comments, each comment
+    is replaced by a placeholder, so that the profile can be given the
+    comment of each instance"""
+
+    def __init__(self, profile):
+        super(_TemplateProfile, self).__init__(profile.name, headers=profile.headers, comments=profile.comments)
+        self.profile = profile
+        self.slots = []
+
+    def kernel_comment(self, comment, rule=None):
+        if not self.profile.records_comments:
+            return self.profile.kernel_comment(comment, rule)
+        if not comment:
+            return None
+        key = '__comment%d' % len(self.slots)
+        self.slots.append((key, comment, rule))
+        return '${%s}' % key
+
+
+class _CompiledTemplate(object):
+    """The output of a template rendered with a profile, as a %-format string"""
+
+    def __init__(self, template, profile):
+        pattern = _placeholder_pattern()
+        self.profile = profile
+        self.canonical = profile.canonical
+        if profile.records_comments or profile.canonical:
+            profile = _TemplateProfile(profile)
+        self.placeholders = set()
+        lines = []
+        self.rules = []
+        for line, rule in AbstractChain.iter_iptables(template, profile=profile):
+            lines.append(line)
+            self.rules.append(rule)
+        text = "\n".join(lines)
+        self.placeholders.update(pattern.findall(text))
+        self.format = pattern.sub(r'%(\1)s', text.replace('%', '%%'))
+        self.comments = self._take_comments(profile)
+        self.rule_formats = {}
+        self.rule_comments = {}
+        for rule in template:
+            definitions = "\n".join(rule.rule_definitions(profile))
+            self.placeholders.update(pattern.findall(definitions))
+            self.rule_formats[id(rule)] = pattern.sub(r'%(\1)s', definitions.replace('%', '%%'))
+            self.rule_comments[id(rule)] = self._take_comments(profile)
+
+    @staticmethod
+    def _take_comments(profile):
+        slots = getattr(profile, 'slots', [])
+        result = list(slots)
+        del slots[:]
+        return result
+
+    def values(self, values, comments):
+        """Returns values, with the kernel comments of comments added"""
+        if not comments:
+            return values
+        values = dict(values)
+        for key, comment, rule in comments:
+            kernel_comment = self.profile.kernel_comment(_substitute(comment, values), rule)
+            if not kernel_comment or '"' in kernel_comment or '\\' in kernel_comment or len(kernel_comment.split()) != 1:
+                raise ValueError('profile %s returned a comment which can\'t be used in a template: %r' % (
+                    self.profile.name, kernel_comment))
+            values[key] = kernel_comment
+        return values
+
+
+class ChainTemplate(UserChain):
+    """A UserChain with placeholders, see module documentation"""
+
+    def __init__(self, *args, **kwargs):
+        super(ChainTemplate, self).__init__(*args, **kwargs)
+        self._compiled = {}
+        pattern = _placeholder_pattern()
+        self._name_format = pattern.sub(r'%(\1)s', self.name.replace('%', '%%'))
+        self._comment_format = pattern.sub(r'%(\1)s', self.comment.replace('%', '%%')) if self.comment else None
+
+    def compile(self, profile=None):
+        """Returns the template rendered with profile (rendered on first use)"""
+        profile = get_profile(profile)
+        compiled = self._compiled.get(profile)
+        if compiled is None:
+            compiled = self._compiled[profile] = _CompiledTemplate(self, profile)
+        return compiled
+
+    @property
+    def placeholders(self):
+        """The names of the placeholders used by this template"""
+        return sorted(self.compile(VERBOSE).placeholders.union(_placeholder_pattern().findall(self.name)))
+
+    def instantiate(self, **values):
+        """Returns a TemplateChain, with the placeholders replaced by values"""
+        required = set(self.placeholders)
+        missing = required.difference(values)
+        if missing:
+            raise ValueError('missing values for placeholders: %s' % ", ".join(sorted(missing)))
+        unknown = set(values).difference(required)
+        if unknown:
+            raise ValueError('unknown placeholders: %s' % ", ".join(sorted(unknown)))
+        strings = {}
+        for key, value in values.items():
+            value = str(value)
+            if not value or '"' in value or '\\' in value or len(value.split()) != 1:
+                raise ValueError('invalid value for placeholder %s: %r' % (key, value))
+            strings[key] = value
+        return TemplateChain(self, strings)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_compiled'] = {}
+        return state
+
+    def _type_name(self):
+        return 'User Chain'
+
+
+class TemplateChain(AbstractChain):
+    """A chain created from a ChainTemplate (see ChainTemplate.instantiate())
+
+    The output is generated by substituting values into the rendered
+    template.  Rules (TemplateRule objects) are only created if the
+    chain is inspected (iterated, indexed, etc.).
+    """
+
+    def __init__(self, template, values):
+        super(TemplateChain, self).__init__(template._name_format % values)
+        if template._comment_format is not None:
+            self.comment = template._comment_format % values
+        self.template = template
+        self.values = values
+        self.filename, self.lineno, self.function = template.filename, template.lineno, template.function
+        self._materialized = False
+
+    def _materialize(self):
+        if not self._materialized:
+            self._materialized = True
+            list.extend(self, [TemplateRule(rule, self) for rule in self.template])
+
+    def __iter__(self):
+        self._materialize()
+        return list.__iter__(self)
+
+    def __len__(self):
+        self._materialize()
+        return list.__len__(self)
+
+    def __getitem__(self, index):
+        self._materialize()
+        return list.__getitem__(self, index)
+
+    def iter_iptables(self, profile=None):
+        """Yield (line, rule) tuples for the rules of this chain in iptables format
+        (rule is the template Rule object that generated the line)
+
+        Note: the chain definition is not included, see _chain_definition()
+        """
+        compiled = self.template.compile(profile)
+        values = compiled.values(self.values, compiled.comments)
+        lines = zip((compiled.format % values).split('\n'), compiled.rules)
+        if compiled.canonical:
+            from pyptables.canonical import normalize
+            return ((normalized, rule) for line, rule in lines
+                    for normalized in (normalize(line) if rule is not None else [line]))
+        return lines
+
+    def _chain_definition(self):
+        return ':%(name)s - [0:0]' % {'name': self.name}
+
+    def __reduce__(self):
+        return self.__class__, (self.template, self.values), {'comment': self.comment}
+
+    def __repr__(self):
+        return "<%s: %s - %s>" % (self.__class__.__name__, self.name, self.template.name)
+
+
+class TemplateRule(AbstractRule):
+    """A rule of a TemplateChain, a template rule with the placeholders replaced"""
+
+    def __init__(self, rule, chain):
+        super(TemplateRule, self).__init__(rule.comment)
+        self.rule = rule
+        self.chain = chain
+        self.filename, self.lineno, self.function = rule.filename, rule.lineno, rule.function
+        if self.comment:
+            self.comment = _substitute(self.comment, chain.values)
+
+    def rule_definitions(self, profile=None):
+        """Return a list of individual iptables commands that implement this rule"""
+        compiled = self.chain.template.compile(profile)
+        rule_format = compiled.rule_formats[id(self.rule)]
+        if not rule_format:
+            return []
+        values = compiled.values(self.chain.values, compiled.rule_comments[id(self.rule)])
+        return (rule_format % values).split('\n')
@@ -1,4 +1,8 @@
 import itertools
+import pickle
+import shutil
+import sys
+import tempfile
 
 import six
 from six.moves import zip_longest
@@ -7,7 +11,12 @@ import unittest
 
 from io import StringIO
 
-from pyptables import default_tables, Rule, UserChain, Jump, CustomRule
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+from pyptables import default_tables, Rule, UserChain, Jump, CustomRule, VERBOSE, COMPACT, LineIndex
 from pyptables.rules import CompositeRule
 from pyptables.rules.arguments import ArgumentList, CustomArgument
 from pyptables.rules.marks import Mark, random_mark, Marked
@@ -17,7 +26,8 @@ from pyptables.rules.forwarding.hosts import HostList, HostRange
 from pyptables.rules.forwarding.ipsets import IPSet
 from pyptables.rules.forwarding.locations import Location
 from pyptables.rules.forwarding.zones import Zone
-from pyptables.rules.forwarding.channels import TCPChannel, UDPChannel, ICMPChannel
+from pyptables.rules.forwarding.channels import TCPChannel, UDPChannel, ICMPChannel, HashLimitChannel, \
+    ConnLimitChannel
 
 
 def compare(a, b):
@@ -155,3 +165,1468 @@ class MainTest(unittest.TestCase):
                 compare(fixture, StringIO(six.u(result)))
             except ValueError as e:  # pragma: nocover
                 self.fail(str(e))
+
+
+class ProfileTest(unittest.TestCase):
+    def _tables(self):
+        tables = default_tables()
+        chain = tables['filter'].append(UserChain('test_chain', comment='A user chain'))
+        chain.append(Rule(i='eth0', s='1.1.2.1', jump='DROP', comment='A Rule'))
+        tables['filter']['INPUT'].append(Jump(chain))
+        tables['filter']['INPUT'].append(CustomRule('-j ACCEPT', comment='custom'))
+        tables['filter']['INPUT'].append(InputRule('NONE'))
+        return tables
+
+    def test_compact(self):
+        result = self._tables().to_iptables(profile='compact')
+        self.assertFalse([line for line in result.split('\n') if line.startswith('#')])
+        self.assertFalse([line for line in result.split('\n')[:-1] if not line])
+        self.assertIn('-A test_chain -i eth0 -s 1.1.2.1 -j DROP -m comment --comment "A Rule"', result)
+        self.assertIn('-A INPUT -j ACCEPT -m comment --comment "custom"', result)
+        self.assertTrue(result.startswith('*filter\n:INPUT ACCEPT [0:0]\n'))
+        self.assertTrue(result.endswith('COMMIT\n'))
+
+    def test_minimal(self):
+        result = self._tables().to_iptables(profile='minimal')
+        self.assertNotIn('#', result)
+        self.assertNotIn('comment', result)
+        self.assertIn('-A test_chain -i eth0 -s 1.1.2.1 -j DROP\n', result)
+        self.assertIn('-A INPUT -j test_chain\n', result)
+
+    def test_verbose(self):
+        tables = self._tables()
+        self.assertEqual(tables.to_iptables(), tables.to_iptables(profile=VERBOSE))
+        with self.assertRaises(ValueError):
+            tables.to_iptables(profile='bad')
+
+
+FAKE_RESTORE = os.path.join(os.path.dirname(__file__), 'fake_restore.py')
+
+
+if not six.PY2:
+    # asyncio tests, in a module of their own as they are not python 2 syntax
+    from pyptables.test.asyncio_cases import ApplyServiceTest, RestoreAsyncTest  # noqa
+
+
+class LineIndexTest(unittest.TestCase):
+    def test_index(self):
+        tables = default_tables()
+        chain = tables['filter']['FORWARD']
+        rules = [Rule(s='10.0.0.%d' % i, j='ACCEPT') for i in range(10)]
+        chain.extend(rules)
+        forwarding = ForwardingRule('DROP', sources=[Location('A', Zone('a', 'eth0'))],
+                                    destinations=Location.from_ip_list('B', None, '1.1.1.1,2.2.2.2'))
+        chain.append(forwarding)
+        index = LineIndex()
+        lines = tables.to_iptables(index=index).split('\n')
+        self.assertEqual(len(index), len(lines) - 1)
+        for line_no, line in enumerate(lines[:-1], 1):
+            entry = index[line_no]
+            if line.startswith('-A FORWARD -s 10.0.0.'):
+                self.assertIs(entry.rule, rules[int(line.split()[3].split('.')[-1])])
+                self.assertIs(entry.chain, chain)
+                self.assertIs(entry.table, tables['filter'])
+            elif line.startswith('-A FORWARD -j DROP'):
+                self.assertIs(entry.rule, forwarding)
+                self.assertEqual(entry.debug_info, forwarding.debug_info())
+            elif line.startswith(':'):
+                self.assertIsNone(entry.rule)
+                self.assertEqual(entry.chain.name, line.split()[0][1:])
+        with self.assertRaises(IndexError):
+            index[len(lines)]
+
+        stderr = "iptables-restore v1.8.7 (legacy): unknown option\nError occurred at line: %d\n" \
+                 "Try `iptables-restore -h' for more information.\n" % (lines.index(
+                     [line for line in lines if line.startswith('-A FORWARD -j DROP')][0]) + 1)
+        error, = index.errors(stderr)
+        self.assertIs(error.rule, forwarding)
+        self.assertEqual(error.message, stderr.split('\n', 2)[0] + '\n' + stderr.split('\n')[1])
+
+
+class BulkLocationTest(unittest.TestCase):
+    def test_bulk_load(self):
+        zones = {'lan': Zone('lan', 'eth0'), 'dmz': Zone('dmz', 'eth1')}
+        records = [('a', 'lan', '10.0.0.1,10.0.0.0/24'),
+                   ('b', 'dmz', '10.1.0.1-10.1.0.9'),
+                   ('c', 'lan', '10.0.0.2, 10.0.0.3-10.0.0.4'),
+                   ('d', 'dmz', ''),
+                   ('e', None, '10.0.0.1,10.0.0.0/24')]
+        result = Location.bulk_load(records, zones, source='cmdb')
+        self.assertEqual(list(result), [zones['lan'], zones['dmz'], None])
+        self.assertEqual([str(l) for l in result[zones['lan']]], ['lan: a', 'lan: c', 'lan: c'])
+        self.assertEqual([str(l) for l in result[zones['dmz']]], ['dmz: b', 'd'])
+        self.assertIs(result[zones['lan']][0].zone, zones['lan'])
+        self.assertIs(result[None][0].hosts, result[zones['lan']][0].hosts)
+        self.assertEqual(result[zones['dmz']][1].debug_info(), 'cmdb:4 bulk_load')
+        self.assertEqual(str(result[zones['dmz']][0].as_input()),
+                         '--in-interface eth1 -m iprange --src-range 10.1.0.1-10.1.0.9')
+        self.assertNotEqual(Zone('x', 'eth2').filename, 'cmdb')
+
+        for records, message in [([('a', 'wan', '1.1.1.1')], 'cmdb:1: unknown zone "wan"'),
+                                 ([('a', 'lan', '1.1.1.1'), ('b', 'lan', '1.1.1.x')], 'cmdb:2: .*1.1.1.x'),
+                                 ([('a', 'lan', '1.1.1.9-1.1.1.1')], 'cmdb:1: invalid range'),
+                                 ([('a', None, '')], 'cmdb:1: location "a" has no zone or ips')]:
+            with six.assertRaisesRegex(self, ValueError, message):
+                Location.bulk_load(records, zones, source='cmdb')
+
+    def test_csv_json(self):
+        zones = {'lan': Zone('lan', 'eth0')}
+        data = u'name,zone,ips\na,lan,1.1.1.1\nb,,2.2.2.2\n'
+        result = Location.from_csv(StringIO(data), zones, source='inventory.csv')
+        self.assertEqual([str(l) for l in result[zones['lan']]], ['lan: a'])
+        self.assertEqual(result[None][0].debug_info(), 'inventory.csv:2 bulk_load')
+        data = u'[{"name": "a", "zone": "lan", "ips": "1.1.1.1"}, {"name": "b", "ips": "2.2.2.2"}]'
+        result = Location.from_json(StringIO(data), zones)
+        self.assertEqual([str(l) for l in result[None]], ['Anywhere: b'])
+        data = u'{"name": "a", "zone": "lan", "ips": "1.1.1.1"}\n\n{"name": "b", "ips": "2.2.2.2"}\n'
+        result = Location.from_json(StringIO(data), zones)
+        self.assertEqual([str(l) for l in result[zones['lan']]], ['lan: a'])
+        self.assertEqual([str(l) for l in result[None]], ['Anywhere: b'])
+
+
+class SnapshotTest(unittest.TestCase):
+    def _tables(self):
+        tables = default_tables()
+        chain = tables['filter'].append(UserChain('test_chain', comment='A user chain'))
+        chain.append(Rule(i='eth0', s='1.1.2.1', jump='DROP', comment='A Rule'))
+        tables['filter']['INPUT'].append(Jump(chain))
+        tables['filter']['FORWARD'].append(ForwardingRule(
+            'ACCEPT',
+            sources=Location.from_ip_list('A', Zone('a', 'eth0'), '1.1.1.1,1.1.1.5-1.1.1.9'),
+            destinations=[IPSet('a_set')],
+            channels=[TCPChannel(dports='80,443')],
+        ))
+        return tables
+
+    def test_pickle(self):
+        tables = self._tables()
+        loaded = pickle.loads(pickle.dumps(tables))
+        self.assertEqual(loaded.to_iptables(), tables.to_iptables())
+        self.assertEqual(list(loaded['filter']), list(tables['filter']))
+
+    def test_snapshot(self):
+        from pyptables.snapshot import save_snapshot, load_snapshot, cached_snapshot
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'tables.snap')
+        source = os.path.join(directory, 'config.py')
+        with open(source, 'w') as config:
+            config.write('# version 1\n')
+
+        tables = self._tables()
+        built = []
+
+        def build():
+            built.append(True)
+            return tables
+
+        snapshot = cached_snapshot(path, [source], build)
+        self.assertEqual(len(built), 1)
+        snapshot = cached_snapshot(path, [source], build)
+        self.assertEqual(len(built), 1)
+        self.assertEqual(snapshot.to_iptables(), tables.to_iptables(profile='compact'))
+        self.assertEqual(list(snapshot), ['filter', 'nat', 'mangle', 'raw', 'security'])
+        self.assertEqual(snapshot['filter'].keys(), ['INPUT', 'FORWARD', 'OUTPUT', 'test_chain'])
+        self.assertEqual(snapshot['filter']._chains, {})
+        chain = snapshot['filter']['test_chain']
+        self.assertEqual(list(snapshot['filter']._chains), ['test_chain'])
+        self.assertEqual(chain.to_iptables(), tables['filter']['test_chain'].to_iptables())
+        self.assertEqual(snapshot.tables.to_iptables(), tables.to_iptables())
+        self.assertEqual(snapshot.to_iptables(profile='minimal'), tables.to_iptables(profile='minimal'))
+
+        with open(source, 'w') as config:
+            config.write('# version 2\n')
+        cached_snapshot(path, [source], build)
+        self.assertEqual(len(built), 2)
+        self.assertIsNone(load_snapshot(path, 'stale'))
+        self.assertIsNone(load_snapshot(os.path.join(directory, 'missing')))
+        with self.assertRaises(ValueError):
+            load_snapshot(source)
+        self.assertIsNotNone(save_snapshot(tables, path))
+
+
+class CostTest(unittest.TestCase):
+    def test_estimate(self):
+        from pyptables.cost import estimate
+        tables = default_tables()
+        lan, dmz = Zone('lan', 'eth0'), Zone('dmz', 'eth1')
+        lan_chain = tables['filter'].append(UserChain('from_lan'))
+        lan_chain.append(Rule(s='1.1.1.1,2.2.2.2', d='3.3.3.3,4.4.4.4', j='ACCEPT', comment='4 kernel rules'))
+        lan_chain.append(Rule(p='tcp', j='ACCEPT'))
+        lan_chain.append(Rule(j='DROP'))
+        forward = tables['filter']['FORWARD']
+        forward.append(Rule(i='eth0', j='from_lan'))
+        forward.append(Rule(i='eth1', o='eth0', j='ACCEPT'))
+        forward.append(Rule(p='udp', g='from_lan'))
+        report = estimate(tables, zones=[lan, dmz])
+
+        costs = report.chains[('filter', 'FORWARD')]
+        self.assertEqual(costs.rules, 3)
+        self.assertEqual(costs.kernel_rules, 3)
+        # jump into from_lan (6 kernel rules), then the goto into it again
+        self.assertEqual(costs.worst, 3 + 6 + 6)
+        self.assertEqual(report.chains[('filter', 'INPUT')].worst, 0)
+        self.assertNotIn(('filter', 'from_lan'), report.chains)
+
+        # packets from lan always end in from_lan
+        self.assertEqual(report.zone_pairs[('lan', 'dmz')].worst, 1 + 6)
+        self.assertEqual(report.zone_pairs[('dmz', 'lan')].worst, 2)
+        self.assertEqual(report.zone_pairs[('dmz', 'dmz')].worst, 3 + 6)
+        self.assertTrue(report.zone_pairs[('dmz', 'dmz')].average < report.zone_pairs[('dmz', 'dmz')].worst)
+
+        self.assertEqual(report.kernel_rules, 9)
+        self.assertTrue(report.memory_bytes > 9 * 152)
+        self.assertTrue(report.restore_seconds > 0)
+        self.assertEqual(report.check(max_worst=100), [])
+        self.assertEqual(report.check(max_worst=10, max_kernel_rules=5), [
+            'filter/FORWARD: worst case 15 rules exceeds 10',
+            '9 kernel rules exceeds 5',
+        ])
+        self.assertIn('filter/FORWARD', str(report))
+        self.assertEqual(report.as_dict()['kernel_rules'], 9)
+
+        loop = tables['filter'].append(UserChain('loop'))
+        loop.append(Jump(forward))
+        forward.insert(0, Jump(loop))
+        with six.assertRaisesRegex(self, ValueError, 'chain loop: FORWARD -> loop -> FORWARD'):
+            estimate(tables)
+
+    def test_notrack(self):
+        from pyptables.cost import estimate
+        from pyptables.rules.notrack import NoTrack
+        tables = default_tables()
+        prerouting = tables['raw']['PREROUTING']
+        # CT --notrack doesn't end the traversal, the kernel goes on to the next rule
+        prerouting.append(NoTrack())
+        prerouting.append(Rule(p='udp', j='ACCEPT'))
+        prerouting.append(Rule(j='DROP'))
+        self.assertEqual(prerouting[0].rule_definitions('minimal'), ['-j CT --notrack'])
+        self.assertEqual(estimate(tables).chains[('raw', 'PREROUTING')].worst, 3)
+
+    def test_shared_chains(self):
+        import time
+        from pyptables.cost import estimate
+        tables = default_tables()
+        # each level jumps to the next twice: 2 ** 30 paths, unless shared chains are only walked once
+        chain = tables['filter'].append(UserChain('level_30', rules=[Rule(j='ACCEPT', p='tcp')]))
+        for level in range(29, -1, -1):
+            chain = tables['filter'].append(UserChain('level_%d' % level, rules=[
+                Jump(chain, p='tcp'), Jump(chain, p='udp'),
+            ]))
+        tables['filter']['FORWARD'].append(Jump(chain))
+        start = time.time()
+        report = estimate(tables)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(report.chains[('filter', 'FORWARD')].worst, 1 + 2 * (2 ** 30 - 1) + 2 ** 30)
+
+
+@unittest.skipIf(numpy is None, "requires numpy")
+class SimulatorTest(unittest.TestCase):
+    def setUp(self):
+        self.tables = default_tables()
+        filter_table = self.tables['filter']
+        from_lan = filter_table.append(UserChain('from_lan'))
+        from_lan.append(Rule(p='tcp', dport='22', j='ACCEPT'))
+        from_lan.append(Rule(m='set', match_set=['bad', 'dst'], j='DROP'))
+        from_lan.append(Rule(p='udp', m='multiport', dports='53,1000:2000', j='ACCEPT'))
+        from_lan.append(Rule(j='RETURN'))
+        self.tables['mangle']['FORWARD'].append(Mark(5, s='10.1.0.0/16'))
+        forward = filter_table['FORWARD']
+        forward.policy = 'DROP'
+        forward.append(Rule(m='conntrack', ctstate='ESTABLISHED,RELATED', j='ACCEPT'))
+        forward.append(Marked(5, j='REJECT'))
+        forward.append(Rule(i='eth+', j='from_lan'))
+        forward.append(Rule(s='1.1.1.1,2.2.2.2', g='from_lan'))
+
+    def test_classify(self):
+        from pyptables.simulator import Simulator, read_packets
+        packets = read_packets(StringIO(u"""in_interface,src,dst,proto,dport,ctstate
+eth0,10.0.0.1,8.8.8.8,tcp,22,NEW
+eth0,10.0.0.1,8.8.8.8,tcp,80,ESTABLISHED
+eth1,10.0.0.1,9.9.9.9,udp,1500,NEW
+wlan0,1.1.1.1,8.8.8.8,tcp,22,NEW
+eth0,10.1.2.3,4.4.4.4,tcp,22,NEW
+eth0,10.0.0.1,4.4.4.4,udp,53,NEW
+eth0,10.0.0.1,4.4.4.4,udp,54,NEW
+wlan0,2.2.2.2,4.4.4.4,icmp,0,NEW
+"""))
+        simulator = Simulator(self.tables, sets={'bad': ['8.8.8.8', '9.9.9.0/24']})
+        result = simulator.classify(packets, path=[('mangle', 'FORWARD'), ('filter', 'FORWARD')])
+        self.assertEqual([result.verdict(i) for i in range(len(packets))],
+                         ['ACCEPT', 'ACCEPT', 'DROP', 'ACCEPT', 'REJECT', 'ACCEPT', 'DROP', 'DROP'])
+        self.assertEqual(list(result.marks), [0, 0, 0, 0, 5, 0, 0, 0])
+        self.assertEqual(dict(result.counts()), {'ACCEPT': 4, 'DROP': 3, 'REJECT': 1})
+        self.assertEqual(result.policies[('filter', 'FORWARD')], 2)
+        hits = dict((rule.line, count) for rule, count in result.rule_hits())
+        self.assertEqual(hits['-j RETURN'], 2)
+        self.assertEqual(hits['-s 1.1.1.1,2.2.2.2 -g from_lan'], 2)
+        self.assertEqual(hits['-p tcp -j ACCEPT --dport 22'], 2)
+
+        # filter only, without the mark
+        result = simulator.classify(packets, path=('filter', 'FORWARD'))
+        self.assertEqual(result.verdict(4), 'ACCEPT')
+
+    def test_errors(self):
+        from pyptables.simulator import Simulator, make_packets
+        with six.assertRaisesRegex(self, ValueError, 'unknown set bad'):
+            Simulator(self.tables)
+        simulator = Simulator(self.tables, sets={'bad': []})
+        with six.assertRaisesRegex(self, ValueError, 'is not a built-in chain'):
+            simulator.classify(make_packets(1), path=('filter', 'from_lan'))
+        self.tables['filter']['OUTPUT'].append(Rule(m='time', timestart='12:00', j='DROP'))
+        with six.assertRaisesRegex(self, ValueError, 'unsupported option --timestart'):
+            Simulator(self.tables, sets={'bad': []})
+
+
+class MarkSpaceTest(unittest.TestCase):
+    def test_allocate(self):
+        from pyptables.rules.marks import MarkSpace
+        marks = MarkSpace(0xffff0000)
+        qos = marks.reserve('qos', 0x00ff0000)
+        routing = marks.reserve('routing', 0xff000000)
+        self.assertIs(marks.reserve('qos', 0x00ff0000), qos)
+
+        bulk = qos.allocate('bulk')
+        self.assertEqual(bulk & ~0x00ff0000, 0)
+        self.assertEqual(qos.allocate('bulk'), bulk)
+        self.assertEqual(MarkSpace(0x00ff0000).allocate('bulk'), bulk)  # stable across runs
+        self.assertNotEqual(qos.allocate('interactive'), bulk)
+        self.assertEqual(routing.allocate('bulk') & ~0xff000000, 0)
+        self.assertIn('bulk', qos)
+        self.assertEqual(len(qos), 2)
+
+        self.assertEqual(qos.mark('bulk', p='tcp').rule_definitions(), [
+            '-p tcp -j MARK --set-xmark 0x%x/0xff0000' % bulk,
+        ])
+        self.assertEqual(qos.marked('bulk', j='ACCEPT').rule_definitions(), [
+            '-j ACCEPT --match mark --mark 0x%x/0xff0000' % bulk,
+        ])
+        self.assertEqual(Marked(qos.mark('bulk')).rule_definitions(), Marked(bulk, mask=0xff0000).rule_definitions())
+        self.assertEqual(Mark(5, 'a comment').comment, 'a comment')
+        self.assertEqual(Mark(5).rule_definitions(), ['-j MARK --set-mark 5'])
+
+        with six.assertRaisesRegex(self, ValueError, 'overlaps mark space qos'):
+            marks.reserve('other', 0x0f000000 | 0x00f00000)
+        with six.assertRaisesRegex(self, ValueError, 'not within mark space'):
+            marks.reserve('other', 0x0000ffff)
+        with six.assertRaisesRegex(self, ValueError, 'its bits are reserved'):
+            marks.allocate('bulk')
+        with six.assertRaisesRegex(self, ValueError, 'must be contiguous'):
+            MarkSpace(0x5)
+
+    def test_full(self):
+        from pyptables.rules.marks import MarkSpace
+        small = MarkSpace(0x70)
+        values = [small.allocate('mark %d' % i) for i in range(7)]
+        self.assertEqual(sorted(values), [0x10, 0x20, 0x30, 0x40, 0x50, 0x60, 0x70])
+        with six.assertRaisesRegex(self, ValueError, 'is full'):
+            small.allocate('one too many')
+
+    def test_random_mark(self):
+        self.assertEqual(random_mark('named').mark, random_mark('named').mark)
+        first = random_mark()
+        second = random_mark()
+        self.assertNotEqual(first.mark, second.mark)
+        self.assertNotEqual(random_mark(comment='x').mark, random_mark(comment='x').mark)
+        marks = [random_mark(p='udp') for __ in range(3)]
+        self.assertEqual(len(set(mark.mark for mark in marks)), 3)
+        self.assertEqual(marks[0].rule_definitions(), ['-p udp -j MARK --set-mark %d' % marks[0].mark])
+        self.assertEqual(first.debug_info().split()[-1], 'test_random_mark')
+
+
+class ConnMarkTest(unittest.TestCase):
+    def test_rules(self):
+        from pyptables.rules.marks import ConnMark, ConnMarked, SaveConnMark, RestoreConnMark, MarkSpace
+        self.assertEqual(ConnMark(3).rule_definitions(), ['-j CONNMARK --set-mark 3'])
+        self.assertEqual(ConnMark(3, mask=0xf).rule_definitions(), ['-j CONNMARK --set-xmark 0x3/0xf'])
+        self.assertEqual(ConnMarked(ConnMark(3, mask=0xf), j='ACCEPT').rule_definitions(),
+                         ['-j ACCEPT --match connmark --mark 0x3/0xf'])
+        self.assertEqual(SaveConnMark().rule_definitions(), ['-j CONNMARK --save-mark'])
+        self.assertEqual(RestoreConnMark(MarkSpace(0xff00)).rule_definitions(),
+                         ['-j CONNMARK --restore-mark --nfmask 0xff00 --ctmask 0xff00'])
+
+    def test_cache_name(self):
+        from pyptables.rules.marks import ConnMarkCache
+        from pyptables.validator import MAX_CHAIN_NAME
+        self.assertEqual(ConnMarkCache('classify').name, 'classify_cached')
+        names = [ConnMarkCache('classify_%s_traffic_by_port' % kind).name for kind in ('tenant', 'customer')]
+        self.assertTrue(all(len(name) == MAX_CHAIN_NAME and name.endswith('_cached') for name in names))
+        self.assertNotEqual(names[0], names[1])
+        with six.assertRaisesRegex(self, ValueError, 'at most 28 are allowed'):
+            ConnMarkCache('classify', name='a_much_too_long_cached_chain_name')
+
+    @unittest.skipIf(numpy is None, "requires numpy")
+    def test_cache(self):
+        from pyptables.rules.marks import ConnMarkCache, MarkSpace
+        from pyptables.simulator import Simulator, make_packets
+        qos = MarkSpace(0xff00)
+        tables = default_tables()
+        mangle = tables['mangle']
+        classify = mangle.append(UserChain('classify'))
+        classify.append(qos.mark('ssh', p='tcp', dport='22'))
+        classify.append(qos.mark('web', p='tcp', dport='80'))
+        cached = mangle.append(ConnMarkCache(classify, mask=qos))
+        mangle['PREROUTING'].append(Jump(cached))
+        self.assertEqual(cached.name, 'classify_cached')
+
+        # the second packet belongs to an already classified ssh connection,
+        # the third to a connection with another (unrelated) bit of the mark set
+        packets = make_packets(3, proto='tcp', dport=[22, 22, 80],
+                               ctmark=[0, qos.allocate('ssh') | 0x1, 0x10000])
+        result = Simulator(tables).classify(packets, path=('mangle', 'PREROUTING'))
+        self.assertEqual(list(result.marks), [qos.allocate('ssh'), qos.allocate('ssh'), qos.allocate('web')])
+        self.assertEqual(list(result.ctmarks), [qos.allocate('ssh'), qos.allocate('ssh') | 0x1,
+                                                0x10000 | qos.allocate('web')])
+        hits = dict((rule.rule, count) for rule, count in result.rule_hits())
+        self.assertEqual(hits[classify[0]], 1)  # only the first ssh packet was classified
+        self.assertEqual(hits[cached[1]], 1)
+
+
+class ChainTemplateTest(unittest.TestCase):
+    def build(self, chain, interface, network):
+        chain.append(Rule(i=interface, s=network, j='ACCEPT', comment='from %s' % network))
+        chain.append(Rule(p='tcp', dport='22', j='DROP'))
+        return chain
+
+    def test_instantiate(self):
+        from pyptables import ChainTemplate
+        template = self.build(ChainTemplate('tenant_${id}', comment='tenant ${id}'), '${interface}', '${network}')
+        self.assertEqual(template.placeholders, ['id', 'interface', 'network'])
+
+        tables = default_tables()
+        expected = default_tables()
+        for tenant in range(3):
+            chain = tables['filter'].append(template.instantiate(id=tenant,
+                                                                 interface='veth%d' % tenant,
+                                                                 network='10.0.%d.0/24' % tenant))
+            tables['filter']['FORWARD'].append(Jump(chain))
+            chain = expected['filter'].append(self.build(UserChain('tenant_%d' % tenant, comment='tenant %d' % tenant),
+                                                         'veth%d' % tenant, '10.0.%d.0/24' % tenant))
+            expected['filter']['FORWARD'].append(Jump(chain))
+        for profile in ('compact', 'minimal'):
+            self.assertEqual(tables.to_iptables(profile), expected.to_iptables(profile))
+        self.assertTrue(compare(StringIO(six.u(tables.to_iptables())), StringIO(six.u(expected.to_iptables()))))
+
+        chain = tables['filter']['tenant_1']
+        self.assertEqual(chain.comment, 'tenant 1')
+        self.assertEqual(len(chain), 2)
+        self.assertEqual(chain[0].comment, 'from 10.0.1.0/24')
+        self.assertEqual(chain[0].rule_definitions('minimal'), ['-i veth1 -s 10.0.1.0/24 -j ACCEPT'])
+        self.assertEqual(chain[0].debug_info(), template[0].debug_info())
+
+        index = LineIndex()
+        output = tables.to_iptables('compact', index=index).split('\n')
+        line_no = output.index('-A tenant_2 -p tcp -j DROP --dport 22') + 1
+        self.assertIs(index[line_no].rule, template[1])
+        self.assertIs(index[line_no].chain, tables['filter']['tenant_2'])
+
+        copy = pickle.loads(pickle.dumps(chain))
+        self.assertEqual(copy.to_iptables('compact'), chain.to_iptables('compact'))
+
+    def test_canonical(self):
+        from pyptables import ChainTemplate
+        from pyptables.comments import CommentIndex
+        template = ChainTemplate('tenant_${id}')
+        template.append(Rule(s='${hosts}', p='tcp', dport='${port}', j='ACCEPT', comment='tenant ${id}'))
+        chain = template.instantiate(id=1, hosts='10.0.0.1,10.0.0.2', port='http')
+        expected = UserChain('tenant_1')
+        expected.append(Rule(s='10.0.0.1,10.0.0.2', p='tcp', dport='http', j='ACCEPT', comment='tenant 1'))
+        self.assertEqual(chain.to_iptables('canonical'), expected.to_iptables('canonical'))
+        self.assertEqual(list(chain[0].iter_iptables(profile='canonical')),
+                         list(expected[0].iter_iptables(profile='canonical')))
+        self.assertEqual(len(chain.to_iptables('canonical').rules.split('\n')), 2)
+
+        index = CommentIndex()
+        index.canonical = True
+        lines = chain.to_iptables(index).rules.split('\n')
+        self.assertEqual([index.expand(line) for line in lines], expected.to_iptables('canonical').rules.split('\n'))
+
+    def test_errors(self):
+        from pyptables import ChainTemplate
+        template = self.build(ChainTemplate('tenant_${id}'), '${interface}', '10.0.0.0/8')
+        with six.assertRaisesRegex(self, ValueError, 'missing values for placeholders: interface'):
+            template.instantiate(id=1)
+        with six.assertRaisesRegex(self, ValueError, 'unknown placeholders: network'):
+            template.instantiate(id=1, interface='eth0', network='x')
+        with six.assertRaisesRegex(self, ValueError, 'invalid value for placeholder interface'):
+            template.instantiate(id=1, interface='eth0 -j ACCEPT')
+
+
+class PortForwardTest(unittest.TestCase):
+    def build(self):
+        from pyptables.rules.nat import PortForwardTable
+        forwards = PortForwardTable('port_fwd', in_interface='eth0', bucket_size=4, fanout=4)
+        for port in range(1000, 1100):
+            forwards.add('203.0.113.1', port, '10.0.0.%d' % (port % 50 + 1), 80,
+                         proto='tcp' if port % 4 else 'udp')
+        for host in range(20):
+            forwards.add('198.51.100.%d' % host, 22, '10.1.0.%d' % host)
+        return forwards
+
+    def test_rules(self):
+        from pyptables.rules.nat import DNAT, SNAT, Masquerade
+        self.assertEqual(DNAT('10.0.0.1:80', p='tcp', dport='8080').rule_definitions('minimal'),
+                         ['-p tcp -j DNAT --to-destination 10.0.0.1:80 --dport 8080'])
+        self.assertEqual(SNAT('192.0.2.1', o='eth0').rule_definitions('minimal'),
+                         ['-o eth0 -j SNAT --to-source 192.0.2.1'])
+        self.assertEqual(Masquerade(o='eth0').rule_definitions('minimal'), ['-o eth0 -j MASQUERADE'])
+        self.assertEqual(Masquerade('1024-65535', o='eth0', p='tcp').rule_definitions('minimal'),
+                         ['-o eth0 -p tcp -j MASQUERADE --to-ports 1024-65535'])
+
+    def test_tree(self):
+        from pyptables.parsing import tokenize, target
+        from pyptables.rules.nat import DNAT
+        forwards = self.build()
+        tables = default_tables()
+        root = forwards.install(tables['nat'])
+        self.assertIs(tables['nat']['port_fwd'], root)
+        self.assertEqual(tables['nat']['PREROUTING'][-1].rule_definitions('minimal'), ['-i eth0 -j port_fwd'])
+        dnat_rules = sum(len([rule for rule in chain if isinstance(rule, DNAT)])
+                         for chain in tables['nat'].values())
+        self.assertEqual(dnat_rules, 120)
+        for chain in forwards._chains:
+            self.assertLessEqual(len(chain), 8)  # two protocols, fanout 4
+        # the chains reached from a chain are disjoint, a packet traverses at most one of them
+        nat = tables['nat']
+
+        def evaluated(name):
+            targets = [target(tokenize(rule.rule_definitions('minimal')[0]))[0] for rule in nat[name]]
+            return len(nat[name]) + max([evaluated(name) for name in targets if name in nat] or [0])
+        self.assertLess(evaluated('port_fwd'), 30)
+
+    @unittest.skipIf(numpy is None, "requires numpy")
+    def test_lookup(self):
+        from pyptables.simulator import Simulator, make_packets
+        from pyptables.rules.nat import DNAT
+        forwards = self.build()
+        tables = default_tables()
+        forwards.install(tables['nat'])
+        expected = list(forwards)
+        packets = make_packets(len(expected) + 3,
+                               in_interface='eth0',
+                               dst=[forward.address for forward in expected] + ['203.0.113.1', '198.51.100.99', '203.0.113.2'],
+                               proto=[forward.proto for forward in expected] + ['tcp', 'tcp', 'tcp'],
+                               dport=[forward.port for forward in expected] + [1100, 22, 1001])
+        result = Simulator(tables).classify(packets, path=('nat', 'PREROUTING'))
+        hits = [(simulated.rule, count) for simulated, count in result.rule_hits()
+                if isinstance(simulated.rule, DNAT)]
+        self.assertEqual(len(hits), len(expected))
+        self.assertEqual(set(count for __, count in hits), set([1]))
+        self.assertEqual(sorted(rule.to_destination for rule, __ in hits),
+                         sorted('%s:%d' % (forward.to_address, forward.to_port) for forward in expected))
+
+        packets['in_interface'] = 'eth1'
+        result = Simulator(tables).classify(packets, path=('nat', 'PREROUTING'))
+        self.assertFalse([rule for rule, __ in result.rule_hits() if isinstance(rule.rule, DNAT)])
+
+    def test_ipset(self):
+        from pyptables.rules.nat import PortForwardTable
+        forwards = PortForwardTable('port_fwd', ipset='port_fwd')
+        forwards.add('203.0.113.1', 8080, '10.0.0.5', 80)
+        forwards.add('203.0.113.1', 53, '10.0.0.6', proto='udp')
+        self.assertEqual(forwards.jump().rule_definitions('minimal'),
+                         ['-j port_fwd -m set --match-set port_fwd dst,dst'])
+        self.assertEqual(forwards.ipset_restore().split('\n')[2:],
+                         ['add port_fwd 203.0.113.1,tcp:8080', 'add port_fwd 203.0.113.1,udp:53', ''])
+        with six.assertRaisesRegex(self, ValueError, 'duplicate port forward'):
+            forwards.add('203.0.113.1', 8080, '10.0.0.7')
+        with six.assertRaisesRegex(self, ValueError, 'invalid IPv4 address'):
+            forwards.add('203.0.113', 80, '10.0.0.7')
+        with six.assertRaisesRegex(self, ValueError, 'invalid port'):
+            forwards.add('203.0.113.1', 0, '10.0.0.7')
+
+
+class LimitChannelTest(unittest.TestCase):
+    def test_channels(self):
+        from pyptables.rules.matches import Match
+        hashlimit = HashLimitChannel('50/second', above=True, burst=100, expire=10000, size=65536, name='syn')
+        self.assertEqual(hashlimit.to_iptables(),
+                         '-m hashlimit --hashlimit-above 50/second --hashlimit-mode srcip --hashlimit-burst 100 '
+                         '--hashlimit-htable-expire 10000 --hashlimit-htable-size 65536 --hashlimit-name syn')
+        self.assertEqual(str(hashlimit), 'rate above 50/second per srcip (burst 100)')
+        hashlimit = HashLimitChannel('10/minute', mode='srcip,dstport', srcmask=24, p='tcp')
+        self.assertEqual(str(hashlimit), 'tcp, rate up to 10/minute per srcip,dstport')
+        self.assertEqual(hashlimit['hashlimit_name'].value,
+                         HashLimitChannel('10/minute', mode='srcip,dstport', srcmask=24)['hashlimit_name'].value)
+        names = set(HashLimitChannel('10/minute', **options)['hashlimit_name'].value for options in [
+            {}, {'expire': 10000}, {'size': 1024}, {'srcmask': 24}, {'dstmask': 24},
+            {'args': [Match('conntrack', ctstate='NEW')]},
+        ])
+        self.assertEqual(len(names), 6)
+        args = [Match('conntrack', ctstate='NEW')]
+        HashLimitChannel('10/minute', args=args)
+        ConnLimitChannel(above=20, args=args)
+        self.assertEqual(len(args), 1)
+
+        connlimit = ConnLimitChannel(above=20, mask=24)
+        self.assertEqual(connlimit.to_iptables(),
+                         '-m connlimit --connlimit-above 20 --connlimit-mask 24 --connlimit-saddr')
+        self.assertEqual(str(connlimit), 'connections above 20 per source/24')
+        self.assertEqual(str(ConnLimitChannel(upto=3, daddr=True, p='tcp')), 'tcp, connections up to 3 per destination')
+        with six.assertRaisesRegex(self, ValueError, 'exactly one of above and upto'):
+            ConnLimitChannel()
+
+    def test_rules(self):
+        limit = HashLimitChannel('50/second', above=True, name='syn')
+        limit_args = '-m hashlimit --hashlimit-above 50/second --hashlimit-mode srcip --hashlimit-name syn'
+        channel = TCPChannel(dports='80,443', states='NEW')
+        rule = ForwardingRule('DROP', sources=[Location('A', Zone('a', 'eth0'))], destinations=[],
+                              channels=[channel], limits=[limit], comment='syn flood')
+        definition, = rule.rule_definitions('compact')
+        self.assertTrue(definition.endswith('-m conntrack --ctstate NEW --in-interface eth0 %s '
+                                            '-m comment --comment "syn flood, limit rate above 50/second per srcip: '
+                                            'route A -> any, channel tcp, NEW, ports any -> 80,443"' % limit_args))
+        rule.limit_first = True
+        definition, = rule.rule_definitions('minimal')
+        self.assertEqual(definition, '-j DROP %s -p tcp -m multiport --dports 80,443 '
+                                     '-m conntrack --ctstate NEW --in-interface eth0' % limit_args)
+
+        rule = InputRule('DROP', channels=[channel, ICMPChannel()], limits=[ConnLimitChannel(above=10)],
+                         limit_first=True)
+        self.assertEqual(rule.rule_definitions('minimal'), [
+            '-j DROP -m connlimit --connlimit-above 10 --connlimit-saddr -p tcp -m multiport --dports 80,443 '
+            '-m conntrack --ctstate NEW',
+            '-j DROP -m connlimit --connlimit-above 10 --connlimit-saddr -p icmp',
+        ])
+        self.assertEqual(InputRule('DROP', channels=[limit]).rule_definitions('minimal'), ['-j DROP %s' % limit_args])
+
+
+class NFLogTest(unittest.TestCase):
+    def test_nflog(self):
+        from pyptables.rules.logs import NFLog
+        self.assertEqual(NFLog(prefix='dropped', group=5, threshold=20, copy_range=128).rule_definitions('minimal'),
+                         ['-j NFLOG --nflog-group 5 --nflog-prefix dropped --nflog-range 128 --nflog-threshold 20'])
+        with six.assertRaisesRegex(self, ValueError, 'at most 64 characters'):
+            NFLog(prefix='x' * 65)
+
+    def test_log_chains(self):
+        from functools import partial
+        from pyptables.rules.logs import NFLog, LogChains
+        log_cls = partial(NFLog, group=1, threshold=10)
+        tables = default_tables()
+        log_chains = LogChains('fwd_log', prefix='FWD', log_cls=log_cls)
+        log_chains.install(tables['filter'])
+        self.assertEqual([chain.name for chain in log_chains.chains()],
+                         ['fwd_log_accept', 'fwd_log_drop', 'fwd_log_reject', 'fwd_log_none'])
+        self.assertEqual([line for line, __ in tables['filter']['fwd_log_drop'].iter_iptables('minimal')], [
+            '-A fwd_log_drop -j NFLOG --nflog-group 1 --nflog-prefix "FWD D" --nflog-threshold 10',
+            '-A fwd_log_drop -j DROP',
+        ])
+        self.assertEqual(len(tables['filter']['fwd_log_none']), 1)
+
+        sources = Location.from_ip_list('A', Zone('a', 'eth0'), '10.0.0.1,10.0.0.2')
+        channels = [TCPChannel(dports='22'), UDPChannel(dports='53')]
+        duplicated = ForwardingRule('DROP', sources, [], channels=channels, log=True, log_id=7, log_cls=log_cls)
+        shared = ForwardingRule('DROP', sources, [], channels=channels, log=True, log_chains=log_chains)
+        self.assertEqual(len(duplicated.rule_definitions()), 4)
+        definitions = shared.rule_definitions('minimal')
+        self.assertEqual(len(definitions), 2)
+        self.assertEqual(definitions[0], '-j fwd_log_drop -p tcp -m multiport --dports 22 '
+                                         '--in-interface eth0 --source 10.0.0.1,10.0.0.2')
+        rule = InputRule('accept', channels=channels, log=True, log_chains=log_chains)
+        self.assertEqual(rule.rule_definitions('minimal')[1], '-j fwd_log_accept -p udp -m multiport --dports 53')
+        with six.assertRaisesRegex(self, ValueError, 'policy must be either'):
+            ForwardingRule('QUEUE', sources, [], log=True, log_chains=log_chains).rule_definitions()
+        self.assertEqual(ForwardingRule('DROP', sources, [], log_chains=log_chains).rule_definitions('minimal'),
+                         ['-j DROP --in-interface eth0 --source 10.0.0.1,10.0.0.2'])
+
+        if numpy is not None:
+            from pyptables.simulator import Simulator, make_packets
+            tables['filter']['FORWARD'].append(shared)
+            result = Simulator(tables).classify(make_packets(2, in_interface='eth0', src='10.0.0.2',
+                                                             proto='udp', dport=[53, 54]))
+            self.assertEqual([result.verdict(0), result.verdict(1)], ['DROP', 'ACCEPT'])
+
+
+class NoTrackTest(unittest.TestCase):
+    def test_notrack(self):
+        from pyptables.rules.notrack import NoTrack
+        self.assertEqual(NoTrack(p='udp', dport='53').rule_definitions('minimal'), ['-p udp -j CT --notrack --dport 53'])
+        self.assertEqual(NoTrack(legacy=True).rule_definitions('minimal'), ['-j NOTRACK'])
+
+    def test_forwarded_service(self):
+        from pyptables.rules.notrack import StatelessService
+        clients = Location('clients', Zone('lan', 'eth0'))
+        servers = Location.from_ip_list('dns', Zone('dmz', 'eth1'), '10.1.0.53')
+        tables = default_tables()
+        StatelessService(UDPChannel(dports='53'), [clients], servers, comment='dns').install(tables)
+        self.assertEqual([line for line, __ in tables['raw']['PREROUTING'].iter_iptables('minimal')], [
+            '-A PREROUTING -j CT --notrack --in-interface eth0 -d 10.1.0.53 -p udp -m multiport --dports 53',
+            '-A PREROUTING -j CT --notrack --in-interface eth1 --source 10.1.0.53 -p udp -m multiport --sports 53',
+        ])
+        self.assertEqual([line for line, __ in tables['filter']['FORWARD'].iter_iptables('minimal')], [
+            '-A FORWARD -j ACCEPT --in-interface eth0 --out-interface eth1 --destination 10.1.0.53 '
+            '-p udp -m multiport --dports 53',
+            '-A FORWARD -j ACCEPT --in-interface eth1 --source 10.1.0.53 --out-interface eth0 '
+            '-p udp -m multiport --sports 53',
+        ])
+        self.assertEqual(tables['filter']['FORWARD'][1].comment, 'dns: reply dmz: dns -> clients')
+
+        if numpy is not None:
+            from pyptables.simulator import Simulator, make_packets
+            tables['filter']['FORWARD'].policy = 'DROP'
+            packets = make_packets(3, in_interface=['eth0', 'eth1', 'eth1'], out_interface=['eth1', 'eth0', 'eth0'],
+                                   src=['10.0.0.1', '10.1.0.53', '10.1.0.54'], dst=['10.1.0.53', '10.0.0.1', '10.0.0.1'],
+                                   proto='udp', sport=[40000, 53, 53], dport=[53, 40000, 40000])
+            result = Simulator(tables).classify(packets, path=[('raw', 'PREROUTING'), ('filter', 'FORWARD')])
+            self.assertEqual([result.verdict(i) for i in range(3)], ['ACCEPT', 'ACCEPT', 'DROP'])
+
+    def test_local_service(self):
+        from pyptables.rules.notrack import StatelessService
+        service = StatelessService(UDPChannel(dports='123'))
+        self.assertEqual(list(service.raw_rules()), ['PREROUTING', 'OUTPUT'])
+        output, = service.filter_rules()['OUTPUT']
+        self.assertEqual(output.rule_definitions('minimal'), ['-j ACCEPT -p udp -m multiport --sports 123'])
+        self.assertIs(StatelessService(ICMPChannel()).reply_channel.__class__, ICMPChannel)
+        with six.assertRaisesRegex(self, ValueError, 'can not match connection state'):
+            StatelessService(UDPChannel(dports='53', states='NEW'))
+
+
+class OptimizerTest(unittest.TestCase):
+    def setUp(self):
+        self.tables = default_tables()
+        filter_table = self.tables['filter']
+        empty = filter_table.append(UserChain('empty'))
+        dead = filter_table.append(UserChain('dead'))
+        dead.append(Rule(j='DROP'))
+        web = filter_table.append(UserChain('web'))
+        web.append(Rule(j='ACCEPT', comment='web ok'))
+        ssh = filter_table.append(UserChain('ssh'))
+        ssh.append(Rule(p='tcp', dport='22', j='ACCEPT'))
+        lan = filter_table.append(UserChain('lan'))
+        lan.extend([Rule(s='10.0.0.%d' % i, j='ACCEPT') for i in range(3)])
+        lan.append(Rule(j='RETURN'))
+        tail = filter_table.append(UserChain('tail'))
+        tail.append(Rule(i='eth0', j='lan'))
+        tail.append(Rule(j='RETURN'))
+        forward = filter_table['FORWARD']
+        forward.policy = 'DROP'
+        forward.append(Jump(empty))
+        self.web_jump = Rule(p='tcp', dport='80', j='web', comment='to web')
+        forward.append(self.web_jump)
+        forward.append(Jump(ssh))
+        forward.append(Rule(i='eth1', j='tail'))
+        forward.append(Rule(i='eth2', g='empty'))
+        self.lan_jump = Rule(i='eth3', j='lan')
+        forward.append(self.lan_jump)
+
+    def test_optimize(self):
+        from pyptables.optimizer import optimize, OptimizedRule, JumpCount
+        optimized, report = optimize(self.tables)
+        self.assertEqual(list(optimized['filter']), ['INPUT', 'FORWARD', 'OUTPUT', 'lan', 'tail'])
+        self.assertEqual(sorted(report.removed_chains), [('filter', 'dead', 'unreferenced'),
+                                                         ('filter', 'empty', 'empty'),
+                                                         ('filter', 'ssh', 'unreferenced'),
+                                                         ('filter', 'web', 'unreferenced')])
+        self.assertEqual(optimized['filter'].to_iptables('minimal').split('\n')[6:], [
+            '-A FORWARD -p tcp -j ACCEPT --dport 80 -m comment --comment "to web"',
+            '-A FORWARD -p tcp -j ACCEPT --dport 22',
+            '-A FORWARD -i eth1 -j tail',
+            '-A FORWARD -i eth2 -j RETURN',
+            '-A FORWARD -i eth3 -g lan',
+            '-A lan -s 10.0.0.0 -j ACCEPT',
+            '-A lan -s 10.0.0.1 -j ACCEPT',
+            '-A lan -s 10.0.0.2 -j ACCEPT',
+            '-A tail -i eth0 -g lan',
+            'COMMIT',
+        ])
+        forward = optimized['filter']['FORWARD']
+        self.assertIsInstance(forward[0], OptimizedRule)
+        self.assertIs(forward[0].rule, self.web_jump)
+        self.assertIs(forward[1], self.tables['filter']['ssh'][0])
+        self.assertIs(forward[4].rule, self.lan_jump)
+        self.assertEqual(forward[0].rule_definitions(), ['-p tcp -j ACCEPT --dport 80 -m comment --comment "to web"'])
+        self.assertEqual(report.before[('filter', 'FORWARD')], JumpCount(jumps=7, returns=6))
+        self.assertEqual(report.after[('filter', 'FORWARD')], JumpCount(jumps=3, returns=1))
+        self.assertEqual((report.rules_before, report.rules_after), (15, 9))
+        self.assertEqual((report.inlined, report.gotos, report.returns_removed), (2, 2, 2))
+        self.assertIn('filter/FORWARD', str(report))
+        self.assertEqual(len(self.tables['filter']), 9)  # not modified
+
+        optimized, report = optimize(self.tables, remove_unreferenced=False)
+        self.assertIn('dead', optimized['filter'])
+        self.assertNotIn('empty', optimized['filter'])
+
+    @unittest.skipIf(numpy is None, "requires numpy")
+    def test_equivalent(self):
+        from pyptables.optimizer import optimize
+        from pyptables.simulator import Simulator, make_packets
+        optimized, __ = optimize(self.tables)
+        count = 512
+        random = numpy.random.RandomState(1)
+        packets = make_packets(count,
+                               in_interface=numpy.array(['eth0', 'eth1', 'eth2', 'eth3'])[random.randint(0, 4, count)],
+                               src=random.randint(0x0a000000, 0x0a000004, count).astype('u4'),
+                               proto=numpy.array(['tcp', 'udp'])[random.randint(0, 2, count)],
+                               dport=numpy.array([22, 80, 443])[random.randint(0, 3, count)])
+        expected = Simulator(self.tables).classify(packets)
+        result = Simulator(optimized).classify(packets)
+        self.assertEqual(list(result.verdicts), list(expected.verdicts))
+
+    def test_loop(self):
+        from pyptables.optimizer import optimize
+        self.tables['filter']['lan'].append(Rule(s='10.1.0.0/16', j='tail'))
+        with six.assertRaisesRegex(self, ValueError, 'chain loop: tail -> lan -> tail'):
+            optimize(self.tables)
+
+
+class HistoryTest(unittest.TestCase):
+    def setUp(self):
+        from pyptables.history import History
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.history = History(self.directory, keep=3)
+
+    def _tables(self, version):
+        tables = default_tables()
+        tables['filter']['INPUT'].append(CustomRule('-s 10.0.0.%d -j DROP' % version))
+        return tables
+
+    def test_record(self):
+        from pyptables.history import fingerprint
+        tables = self._tables(1)
+        payload = tables.to_iptables(profile='compact')
+        entry = self.history.record(payload, tables=tables, profile=COMPACT)
+        self.assertEqual(entry.fingerprint, fingerprint(payload))
+        self.assertEqual(entry.profile, 'compact')
+        self.assertEqual(entry.source, tables.debug_info())
+        self.assertEqual(entry.tables['filter'], 3)
+        self.assertEqual(self.history.entries(), [entry])
+        self.assertEqual(self.history.payload(0), payload)
+        self.assertEqual(self.history.payload(entry.fingerprint[:10]), payload)
+
+        self.history.record(payload)
+        self.assertEqual(len(self.history), 2)
+        self.assertEqual(len(os.listdir(os.path.join(self.directory, 'objects'))), 1)
+        with self.assertRaises(KeyError):
+            self.history.get(2)
+        with self.assertRaises(KeyError):
+            self.history.get('abcdef0123')
+
+    def test_retention(self):
+        payloads = [self._tables(version).to_iptables() for version in range(5)]
+        for payload in payloads:
+            self.history.record(payload)
+        self.assertEqual([self.history.payload(i) for i in range(3)], payloads[:1:-1])
+        self.assertEqual(len(os.listdir(os.path.join(self.directory, 'objects'))), 3)
+
+        from pyptables.history import History
+        history = History(self.directory, keep=3, max_bytes=1)
+        history.prune()
+        self.assertEqual([entry.fingerprint for entry in history.entries()],
+                         [self.history.get(0).fingerprint])
+        self.assertEqual(len(os.listdir(os.path.join(self.directory, 'objects'))), 1)
+
+    def test_rollback(self):
+        log = os.path.join(self.directory, 'restore.log')
+        command = [sys.executable, FAKE_RESTORE, log]
+        first, second = self._tables(1).to_iptables(), self._tables(2).to_iptables()
+        self.history.record(first)
+        self.history.record(second)
+        entry, stdout, stderr = self.history.rollback(command=command)
+        self.assertEqual(entry, self.history.get(2))
+        with open(log) as restored:
+            self.assertEqual(restored.read(), "ARGS: \n%s" % first)
+        latest = self.history.get(0)
+        self.assertEqual(latest.fingerprint, entry.fingerprint)
+        self.assertEqual(latest.comment, 'rollback to %s' % entry.fingerprint[:12])
+
+        self.history.record('*filter\nFAIL\nCOMMIT\n')
+        with six.assertRaisesRegex(self, RuntimeError, 'line 2 failed'):
+            self.history.rollback(0, command=command)
+        self.assertEqual(len(self.history), 3)
+
+    def test_restore_snapshot(self):
+        from pyptables import restore
+        from pyptables.snapshot import save_snapshot
+        log = os.path.join(self.directory, 'restore.log')
+        bin_dir = os.path.join(self.directory, 'bin')
+        os.mkdir(bin_dir)
+        script = os.path.join(bin_dir, 'iptables-restore')
+        with open(script, 'w') as fake:
+            fake.write('#!/bin/sh\nexec "%s" "%s" "%s" "$@"\n' % (sys.executable, FAKE_RESTORE, log))
+        os.chmod(script, 0o755)
+        self.addCleanup(os.environ.__setitem__, 'PATH', os.environ['PATH'])
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+
+        snapshot = save_snapshot(self._tables(1), os.path.join(self.directory, 'rules.snap'))
+        restore(snapshot, history=self.history)
+        entry = self.history.get(0)
+        self.assertEqual(self.history.payload(0), snapshot.output)
+        self.assertEqual(entry.tables['filter'], 3)
+
+        stdout, stderr = result = restore('*filter\nFAIL\nCOMMIT\n', history=self.history)
+        self.assertEqual(result.returncode, 1)
+        self.assertIn(b'line 2 failed', stderr)
+        self.assertEqual(len(self.history), 1)
+
+
+class PrefixTreeTest(unittest.TestCase):
+    def setUp(self):
+        import random
+        from pyptables.rules.prefixtree import PrefixTree
+        rand = random.Random(43)
+        self.tree = PrefixTree('per_host', {'0.0.0.0/1': 'REJECT', '10.0.0.0/8': 'DROP'}, bucket_size=4, bits=2)
+        for i in range(300):
+            length = rand.choice([16, 20, 24, 28, 30, 32, 32, 32])
+            cidr = '10.%d.%d.%d/%d' % (rand.randrange(4), rand.randrange(256), rand.randrange(256), length)
+            try:
+                self.tree.add(cidr, rand.choice(['DROP', 'REJECT']))
+            except ValueError:
+                pass  # duplicate prefix
+        self.addresses = ['10.%d.%d.%d' % (rand.randrange(5), rand.randrange(256), rand.randrange(256))
+                          for i in range(2000)]
+        self.addresses += ['%s.%s' % (cidr.rsplit('.', 1)[0], i) for cidr in ('10.0.0.0', '172.16.0.0', '200.0.0.0')
+                           for i in (0, 1, 255)]
+
+    def test_lookup(self):
+        from pyptables.rules.prefixtree import PrefixTree
+        tree = PrefixTree('t', [('10.0.0.0/8', 'a'), ('10.1.0.0/16', 'b'), ('10.1.2.3', 'c')])
+        self.assertEqual([tree.lookup(address) for address in ('10.1.2.3', '10.1.2.4', '10.2.0.0', '11.0.0.0')],
+                         ['c', 'b', 'a', None])
+        self.assertEqual([str(rule) for rule in tree.flat_rules()],
+                         [str(Rule(s='10.1.2.3/32', jump='c')), str(Rule(s='10.1.0.0/16', jump='b')),
+                          str(Rule(s='10.0.0.0/8', jump='a'))])
+        with six.assertRaisesRegex(self, ValueError, 'duplicate prefix 10.1.0.0/16'):
+            tree.add('10.1.255.255/16', UserChain('x'))
+        with six.assertRaisesRegex(self, ValueError, 'invalid IPv4 address or network: 10.1/33'):
+            tree.add('10.1/33', 'a')
+
+    def test_tree(self):
+        chains = self.tree.chains()
+        self.assertGreater(len(chains), 10)
+        self.assertTrue(all(len(chain) <= 2 ** self.tree.bits + 4 for chain in chains))
+        names = set(chain.name for chain in chains)
+
+        def evaluated(chain):
+            targets = [rule.rule_definitions('minimal')[0].split()[-1] for rule in chain]
+            return len(chain) + max([evaluated(chains[int(name.rsplit('_', 1)[1])])
+                                     for name in targets if name in names and name != self.tree.name] or [0])
+        self.assertLess(evaluated(chains[0]), len(self.tree) // 4)
+
+    @unittest.skipIf(numpy is None, "requires numpy")
+    def test_equivalent(self):
+        from pyptables.simulator import Simulator, make_packets
+        packets = make_packets(len(self.addresses), src=self.addresses)
+        flat = default_tables()
+        flat['filter']['FORWARD'].extend(self.tree.flat_rules())
+        tree = default_tables()
+        self.tree.install(tree['filter'], 'FORWARD')
+        expected = [self.tree.lookup(address) or 'ACCEPT' for address in self.addresses]
+        for tables in (flat, tree):
+            result = Simulator(tables).classify(packets)
+            self.assertEqual([result.verdict(i) for i in range(len(packets))], expected)
+
+
+class ValidatorTest(unittest.TestCase):
+    def test_line(self):
+        from pyptables.validator import validate_line
+        self.assertEqual(validate_line('-A FORWARD -i eth0 -p tcp --dport 80 -m conntrack --ctstate NEW -j ACCEPT'),
+                         [])
+        self.assertEqual(validate_line('--dport 80 -p tcp -m foo -j LOG --prefix x'), [
+            'option --dport requires -m tcp (before it)',
+            'unknown match foo',
+            'unknown option --prefix',
+        ])
+        self.assertEqual(validate_line('-j ACCEPT -p tcp -m multiport --dports 2 --sports 1'),
+                         ['multiport: only one of --dports, --sports may be given'])
+        self.assertEqual(validate_line('-p udp -m multiport --dports 1,2,3,4,5,6,7,8,9,10,11,12,13,14:15'), [])
+        self.assertEqual(validate_line('-p udp -m multiport --dports 1,2,3,4,5,6,7,8,9,10,11,12,13,14,15:16'),
+                         ['--dports lists 16 ports (ranges count as 2), at most 15 are allowed'])
+        self.assertEqual(validate_line('-s 1.1.1.1 -s 2.2.2.2 -m set --match-set a -j CT --notrack 1',
+                                       table='filter'), [
+            'multiple -s options',
+            'option --match-set expects 2 values, got 1',
+            'target CT is only valid in the raw table',
+            'option --notrack takes no value, got 1',
+        ])
+        self.assertEqual(validate_line('-i a_very_long_interface -j chain', chains=['other']), [
+            'interface name a_very_long_interface is longer than 15 characters',
+            'unknown target or chain chain',
+        ])
+
+    def test_rule(self):
+        from pyptables.rules import Log
+        from pyptables.rules.logs import NFLog
+        from pyptables.validator import validate_rule
+        self.assertEqual(validate_rule(Rule(p='tcp', dport='22', j='ACCEPT', comment='x' * 255)), [])
+        self.assertEqual(validate_rule(Rule(j='ACCEPT', comment=u'é' * 128)),
+                         ['comment is 256 bytes long, at most 255 are allowed'])
+        self.assertEqual(validate_rule(Log(prefix='dropped')), ['unknown option --prefix'])
+        self.assertEqual(validate_rule(NFLog(prefix='dropped', group=1)), [])
+        self.assertEqual(validate_rule(UDPChannel(dports='53', states='NEW')), [])
+        self.assertEqual(validate_rule(HashLimitChannel('50/second', above=True)), [])
+
+    def test_tables(self):
+        from pyptables.rules.nat import DNAT
+        from pyptables.validator import validate
+        tables = default_tables()
+        chain = tables['filter'].append(UserChain('a_chain_with_a_name_too_long_for_iptables'))
+        rule = Rule(p='tcp', dports='22', j='missing')
+        chain.append(rule)
+        tables['filter']['INPUT'].append(Jump(chain))
+        tables['nat']['PREROUTING'].append(DNAT('10.0.0.1', p='tcp', dport='80'))
+        errors = validate(tables)
+        self.assertEqual([error.message for error in errors], [
+            'chain name a_chain_with_a_name_too_long_for_iptables is 41 characters long, at most 28 are allowed',
+            'unknown target or chain missing',
+            'option --dports requires -m multiport (before it)',
+        ])
+        output = tables.to_iptables().split('\n')
+        self.assertEqual(output[errors[1].line - 1], '-A a_chain_with_a_name_too_long_for_iptables -p tcp -j missing '
+                                                     '--dports 22')
+        self.assertIs(errors[1].rule, rule)
+        self.assertIs(errors[1].table, tables['filter'])
+        self.assertEqual(errors[1].debug_info, rule.debug_info())
+
+        payload = tables.to_iptables(profile='minimal')
+        self.assertEqual([error.message for error in validate(payload)], [error.message for error in errors])
+        self.assertEqual(validate(default_tables()), [])
+
+
+class CommentIndexTest(unittest.TestCase):
+    def _tables(self, extra=False):
+        tables = default_tables()
+        forward = tables['filter']['FORWARD']
+        if extra:
+            forward.append(Rule(i='eth9', j='DROP', comment='an extra rule'))
+        lan = Location.from_ip_list('LAN', Zone('lan', 'eth0'), '10.0.0.0/8')
+        dmz = Location.from_ip_list('DMZ', Zone('dmz', 'eth1'), '192.168.0.0/24')
+        self.rule = ForwardingRule('ACCEPT', lan, dmz, channels=[TCPChannel(dports='80'), UDPChannel(dports='53')],
+                                   comment='lan to "dmz" services')
+        forward.append(self.rule)
+        forward.append(CustomRule('-p icmp -j ACCEPT'))
+        return tables
+
+    def test_index(self):
+        from pyptables.comments import CommentIndex, CommentEntry
+        index = CommentIndex()
+        output = self._tables().to_iptables(profile=index)
+        compact = self._tables().to_iptables(profile='compact')
+        self.assertEqual(len(index), 2)
+        ids = list(index)
+        self.assertTrue(all(len(comment_id) == 12 for comment_id in ids))
+        self.assertEqual(index[ids[0]].comment, 'lan to "dmz" services: route lan: LAN -> dmz: DMZ, channel tcp, ports any -> 80')
+        self.assertEqual(index[ids[0]].sources, [self.rule.debug_info()])
+        lines = [line for line in output.split('\n') if line.startswith('-A')]
+        self.assertEqual(lines[0], '-A FORWARD -j ACCEPT -p tcp -m multiport --dports 80 --in-interface eth0 '
+                                   '--source 10.0.0.0/8 --out-interface eth1 --destination 192.168.0.0/24 '
+                                   '-m comment --comment %s' % ids[0])
+        self.assertEqual(lines[2], '-A FORWARD -p icmp -j ACCEPT')
+        self.assertEqual([index.expand(line) for line in lines],
+                         [line for line in compact.split('\n') if line.startswith('-A')])
+
+        # IDs don't change when other rules are added
+        other = CommentIndex()
+        self._tables(extra=True).to_iptables(profile=other)
+        self.assertEqual(list(other)[1:], ids)
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'comments.json')
+        index.save(path)
+        loaded = CommentIndex.load(path)
+        self.assertEqual([loaded[comment_id] for comment_id in loaded], [index[comment_id] for comment_id in ids])
+        self.assertEqual(loaded.expand(lines[1]), index.expand(lines[1]))
+
+        # a failed save leaves the previous index in place
+        index._entries['broken'] = CommentEntry(object(), [])
+        with self.assertRaises(TypeError):
+            index.save(path)
+        self.assertEqual(len(CommentIndex.load(path)), 2)
+        self.assertEqual(os.listdir(directory), ['comments.json'])
+
+    def test_derived_rules(self):
+        from pyptables.comments import CommentIndex
+        index = CommentIndex()
+        self._tables().to_iptables(profile=index)
+        self.assertEqual([index[comment_id].sources for comment_id in index], [[self.rule.debug_info()]] * 2)
+
+        rule = InputRule('ACCEPT', channels=[TCPChannel(dports='22'), UDPChannel(dports='53')], comment='services')
+        definitions = rule.iter_definitions(index)
+        next(definitions)
+        other = CustomRule('-j DROP')  # created while the derived rules are being generated
+        self.assertEqual(len(list(definitions)), 1)
+        self.assertNotEqual(other.debug_info(), rule.debug_info())
+        self.assertEqual(index[index.comment_id('services, channel udp, ports any -> 53')].sources,
+                         [rule.debug_info()])
+
+    def test_template(self):
+        from pyptables import ChainTemplate
+        from pyptables.comments import CommentIndex
+        template = ChainTemplate('tenant_${id}')
+        template.append(Rule(i='${interface}', j='ACCEPT', comment='from ${interface}'))
+        template.append(CustomRule('-j DROP', comment='tenant ${id}'))
+        tables = default_tables()
+        for tenant in range(2):
+            tables['filter'].append(template.instantiate(id=tenant, interface='veth%d' % tenant))
+        index = CommentIndex()
+        lines = [line for line in tables.to_iptables(profile=index).split('\n') if line.startswith('-A')]
+        self.assertEqual(len(set(lines)), 4)
+        self.assertEqual(sorted(entry.comment for entry in map(index.__getitem__, index)),
+                         ['from veth0', 'from veth1', 'tenant 0', 'tenant 1'])
+        self.assertEqual([index.expand(line) for line in lines],
+                         [line for line in tables.to_iptables(profile='compact').split('\n') if line.startswith('-A')])
+        rule = tables['filter']['tenant_1'][0]
+        self.assertEqual(index.expand(rule.rule_definitions(index)[0]), rule.rule_definitions('compact')[0])
+        self.assertEqual(index[index.comment_id('from veth1')].sources, [template[0].debug_info()])
+
+    def test_collision(self):
+        from pyptables.comments import CommentIndex
+        index = CommentIndex(digits=4)
+        with six.assertRaisesRegex(self, ValueError, 'have the same ID'):
+            for i in range(100000):
+                index.kernel_comment('comment %d' % i)
+
+
+class FleetTest(unittest.TestCase):
+    def _base(self):
+        from pyptables.fleet import FleetBase
+        tables = default_tables()
+        services = tables['filter'].append(UserChain('services', comment='Common services'))
+        services.append(Rule(p='tcp', dport='22', j='ACCEPT'))
+        tables['filter'].append(UserChain('empty'))
+        tables['filter']['INPUT'].append(Jump(services))
+        return FleetBase(tables)
+
+    def _host(self, base, name):
+        host = base.host(name)
+        host.replace('filter', UserChain('services', rules=[Rule(p='tcp', dport='80', j='ACCEPT')]))
+        host.add('filter', UserChain('admin', comment='Admin access', rules=[Rule(s='10.0.0.1', j='ACCEPT')]))
+        host.append('filter', 'INPUT', Jump('admin'))
+        host.prepend('filter', 'empty', Rule(s='192.0.2.1', j='DROP'))
+        host.append('filter', 'admin', Rule(j='DROP'))
+        host.append('nat', 'POSTROUTING', Rule(o='eth0', j='MASQUERADE'))
+        return host
+
+    def test_overlay(self):
+        base = self._base()
+        before = base.tables.to_iptables(profile=COMPACT)
+        host = self._host(base, 'web01')
+        for profile in ('verbose', 'compact', 'minimal'):
+            self.assertEqual(host.to_iptables(profile=profile), host.tables().to_iptables(profile=profile))
+            self.assertEqual(base.host('plain').to_iptables(profile=profile), base.tables.to_iptables(profile=profile))
+        self.assertEqual(base.tables.to_iptables(profile=COMPACT), before)
+        lines = host.to_iptables(profile=COMPACT).split('\n')
+        self.assertEqual(lines[lines.index(':empty - [0:0]') + 1], ':admin - [0:0]')
+        self.assertIn('-A INPUT -j admin', lines)
+        self.assertIn('-A services -p tcp -j ACCEPT --dport 80', lines)
+        self.assertNotIn('-A services -p tcp -j ACCEPT --dport 22', lines)
+
+        with six.assertRaisesRegex(self, ValueError, 'already exists'):
+            host.add('filter', UserChain('services'))
+        with six.assertRaisesRegex(self, KeyError, 'not in table'):
+            host.replace('filter', UserChain('missing'))
+        with six.assertRaisesRegex(self, KeyError, 'not in table'):
+            host.append('filter', 'missing', Rule(j='DROP'))
+
+    def test_render_fleet(self):
+        from pyptables.fleet import render_fleet
+        base = self._base()
+        hosts = dict((name, self._host(base, name)) for name in ('web01', 'web02', 'db01'))
+        hosts['db01'].append('filter', 'services', Rule(p='tcp', dport='5432', j='ACCEPT'))
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for processes in (1, 2):
+            reports = render_fleet(hosts, os.path.join(directory, str(processes)), profile=COMPACT,
+                                   processes=processes)
+            self.assertEqual([report.host for report in reports], list(hosts))
+            for report in reports:
+                with open(report.path) as output:
+                    self.assertEqual(output.read(), hosts[report.host].to_iptables(profile=COMPACT))
+                self.assertEqual(os.path.basename(report.path), '%s.rules' % report.host)
+                self.assertTrue(report.seconds >= 0)
+
+        for name in ('../web03', 'a/b', '..', ''):
+            with six.assertRaisesRegex(self, ValueError, 'invalid host name'):
+                render_fleet({name: hosts['web01']}, os.path.join(directory, 'bad'), processes=1)
+        self.assertEqual(sorted(os.listdir(directory)), ['1', '2'])
+
+
+class IPSetTest(unittest.TestCase):
+    def test_scripts(self):
+        ip_set = IPSet('blocklist', 'hash:net', timeout=3600, members=['10.0.0.0/8', '192.0.2.1/32'])
+        ip_set.add('198.51.100.0/24', timeout=60)
+        self.assertIn('192.0.2.1', ip_set)
+        self.assertEqual(ip_set.restore_script().split('\n'), [
+            'create blocklist hash:net family inet maxelem 65536 timeout 3600 -exist',
+            'flush blocklist',
+            'add blocklist 10.0.0.0/8',
+            'add blocklist 192.0.2.1',
+            'add blocklist 198.51.100.0/24 timeout 60',
+            '',
+        ])
+        self.assertEqual(ip_set.swap_script().split('\n'), [
+            'create blocklist-tmp hash:net family inet maxelem 65536 timeout 3600 -exist',
+            'flush blocklist-tmp',
+            'add blocklist-tmp 10.0.0.0/8',
+            'add blocklist-tmp 192.0.2.1',
+            'add blocklist-tmp 198.51.100.0/24 timeout 60',
+            'create blocklist hash:net family inet maxelem 65536 timeout 3600 -exist',
+            'swap blocklist-tmp blocklist',
+            'destroy blocklist-tmp',
+            '',
+        ])
+        ports = IPSet('web', 'hash:ip,port', members=['203.0.113.1,80', '203.0.113.1,udp:53'])
+        self.assertEqual(list(ports), ['203.0.113.1,tcp:80', '203.0.113.1,udp:53'])
+        self.assertEqual(Rule(j='ACCEPT', args=[ports.as_output()]).rule_definitions('minimal'),
+                         ['-j ACCEPT -m set --match-set web dst,dst'])
+        bitmap = IPSet('low_ports', 'bitmap:port', range='1-1023', members=['22'])
+        self.assertEqual(bitmap.create_line(), 'create low_ports bitmap:port range 1-1023 -exist')
+
+        with six.assertRaisesRegex(self, ValueError, 'unknown set type'):
+            IPSet('bad', 'hash:foo')
+        with six.assertRaisesRegex(self, ValueError, 'require a range'):
+            IPSet('bad', 'bitmap:port')
+        with six.assertRaisesRegex(self, ValueError, 'invalid member'):
+            ports.add('203.0.113.1')
+        with six.assertRaisesRegex(self, ValueError, 'has no timeout'):
+            ports.add('203.0.113.2,80', timeout=10)
+        with six.assertRaisesRegex(self, ValueError, 'managed elsewhere'):
+            IPSet('external').restore_script()
+
+    def test_update(self):
+        saved = IPSet.from_save(
+            'create blocklist hash:net family inet hashsize 1024 maxelem 65536 timeout 3600 counters bucketsize 12\n'
+            'add blocklist 10.0.0.0/8 timeout 3000 packets 0 bytes 0\n'
+            'add blocklist 203.0.113.0/24 timeout 10 packets 0 bytes 0\n'
+        )
+        previous = saved['blocklist']
+        self.assertEqual((previous.set_type, previous.maxelem, previous.timeout), ('hash:net', 65536, 3600))
+        self.assertEqual(previous.timeout_of('10.0.0.0/8'), 3000)
+        ip_set = IPSet('blocklist', 'hash:net', timeout=3600, members=['10.0.0.0/8', '192.0.2.1/32'])
+        self.assertEqual(ip_set.diff(previous), (['192.0.2.1'], ['203.0.113.0/24']))
+        self.assertEqual(ip_set.update_script(previous).split('\n'), [
+            'del blocklist 203.0.113.0/24 -exist',
+            'add blocklist 192.0.2.1 -exist',
+            '',
+        ])
+        self.assertEqual(ip_set.update_script(previous, max_changes=1), ip_set.swap_script(previous=previous))
+        self.assertEqual(ip_set.update_script(None), ip_set.swap_script())
+        ip_set.timeout = 60
+        self.assertEqual(ip_set.update_script(previous), ip_set.swap_script(previous=previous))
+        with six.assertRaisesRegex(self, ValueError, 'changed type'):
+            IPSet('blocklist', 'hash:ip').diff(previous)
+        with six.assertRaisesRegex(self, ValueError, 'can not be swapped'):
+            IPSet('blocklist', 'hash:ip').update_script(previous)
+
+    def test_maxelem_growth(self):
+        previous = IPSet.from_save('create bl hash:net family inet hashsize 1024 maxelem 65536\n'
+                                   'add bl 10.0.0.0/24\n')['bl']
+        ip_set = IPSet('bl', 'hash:net', members=['10.%d.%d.0/24' % (i // 256, i % 256) for i in range(40000)])
+        script = ip_set.update_script(previous).split('\n')
+        # the live set exists with the old options, only the temporary set is created, the swap resizes it
+        self.assertEqual([line for line in script if line.startswith('create')],
+                         ['create bl-tmp hash:net family inet maxelem 131072 -exist'])
+        self.assertEqual(script[-3:], ['swap bl-tmp bl', 'destroy bl-tmp', ''])
+        self.assertEqual(ip_set.restore_script(IPSet('bl', 'hash:net', maxelem=131072)).split('\n')[0], 'flush bl')
+        with six.assertRaisesRegex(self, ValueError, 'must be swapped'):
+            ip_set.restore_script(previous)
+
+    def test_restore(self):
+        from pyptables.rules.forwarding.ipsets import ipset_restore
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        log = os.path.join(directory, 'restore.log')
+        script = IPSet('blocklist', 'hash:ip', members=['192.0.2.1']).restore_script()
+        returncode, __, __ = ipset_restore(script, command=[sys.executable, FAKE_RESTORE, log])
+        self.assertEqual(returncode, 0)
+        with open(log) as restored:
+            self.assertEqual(restored.read(), 'ARGS: \n' + script)
+
+    @unittest.skipIf(numpy is None, "requires numpy")
+    def test_simulator(self):
+        from pyptables.simulator import Simulator, make_packets
+        tables = default_tables()
+        blocklist = IPSet('blocklist', 'hash:net', members=['192.0.2.0/24'])
+        tables['filter']['FORWARD'].append(Rule(j='DROP', args=[blocklist.as_input()]))
+        packets = make_packets(2, src=['192.0.2.1', '10.0.0.1'])
+        result = Simulator(tables, sets=[blocklist]).classify(packets, path=('filter', 'FORWARD'))
+        self.assertEqual([result.verdict(i) for i in range(2)], ['DROP', 'ACCEPT'])
+
+
+class CounterTest(unittest.TestCase):
+    def _tables(self):
+        tables = default_tables()
+        lan = Location.from_ip_list('LAN', Zone('lan', 'eth0'), '10.0.0.0/8')
+        dmz = Location.from_ip_list('DMZ', Zone('dmz', 'eth1'), '192.168.0.0/24')
+        self.web = ForwardingRule('ACCEPT', lan, dmz, channels=[TCPChannel(dports='80'), UDPChannel(dports='53')],
+                                  comment='web')
+        tables['filter']['FORWARD'].append(self.web)
+        ssh = tables['filter'].append(UserChain('ssh'))
+        self.admin = Rule(s='192.0.2.1', j='ACCEPT', comment='admin "host"')
+        self.hosts = Rule(s='192.0.2.2,192.0.2.3', j='ACCEPT')
+        self.drop = Rule(j='DROP')
+        ssh.extend([self.admin, self.hosts, self.drop])
+        self.jump = Rule(p='tcp', dport='22', j='ssh')
+        tables['filter']['INPUT'].append(self.jump)
+        return tables
+
+    def _fixture(self, name):
+        with open(os.path.join(os.path.dirname(__file__), name)) as fixture:
+            return fixture.read()
+
+    def test_parse(self):
+        from pyptables.counters import CounterSample, PolicyCounter
+        saved = CounterSample.from_save(self._fixture('counters.save'), time=100)
+        listed = CounterSample.from_list({'filter': self._fixture('counters.list')}, time=100)
+        self.assertEqual(len(saved), 7)
+        self.assertEqual([(c.table, c.chain, c.position, c.packets, c.bytes, c.comment) for c in saved],
+                         [(c.table, c.chain, c.position, c.packets, c.bytes, c.comment) for c in listed])
+        self.assertEqual(saved.rules[3].comment, 'admin "host"')
+        self.assertEqual(saved.rules[3].rule, '-A ssh -s 192.0.2.1/32 -m comment --comment "admin \\"host\\"" -j ACCEPT')
+        self.assertEqual(listed.rules[6].rule, 'DROP all -- * * 0.0.0.0/0 0.0.0.0/0')
+        self.assertEqual(saved.policies[1], PolicyCounter('filter', 'FORWARD', 'DROP', 5, 300))
+        self.assertEqual(saved.policies[:3], listed.policies)
+        self.assertEqual(len(saved.policies), 7)
+
+    def test_rule_map(self):
+        from pyptables.counters import CounterSample, RuleMap, RuleCounter
+        tables = self._tables()
+        rule_map = RuleMap(tables, profile=COMPACT)
+        self.assertEqual(len(rule_map), 7)
+        sample = CounterSample.from_save(self._fixture('counters.save'))
+        self.assertEqual([rule_map[counter] for counter in sample],
+                         [self.jump, self.web, self.web, self.admin, self.hosts, self.hosts, self.drop])
+        # rules inserted by another tool: found by comment, or not at all
+        inserted = [RuleCounter('filter', 'FORWARD', counter.position + 1, 0, 0, counter.rule, counter.comment)
+                    for counter in sample.rules[1:3]]
+        self.assertEqual([rule_map[counter] for counter in inserted], [self.web, self.web])
+        self.assertIsNone(rule_map[RuleCounter('filter', 'ssh', 9, 0, 0, '-A ssh -j DROP', None)])
+
+    def test_rates(self):
+        from pyptables.counters import CounterSample
+        output = self._fixture('counters.save')
+        previous = CounterSample.from_save(output, time=100)
+        later = output.replace('[1000:1500000]', '[1500:2250000]').replace('[37:2220]', '[7:420]').replace(
+            '[40:2400] -A INPUT -p tcp', '[45:2700] -A INPUT -p udp')
+        current = CounterSample.from_save(later, time=110)
+        rates = dict(((rate.counter.chain, rate.counter.position), rate) for rate in current.rates(previous))
+        self.assertEqual((rates['FORWARD', 1].packets, rates['FORWARD', 1].bytes), (50.0, 75000.0))
+        self.assertEqual(rates['FORWARD', 2].packets, 0)
+        self.assertEqual(rates['ssh', 4].packets, 0.7)
+        self.assertNotIn(('INPUT', 1), rates)
+        with six.assertRaisesRegex(self, ValueError, 'must be older'):
+            previous.rates(current)
+
+    def test_export(self):
+        import json
+        from pyptables.comments import CommentIndex
+        from pyptables.counters import CounterSample, RuleMap
+        tables = self._tables()
+        sample = CounterSample.from_save(self._fixture('counters.save'), time=100)
+        exported = json.loads(sample.to_json(RuleMap(tables, profile=COMPACT)))
+        self.assertEqual(exported['rules'][1]['sources'], [self.web.debug_info()])
+        self.assertEqual(exported['rules'][1]['packets'], 1000)
+        self.assertEqual(exported['policies'][0]['chain'], 'INPUT')
+        self.assertEqual(sample.by_comment()['admin "host"'], [3, 180])
+
+        text = sample.to_prometheus()
+        self.assertIn('# TYPE iptables_rule_packets_total counter', text)
+        self.assertIn('iptables_rule_bytes_total{table="filter",chain="ssh",position="1",'
+                      'comment="admin \\"host\\""} 180', text)
+        self.assertIn('iptables_policy_packets_total{table="filter",chain="FORWARD",policy="DROP"} 5', text)
+
+        # comment IDs are expanded by the CommentIndex the rules were written with
+        index = CommentIndex()
+        payload = tables.to_iptables(profile=index)
+        counters = "\n".join('[7:700] %s' % line if line.startswith('-A') else line for line in payload.split('\n'))
+        text = CounterSample.from_save(counters).to_prometheus(index, prefix='fw')
+        self.assertIn('fw_rule_packets_total{table="filter",chain="ssh",position="1",source="%s",'
+                      'comment="admin \\"host\\""} 7' % self.admin.debug_info(), text)
+
+
+class LazyRuleTest(unittest.TestCase):
+    def test_iter_definitions(self):
+        zone = Zone('lan', 'eth0')
+        sources = [Location('host %d' % i, zone, HostList(['10.0.0.%d' % i])) for i in range(20)]
+        destinations = [Location('server %d' % i, zone, HostList(['10.1.0.%d' % i])) for i in range(20)]
+        channel = TCPChannel(dports='80')
+        rule = ForwardingRule('ACCEPT', sources, destinations, channels=[channel, UDPChannel(dports='53')])
+        definitions = rule.iter_definitions('minimal')
+        self.assertFalse(isinstance(definitions, list))
+        self.assertEqual(next(definitions), '-j ACCEPT -p tcp -m multiport --dports 80 --in-interface eth0 '
+                                            '--source 10.0.0.0 --out-interface eth0 --destination 10.1.0.0')
+        self.assertEqual(len(rule.rule_definitions('minimal')), 800)
+        self.assertEqual(rule.rule_definitions('minimal'), list(rule.iter_definitions('minimal')))
+
+        # a channel shared by every generated rule only gets the known arguments once
+        known_args = len(channel.known_args)
+        rule.rule_definitions('minimal')
+        self.assertEqual(len(channel.known_args), known_args)
+
+        composite = CompositeRule([rule, InputRule('DROP', sources=sources[:2])])
+        self.assertEqual(list(composite.iter_definitions('minimal'))[-2:],
+                         ['-j DROP --in-interface eth0 --source 10.0.0.0', '-j DROP --in-interface eth0 --source 10.0.0.1'])
+        self.assertEqual(len(composite.rule_definitions('minimal')), 802)
+
+
+class CanonicalTest(unittest.TestCase):
+    def test_normalize(self):
+        from pyptables.canonical import normalize
+        self.assertEqual(normalize('-A INPUT -p tcp -s 1.2.3.4 -j ACCEPT --dport 22 -m comment --comment "ssh"'),
+                         ['-A INPUT -s 1.2.3.4/32 -p tcp -m tcp --dport 22 -m comment --comment ssh -j ACCEPT'])
+        self.assertEqual(normalize('-A X -s 10.0.0.1,10.0.0.2 -d 192.168.1.5/255.255.255.0 -j DROP'),
+                         ['-A X -s 10.0.0.1/32 -d 192.168.1.0/24 -j DROP', '-A X -s 10.0.0.2/32 -d 192.168.1.0/24 -j DROP'])
+        self.assertEqual(normalize('-A X -p TCP --syn --destination-port ! 22 -j REJECT'),
+                         ['-A X -p tcp -m tcp ! --dport 22 --tcp-flags FIN,SYN,RST,ACK SYN '
+                          '-j REJECT --reject-with icmp-port-unreachable'])
+        self.assertEqual(normalize('-A X -m conntrack --ctstate ESTABLISHED,NEW -m limit --limit 60/minute '
+                                   '-j LOG --log-level info --log-prefix "X: "'),
+                         ['-A X -m conntrack --ctstate NEW,ESTABLISHED -m limit --limit 1/sec '
+                          '-j LOG --log-prefix "X: " --log-level 6'])
+        self.assertEqual(normalize('-A X -d 0.0.0.0/0 -p udp --dport 0:65535 -j MARK --set-mark 5'),
+                         ['-A X -p udp -m udp -j MARK --set-xmark 0x5/0xffffffff'])
+        self.assertEqual(normalize('-A X -m comment --comment "it\'s" -j ACCEPT'),
+                         ['-A X -m comment --comment "it\\\'s" -j ACCEPT'])
+        # iptables-save output is already canonical (counters are dropped)
+        line = '-A X -s 10.0.0.0/8 -p tcp -m multiport --dports 80,443 -m comment --comment "a \\"b\\"" -j ACCEPT'
+        self.assertEqual(normalize('[5:300] %s' % line), [line])
+
+    def test_rules(self):
+        from pyptables.canonical import normalize
+        from pyptables.rules.matches import Match
+        rule = Rule(s='192.0.2.1,192.0.2.2', p='tcp', j='ACCEPT', dport='22', comment='admin')
+        self.assertEqual(rule.canonical_definitions(), [
+            '-s 192.0.2.1/32 -p tcp -m tcp --dport 22 -m comment --comment admin -j ACCEPT',
+            '-s 192.0.2.2/32 -p tcp -m tcp --dport 22 -m comment --comment admin -j ACCEPT',
+        ])
+        self.assertEqual(CustomRule('-j DROP -p udp', comment='x y').canonical_definitions(COMPACT),
+                         ['-p udp -m comment --comment "x y" -j DROP'])
+        self.assertEqual(Match('multiport', dports='80,https', p='tcp').to_canonical(), ['-p tcp -m multiport --dports 80,443'])
+
+        tables = default_tables()
+        tables['filter']['INPUT'].append(rule)
+        lines = [line for line in tables.to_iptables(profile='canonical').split('\n') if line.startswith('-A')]
+        self.assertEqual(lines, ['-A INPUT %s' % line for line in rule.canonical_definitions()])
+        self.assertEqual([normalize(line) for line in lines], [[line] for line in lines])
+
+    def test_lazy_import(self):
+        import subprocess
+        # importing pyptables stays cheap: the canonicalizer (and the modules
+        # it needs) are only imported when a rule is normalized
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        code = ("import sys; sys.path.insert(0, %r); before = set(sys.modules); import pyptables; "
+                "print(' '.join(sorted(set(sys.modules) - before)))" % root)
+        imported = subprocess.check_output([sys.executable, '-c', code]).decode('utf-8').split()
+        for module in ('re', 'socket', 'subprocess', 'six', 'pyptables.validator', 'pyptables.canonical'):
+            self.assertNotIn(module, imported)
+        self.assertIn('pyptables.rules.base', imported)
+
+    def test_render_save(self):
+        from pyptables.canonical import render_save
+        from pyptables.service import render_chains, delta_payload
+        tables = CounterTest('test_parse')._tables()
+        tables['filter']['FORWARD'].policy = 'DROP'
+        with open(os.path.join(os.path.dirname(__file__), 'counters.save')) as fixture:
+            output = fixture.read()
+        saved = render_save(output)
+        self.assertEqual(render_save(output, normalized=True), saved)
+        self.assertEqual(saved[0], render_chains(tables, profile='canonical')[0])
+        self.assertEqual(saved[0][1][0], ('INPUT', ':INPUT ACCEPT [0:0]', '-A INPUT -p tcp -m tcp --dport 22 -j ssh'))
+
+        # only the chains which differ from the kernel are rewritten
+        tables['filter']['ssh'].insert(0, Rule(s='192.0.2.4', j='ACCEPT'))
+        payload = delta_payload(saved[:1], render_chains(tables, profile='canonical')[:1])
+        self.assertEqual(payload.split('\n')[:4], ['*filter', ':ssh - [0:0]', '-F ssh', '-A ssh -s 192.0.2.4/32 -j ACCEPT'])
+        self.assertNotIn('-A INPUT', payload)
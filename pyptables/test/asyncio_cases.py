@@ -0,0 +1,171 @@
+"""Tests of the asyncio modules (pyptables.service and pyptables.aio),
+   imported by the test package on python 3 only.
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+from pyptables import default_tables, UserChain, CustomRule
+from pyptables.test import FAKE_RESTORE
+
+
+class ApplyServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.log = tempfile.NamedTemporaryFile(suffix='.log', delete=False).name
+        self.addCleanup(os.unlink, self.log)
+
+    def _tables(self, *rules):
+        tables = default_tables()
+        chain = tables['filter'].append(UserChain('test_chain'))
+        for rule in rules:
+            chain.append(CustomRule(rule))
+        return tables
+
+    def _log(self):
+        with open(self.log) as log:
+            return log.read()
+
+    def test_service(self):
+        from pyptables.service import ApplyService, ApplyError
+
+        async def run():
+            service = ApplyService(command=[sys.executable, FAKE_RESTORE, self.log], debounce=0.01)
+            await service.start()
+            futures = [service.submit(self._tables('-j ACCEPT %d' % i)) for i in range(3)]
+            await asyncio.gather(*futures)
+            self.assertEqual(service.metrics.applied, 1)
+            self.assertEqual(service.metrics.coalesced, 2)
+            self.assertEqual(service.metrics.full_applies, 1)
+            self.assertIn('-A test_chain -j ACCEPT 2\n', self._log())
+            self.assertNotIn('-j ACCEPT 1', self._log())
+
+            await service.submit(self._tables('-j DROP'))
+            self.assertEqual(service.metrics.delta_applies, 1)
+            log = self._log()
+            self.assertIn('ARGS: --noflush\n*filter\n:test_chain - [0:0]\n-F test_chain\n-A test_chain -j DROP\nCOMMIT\n', log)
+            self.assertNotIn('*nat', log.split('--noflush')[1])
+
+            await service.submit(self._tables('-j DROP'))
+            self.assertEqual(service.metrics.delta_applies, 1)
+            self.assertEqual(service.metrics.applied, 3)
+
+            with self.assertRaises(ApplyError):
+                await service.submit(self._tables('FAIL'))
+            self.assertEqual(service.metrics.failures, 1)
+            self.assertEqual(service.metrics.delta_applies, 1)
+            await service.submit(self._tables('-j REJECT'))
+            self.assertEqual(service.metrics.full_applies, 2)
+            await service.stop()
+
+        asyncio.run(run())
+
+    def test_late_delta_failure(self):
+        from pyptables.service import ApplyService, ApplyError
+
+        async def run():
+            service = ApplyService(command=[sys.executable, FAKE_RESTORE, self.log], debounce=0.01)
+            await service.start()
+            await service.submit(self._tables('-j ACCEPT'))
+            with self.assertRaises(ApplyError) as cm:
+                await service.submit(self._tables('-j ACCEPT SLOW', 'FAIL'))
+            self.assertEqual(cm.exception.returncode, 1)
+            self.assertEqual(service.metrics.delta_applies, 0)
+            self.assertEqual(service.metrics.failures, 1)
+            await service.submit(self._tables('-j DROP'))
+            self.assertEqual(service.metrics.full_applies, 2)
+            await service.stop()
+
+        asyncio.run(run())
+
+    def test_stop_while_applying(self):
+        from pyptables.service import ApplyService
+
+        async def run():
+            service = ApplyService(command=[sys.executable, FAKE_RESTORE, self.log], debounce=0.01)
+            await service.start()
+            future = service.submit(self._tables('-j ACCEPT SLOW'))
+            await asyncio.sleep(0.1)  # the update is being applied
+            await service.stop()
+            self.assertGreater(future.result(), 0)  # applied, rather than cancelled
+            self.assertIn('-A test_chain -j ACCEPT SLOW\n', self._log())
+            self.assertEqual(service.metrics.applied, 1)
+
+        asyncio.run(run())
+
+    def test_cancel_while_applying(self):
+        from pyptables.service import ApplyService, ApplyError
+
+        async def run():
+            service = ApplyService(command=[sys.executable, FAKE_RESTORE, self.log], debounce=0.01)
+            await service.start()
+            future = service.submit(self._tables('SLEEP'))
+            await asyncio.sleep(0.1)
+            start = time.time()
+            service._task.cancel()
+            with self.assertRaises(ApplyError):
+                await asyncio.wait_for(future, 5)
+            self.assertLess(time.time() - start, 5)  # iptables-restore was killed, not waited for
+            await service.stop()
+
+        asyncio.run(run())
+
+
+class RestoreAsyncTest(unittest.TestCase):
+    def setUp(self):
+        self.log = tempfile.NamedTemporaryFile(suffix='.log', delete=False).name
+        self.addCleanup(os.unlink, self.log)
+        self.command = [sys.executable, FAKE_RESTORE, self.log]
+
+    def _tables(self, rule):
+        tables = default_tables()
+        chain = tables['filter'].append(UserChain('test_chain'))
+        chain.append(CustomRule('-j ACCEPT'))
+        chain.append(rule)
+        return tables
+
+    def test_restore(self):
+        from pyptables.aio import restore_async
+        tables = self._tables(CustomRule('-j DROP'))
+        result = asyncio.run(restore_async(tables, command=self.command, chunk_size=100))
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.errors, [])
+        with open(self.log) as log:
+            self.assertEqual(log.read(), "ARGS: \n%s" % tables.to_iptables())
+
+    def test_errors(self):
+        from pyptables.aio import restore_async
+        rule = CustomRule('FAIL')
+        tables = self._tables(rule)
+        result = asyncio.run(restore_async(tables, command=self.command, profile='compact'))
+        self.assertEqual(result.returncode, 1)
+        self.assertFalse(result.rolled_back)
+        error, = result.errors
+        self.assertEqual(error.line, 7)
+        self.assertIs(error.rule, rule)
+        self.assertIs(error.chain, tables['filter']['test_chain'])
+        self.assertIs(error.table, tables['filter'])
+        self.assertEqual(error.debug_info, rule.debug_info())
+        self.assertEqual(error.message, 'iptables-restore: line 7 failed')
+
+    def test_large_stderr(self):
+        from pyptables.aio import restore_async
+        command = [sys.executable, '-c', 'import sys; sys.stderr.write("x" * 1048576); sys.stderr.flush(); '
+                                         'sys.stdout.write(str(len(sys.stdin.read())))']
+        payload = "-A test_chain -j ACCEPT\n" * 20000
+        result = asyncio.run(restore_async(payload, command=command, timeout=10))
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.stdout, str(len(payload)))
+        self.assertEqual(len(result.stderr), 1048576)
+
+    def test_timeout_rollback(self):
+        from pyptables.aio import restore_async
+        save = [sys.executable, '-c', 'print("*filter"); print("COMMIT")']
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(restore_async(self._tables(CustomRule('SLEEP')), command=self.command,
+                                      timeout=0.5, rollback=True, save_command=save))
+        with open(self.log) as log:
+            self.assertTrue(log.read().endswith("ARGS: \n*filter\nCOMMIT\n"))
@@ -0,0 +1,33 @@
+"""A fake iptables-restore for use in tests.
+
+Usage: python fake_restore.py LOGFILE [iptables-restore arguments]
+
+Each invocation appends an "ARGS:" line with its arguments to LOGFILE,
+followed by every line read from stdin.  A line containing "FAIL"
+causes it to report an error for that line and exit, as
+iptables-restore does, a line containing "SLEEP" makes it hang and
+a line containing "SLOW" delays it briefly.
+"""
+
+import sys
+import time
+
+
+def main(argv):
+    with open(argv[1], 'a') as log:
+        log.write("ARGS: %s\n" % " ".join(argv[2:]))
+        log.flush()
+        for line_no, line in enumerate(iter(sys.stdin.readline, ''), 1):
+            if 'FAIL' in line:
+                sys.stderr.write("iptables-restore: line %d failed\n" % line_no)
+                sys.exit(1)
+            if 'SLEEP' in line:
+                time.sleep(60)
+            if 'SLOW' in line:
+                time.sleep(0.2)
+            log.write(line)
+            log.flush()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,20 @@
+"""This module contains file helpers shared by the modules writing
+   output to disk.
+"""
+
+import os
+import tempfile
+
+
+def write_atomic(path, data):
+    """Write data (bytes) to path, through a temporary file in the same
+    directory renamed over path, so readers never see a partial file
+    """
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as temp:
+            temp.write(data)
+        os.rename(temp_path, path)
+    except Exception:
+        os.unlink(temp_path)
+        raise
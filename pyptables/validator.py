@@ -0,0 +1,384 @@
+"""This module contains an offline validator for generated rules.
+
+   validate() checks the rules of a Tables object (or an
+   iptables-restore payload) against a table of the iptables matches and
+   targets and their options, so that rules iptables-restore would
+   reject are found when the tables are built, rather than when the
+   payload is written into the kernel:
+
+   for error in validate(tables):
+       print(error.line, error.message, error.debug_info)
+
+   The checks are:
+
+   - unknown options, match modules and targets, and options used
+     before (or without) the -m, -p or -j that provides them
+   - the number of values given to each option
+   - repeated options, and mutually exclusive options of a match or
+     target (e.g. --sports and --dports in a single multiport match)
+   - comments longer than 255 bytes, more than 15 ports in a multiport
+     match, interface names longer than 15 characters, chain names longer
+     than 28 characters and LOG/NFLOG prefixes longer than 29/64 characters
+   - jumps to chains that are not defined in the table, and targets used
+     outside the tables they are valid in (e.g. DNAT outside nat)
+
+   Options must be given in full (iptables also accepts unambiguous
+   abbreviations of long options).  validate_rule() checks a single Rule
+   (or ArgumentList, e.g. a Match) and returns a list of messages.
+"""
+
+from collections import namedtuple
+
+import six
+
+from pyptables.parsing import tokenize, options
+from pyptables.profiles import get_profile
+
+
+ValidationError = namedtuple('ValidationError', 'line message table chain rule debug_info')
+ValidationError.__doc__ = """A problem found by validate()
+
+line       - the line number of the payload the problem was found in
+message    - the problem
+table      - the Table that generated the line (or None)
+chain      - the Chain that generated the line (or None)
+rule       - the Rule that generated the line (or None)
+debug_info - where the rule (or chain, or table) was created
+"""
+
+MAX_COMMENT_BYTES = 255
+MAX_MULTIPORT_PORTS = 15
+MAX_INTERFACE_NAME = 15
+MAX_CHAIN_NAME = 28
+
+# the generic options, mapped to (preferred name, number of values);
+# the number of values is an int, or a (minimum, maximum) tuple
+CORE_OPTIONS = {}
+for _names, _arity in (
+        (('-A', '--append'), 1),
+        (('-I', '--insert'), (1, 2)),
+        (('-s', '--source', '--src'), 1),
+        (('-d', '--destination', '--dst'), 1),
+        (('-i', '--in-interface'), 1),
+        (('-o', '--out-interface'), 1),
+        (('-p', '--proto', '--protocol'), 1),
+        (('-f', '--fragment'), 0),
+        (('-j', '--jump'), 1),
+        (('-g', '--goto'), 1),
+        (('-m', '--match'), 1),
+        (('-c', '--set-counters'), 2),
+):
+    for _name in _names:
+        CORE_OPTIONS[_name] = (_names[0], _arity)
+
+
+def _options(*groups):
+    """Returns a dictionary of option -> number of values from groups of
+    (number of values, option names...)"""
+    result = {}
+    for group in groups:
+        for name in group[1:]:
+            result[name] = group[0]
+    return result
+
+
+_CONNTRACK_OPTIONS = ('--ctstate', '--ctproto', '--ctorigsrc', '--ctorigdst', '--ctreplsrc', '--ctrepldst',
+                      '--ctorigsrcport', '--ctorigdstport', '--ctreplsrcport', '--ctrepldstport',
+                      '--ctstatus', '--ctexpire', '--ctdir')
+
+# match modules, mapped to their options
+MATCHES = {
+    'addrtype': _options((1, '--src-type', '--dst-type'), (0, '--limit-iface-in', '--limit-iface-out')),
+    'comment': _options((1, '--comment')),
+    'connbytes': _options((1, '--connbytes', '--connbytes-dir', '--connbytes-mode')),
+    'connlimit': _options((1, '--connlimit-upto', '--connlimit-above', '--connlimit-mask'),
+                          (0, '--connlimit-saddr', '--connlimit-daddr')),
+    'connmark': _options((1, '--mark')),
+    'conntrack': _options((1,) + _CONNTRACK_OPTIONS),
+    'devgroup': _options((1, '--src-group', '--dst-group')),
+    'dscp': _options((1, '--dscp', '--dscp-class')),
+    'hashlimit': _options((1, '--hashlimit', '--hashlimit-upto', '--hashlimit-above', '--hashlimit-burst',
+                           '--hashlimit-mode', '--hashlimit-srcmask', '--hashlimit-dstmask', '--hashlimit-name',
+                           '--hashlimit-htable-size', '--hashlimit-htable-max', '--hashlimit-htable-expire',
+                           '--hashlimit-htable-gcinterval')),
+    'helper': _options((1, '--helper')),
+    'icmp': _options((1, '--icmp-type')),
+    'iprange': _options((1, '--src-range', '--dst-range')),
+    'length': _options((1, '--length')),
+    'limit': _options((1, '--limit', '--limit-burst')),
+    'mac': _options((1, '--mac-source')),
+    'mark': _options((1, '--mark')),
+    'multiport': _options((1, '--sports', '--source-ports', '--dports', '--destination-ports', '--ports')),
+    'owner': _options((1, '--uid-owner', '--gid-owner'), (0, '--socket-exists', '--suppl-groups')),
+    'physdev': _options((1, '--physdev-in', '--physdev-out'),
+                        (0, '--physdev-is-in', '--physdev-is-out', '--physdev-is-bridged')),
+    'pkttype': _options((1, '--pkt-type')),
+    'policy': _options((1, '--dir', '--pol', '--reqid', '--spi', '--proto', '--mode', '--tunnel-src',
+                        '--tunnel-dst'), (0, '--strict', '--next')),
+    'recent': _options((1, '--name', '--seconds', '--hitcount', '--mask'),
+                       (0, '--set', '--rcheck', '--update', '--remove', '--rttl', '--rsource', '--rdest',
+                        '--reap')),
+    'rpfilter': _options((0, '--loose', '--validmark', '--accept-local', '--invert')),
+    'set': _options((2, '--match-set'), (1, '--packets-eq', '--packets-lt', '--packets-gt', '--bytes-eq',
+                                         '--bytes-lt', '--bytes-gt'),
+                    (0, '--return-nomatch', '--update-counters', '--update-subcounters')),
+    'socket': _options((0, '--transparent', '--nowildcard', '--restore-skmark')),
+    'state': _options((1, '--state')),
+    'statistic': _options((1, '--mode', '--probability', '--every', '--packet')),
+    'string': _options((1, '--algo', '--from', '--to', '--string', '--hex-string'), (0, '--icase')),
+    'tcp': _options((1, '--sport', '--source-port', '--dport', '--destination-port', '--tcp-option'),
+                    (2, '--tcp-flags'), (0, '--syn')),
+    'time': _options((1, '--datestart', '--datestop', '--timestart', '--timestop', '--monthdays', '--weekdays'),
+                     (0, '--contiguous', '--kerneltz', '--utc')),
+    'tos': _options((1, '--tos')),
+    'ttl': _options((1, '--ttl-eq', '--ttl-gt', '--ttl-lt')),
+    'u32': _options((1, '--u32')),
+    'udp': _options((1, '--sport', '--source-port', '--dport', '--destination-port')),
+}
+
+# targets, mapped to their options
+TARGETS = {
+    'ACCEPT': {},
+    'DROP': {},
+    'RETURN': {},
+    'QUEUE': {},
+    'NOTRACK': {},
+    'TRACE': {},
+    'REJECT': _options((1, '--reject-with')),
+    'LOG': _options((1, '--log-level', '--log-prefix'),
+                    (0, '--log-tcp-sequence', '--log-tcp-options', '--log-ip-options', '--log-uid',
+                     '--log-macdecode')),
+    'NFLOG': _options((1, '--nflog-group', '--nflog-prefix', '--nflog-range', '--nflog-size', '--nflog-threshold')),
+    'NFQUEUE': _options((1, '--queue-num', '--queue-balance'), (0, '--queue-bypass', '--fail-open',
+                                                                '--queue-cpu-fanout')),
+    'DNAT': _options((1, '--to-destination'), (0, '--random', '--persistent')),
+    'SNAT': _options((1, '--to-source'), (0, '--random', '--random-fully', '--persistent')),
+    'MASQUERADE': _options((1, '--to-ports'), (0, '--random', '--random-fully')),
+    'REDIRECT': _options((1, '--to-ports'), (0, '--random')),
+    'MARK': _options((1, '--set-mark', '--set-xmark', '--and-mark', '--or-mark', '--xor-mark')),
+    'CONNMARK': _options((1, '--set-mark', '--set-xmark', '--and-mark', '--or-mark', '--xor-mark', '--nfmask',
+                          '--ctmask', '--mask'), (0, '--save-mark', '--restore-mark')),
+    'CT': _options((1, '--helper', '--ctevents', '--expevents', '--zone', '--zone-orig', '--zone-reply',
+                    '--timeout'), (0, '--notrack')),
+    'TCPMSS': _options((1, '--set-mss'), (0, '--clamp-mss-to-pmtu')),
+    'TOS': _options((1, '--set-tos', '--and-tos', '--or-tos', '--xor-tos')),
+    'DSCP': _options((1, '--set-dscp', '--set-dscp-class')),
+    'TTL': _options((1, '--ttl-set', '--ttl-dec', '--ttl-inc')),
+    'SET': _options((2, '--add-set', '--del-set'), (1, '--timeout'), (0, '--exist')),
+    'CLASSIFY': _options((1, '--set-class')),
+    'TPROXY': _options((1, '--on-port', '--on-ip', '--tproxy-mark')),
+    'CHECKSUM': _options((0, '--checksum-fill')),
+    'AUDIT': _options((1, '--type')),
+}
+
+# options of which at most one may be given to a match or target
+EXCLUSIVE = {
+    'multiport': ('--sports', '--source-ports', '--dports', '--destination-ports', '--ports'),
+    'hashlimit': ('--hashlimit-upto', '--hashlimit-above'),
+    'connlimit': ('--connlimit-upto', '--connlimit-above'),
+    'MARK': ('--set-mark', '--set-xmark', '--and-mark', '--or-mark', '--xor-mark'),
+}
+
+# targets only valid in some tables
+TARGET_TABLES = {
+    'DNAT': ('nat',),
+    'SNAT': ('nat',),
+    'MASQUERADE': ('nat',),
+    'REDIRECT': ('nat',),
+    'CT': ('raw',),
+    'NOTRACK': ('raw',),
+    'TPROXY': ('mangle',),
+}
+
+# the match module of each option, for error messages
+_OPTION_MODULES = {}
+for _module, _module_options in sorted(MATCHES.items(), reverse=True):
+    for _name in _module_options:
+        _OPTION_MODULES[_name] = '-m %s' % _module
+for _target, _target_options in sorted(TARGETS.items(), reverse=True):
+    for _name in _target_options:
+        _OPTION_MODULES.setdefault(_name, '-j %s' % _target)
+
+# protocols which load the match module of the same name
+IMPLICIT_MATCHES = ('tcp', 'udp', 'icmp')
+
+_PREFIX_LIMITS = {'--log-prefix': 29, '--nflog-prefix': 64}
+_CHECKED_VALUES = frozenset(('--comment',) + EXCLUSIVE['multiport'] + tuple(_PREFIX_LIMITS))
+
+
+def _arity_error(option, arity, values):
+    low, high = arity if isinstance(arity, tuple) else (arity, arity)
+    if low <= len(values) <= high:
+        return None
+    if high == 0:
+        return 'option %s takes no value, got %s' % (option, " ".join(values))
+    return 'option %s expects %s value%s, got %d' % (option, low if low == high else '%d-%d' % (low, high),
+                                                     '' if high == 1 else 's', len(values))
+
+
+def _port_count(ports):
+    return sum(2 if ':' in port else 1 for port in ports.split(','))
+
+
+def _check_value(option, values, messages):
+    """Checks the value of a match or target option"""
+    value = values[0]
+    if option == '--comment':
+        size = len(value.encode('utf-8'))
+        if size > MAX_COMMENT_BYTES:
+            messages.append('comment is %d bytes long, at most %d are allowed' % (size, MAX_COMMENT_BYTES))
+    elif option in EXCLUSIVE['multiport']:
+        count = _port_count(value)
+        if count > MAX_MULTIPORT_PORTS:
+            messages.append('%s lists %d ports (ranges count as 2), at most %d are allowed' % (
+                option, count, MAX_MULTIPORT_PORTS))
+    elif option in _PREFIX_LIMITS and len(value) > _PREFIX_LIMITS[option]:
+        messages.append('%s is %d characters long, at most %d are allowed' % (
+            option, len(value), _PREFIX_LIMITS[option]))
+
+
+def _check_chain_name(name, messages):
+    if len(name) > MAX_CHAIN_NAME:
+        messages.append('chain name %s is %d characters long, at most %d are allowed' % (
+            name, len(name), MAX_CHAIN_NAME))
+
+
+def validate_line(line, chains=None, table=None):
+    """Returns a list of the problems found in a rule definition (with or
+    without the leading "-A CHAIN")
+
+    chains - the names of the chains defined in the table, to check jump
+             targets against (default: jumps to chains are not checked)
+    table  - the table name, to check targets against (default: not checked)
+    """
+    messages = []
+    core = set()
+    loaded = []  # [(name, options, used options)], latest last
+    implicit = None
+    for inverse, option, values in options(tokenize(line)):
+        spec = CORE_OPTIONS.get(option)
+        if spec is not None:
+            name, arity = spec
+            if name in core and name != '-m':
+                messages.append('multiple %s options' % name)
+            core.add(name)
+            if arity != len(values):
+                error = _arity_error(option, arity, values)
+                if error:
+                    messages.append(error)
+                    continue
+            value = values[0] if values else None
+            if name in ('-A', '-I'):
+                if chains is None:  # otherwise checked where the chain is defined
+                    _check_chain_name(value, messages)
+            elif name in ('-i', '-o') and len(value.rstrip('+')) > MAX_INTERFACE_NAME:
+                messages.append('interface name %s is longer than %d characters' % (value, MAX_INTERFACE_NAME))
+            elif name == '-p' and not inverse and value.lower() in IMPLICIT_MATCHES:
+                implicit = (value.lower(), MATCHES[value.lower()], set())
+            elif name == '-m':
+                if value not in MATCHES:
+                    messages.append('unknown match %s' % value)
+                else:
+                    loaded.append((value, MATCHES[value], set()))
+            elif name in ('-j', '-g'):
+                if value in TARGETS:
+                    if name == '-g':
+                        messages.append('can not goto target %s, only a chain' % value)
+                    loaded.append((value, TARGETS[value], set()))
+                    if table is not None and table not in TARGET_TABLES.get(value, (table,)):
+                        messages.append('target %s is only valid in the %s table' % (
+                            value, " and ".join(TARGET_TABLES[value])))
+                elif chains is None:
+                    _check_chain_name(value, messages)
+                elif value not in chains:
+                    messages.append('unknown target or chain %s' % value)
+            continue
+        for module in reversed(loaded):
+            if option in module[1]:
+                break
+        else:
+            if implicit is not None and option in implicit[1]:
+                module = implicit
+            else:
+                if option in _OPTION_MODULES:
+                    messages.append('option %s requires %s (before it)' % (option, _OPTION_MODULES[option]))
+                else:
+                    messages.append('unknown option %s' % option)
+                continue
+        name, module_options, used = module
+        if option in used:
+            messages.append('multiple %s options' % option)
+        if name in EXCLUSIVE:
+            exclusive = EXCLUSIVE[name]
+            if option in exclusive and used.intersection(exclusive):
+                messages.append('%s: only one of %s may be given' % (name, ", ".join(sorted(set(
+                    [option] + [used_option for used_option in used if used_option in exclusive])))))
+        used.add(option)
+        arity = module_options[option]
+        if arity != len(values):
+            error = _arity_error(option, arity, values)
+            if error:
+                messages.append(error)
+                continue
+        if option in _CHECKED_VALUES:
+            _check_value(option, values, messages)
+    return messages
+
+
+def validate_rule(rule, profile=None, chains=None, table=None):
+    """Returns a list of the problems found in the rule definitions of rule
+    (an AbstractRule, or an ArgumentList such as a Match or Channel)"""
+    if hasattr(rule, 'rule_definitions'):
+        lines = rule.rule_definitions(profile)
+    else:
+        lines = [rule.to_iptables()]
+    messages = []
+    for line in lines:
+        messages.extend(validate_line(line, chains, table))
+    return messages
+
+
+def _payload_lines(payload):
+    """Yields (line, table, chain, rule) for an iptables-restore payload"""
+    for line in payload.split('\n'):
+        yield line, None, None, None
+
+
+def validate(tables, profile=None):
+    """Validate tables (a Tables object, or an iptables-restore payload),
+    see module documentation.
+
+    tables  - a Tables object or iptables-restore formatted string
+    profile - the Profile used to render the tables
+
+    Returns a list of ValidationErrors
+    """
+    if isinstance(tables, six.string_types):
+        lines = _payload_lines(tables)
+    else:
+        lines = tables.iter_iptables(profile=get_profile(profile))
+    errors = []
+    table_name = None
+    chains = set()
+    for line_no, (line, table, chain, rule) in enumerate(lines, 1):
+        if not line or line[0] == '#' or line == 'COMMIT':
+            continue
+        if line[0] == '*':
+            table_name = line[1:].strip()
+            chains = set()
+            continue
+        if line[0] == ':':
+            name = (line[1:].split() or [''])[0]
+            chains.add(name)
+            messages = []
+            _check_chain_name(name, messages)
+        else:
+            messages = validate_line(line, chains, table_name)
+        for message in messages:
+            debug_info = None
+            for obj in (rule, chain, table):
+                if obj is not None:
+                    debug_info = obj.debug_info()
+                    break
+            errors.append(ValidationError(line_no, message, table, chain, rule, debug_info))
+    return errors